@@ -1,8 +1,12 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, stream_with_context, g
 import pandas as pd
 import threading
+import gzip
 import argparse
+import logging
+import os
 import sys
+import time
 import traceback  # Add this import for better error reporting
 from stock_data import (
     get_sector_comparison, 
@@ -10,10 +14,29 @@ from stock_data import (
     get_stock_code, 
     update_daily_data,
     update_daily_data_batch,
-    get_all_sector_stocks_data  # Add the new function
+    get_all_sector_stocks_data,  # Add the new function
+    get_sector_stock_codes,
+    refresh_sector_stocks,
+    compact_cold_history_if_due,
+    calculate_sector_score
 )
 from sector import SECTORS
 from datetime import datetime
+import db
+import events
+import instrumentation
+import jobs
+import scheduler
+import wire_format
+
+# Responses smaller than this are never gzip compressed
+GZIP_MIN_BYTES = 1024
+
+# Compression level of the pre-compressed sector data response
+GZIP_LEVEL = 6
+
+# Maximum number of serialized responses (deltas, formats, projections) kept for the latest version
+MAX_CACHED_RESPONSES = 32
 
 # Global variables to track initialization status
 initialization_status = {
@@ -23,27 +46,56 @@ initialization_status = {
     'error': None
 }
 
+def has_cached_data():
+    """Check whether a sector snapshot exists, from the last data_version event (no database access)"""
+    return events.get_last_event('data_version') is not None
+
+def publish_initialization_status():
+    """Push the current initialization status to the event stream"""
+    events.publish('status', dict(initialization_status, has_cached_data=has_cached_data()))
+
+def announce_current_data_version():
+    """Publish the version of the latest stored snapshot once at startup"""
+    version = db.get_latest_sector_version()
+    if version is not None and events.get_last_event('data_version') is None:
+        events.publish('data_version', {'version': version, 'created_at': None})
+
 # Create a function to fetch all data on startup
-def initialize_data():
-    """Fetch all stock data from Tushare and save to database on startup"""
+def initialize_data(job=None):
+    """Fetch all stock data from Tushare and save to database on startup
+    
+    Runs as the body of a refresh job (see refresh_jobs); progress and
+    cancellation go through job.progress. A job with targets only refreshes
+    those stocks and the sectors that contain them.
+    """
     global initialization_status
     
     # Mark initialization as in progress
     initialization_status['in_progress'] = True
     initialization_status['complete'] = False
     initialization_status['error'] = None
+    publish_initialization_status()
     
     print("\n======== 应用启动: 初始化数据 ========")
     try:
-        # Use the optimized function to get all data at once
-        get_all_sector_stocks_data(days=120)  # Changed from 90 to 120 days (4 months)
+        if job is not None and job.targets is not None:
+            result = refresh_sector_stocks(job.targets, days=120, progress=job.progress)
+        else:
+            # Use the optimized function to get all data at once
+            result = get_all_sector_stocks_data(days=120,  # Changed from 90 to 120 days (4 months)
+                                                progress=job.progress if job else None)
+            if result:
+                # Old bars move to the compressed cold tier once a day, after a full refresh
+                compact_cold_history_if_due()
         
         # Update status to complete
-        initialization_status['complete'] = True
+        initialization_status['complete'] = bool(result) or has_cached_data()
         initialization_status['in_progress'] = False
-        initialization_status['last_update'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if result:
+            initialization_status['last_update'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        publish_initialization_status()
         
-        return True
+        return bool(result)
     except Exception as e:
         error_msg = f"数据初始化发生错误: {e}"
         print(error_msg)
@@ -52,41 +104,94 @@ def initialize_data():
         initialization_status['complete'] = False
         initialization_status['in_progress'] = False
         initialization_status['error'] = error_msg
+        publish_initialization_status()
         
         return False
 
+# Single-flight manager of full refreshes: overlapping requests join the
+# running refresh or one merged pending refresh
+refresh_jobs = jobs.JobManager(initialize_data)
+
+def get_last_refresh_time():
+    """Get the creation time of the latest sector snapshot, or None"""
+    _, created_at, _ = db.get_latest_sector_snapshot()
+    return datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S") if created_at else None
+
+# Refreshes each market's stocks during its trading sessions and once after the close
+refresh_scheduler = scheduler.MarketRefreshScheduler(
+    lambda codes: refresh_jobs.submit(codes)[0],
+    get_sector_stock_codes,
+    last_refresh_provider=get_last_refresh_time
+)
+
 # Initialize the Flask app
 app = Flask(__name__)
+announce_current_data_version()
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    """Observe the latency of every request per route (streaming responses until the headers are sent)"""
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        instrumentation.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started_at, route=route,
+                                                     method=request.method, status=response.status_code)
+    return response
 
 # Define a function to initialize data that will be called later
 def start_background_initialization():
-    """Run data initialization in a background thread"""
-    global initialization_status
+    """Request a full refresh in the background
     
-    # Check if initialization is already in progress
-    if initialization_status['in_progress']:
-        return False
-        
-    def init_data_thread():
-        print("数据初始化已在后台线程启动")
-        try:
-            initialize_data()
-        except Exception as e:
-            error_msg = f"初始化数据时发生错误: {e}"
-            print(error_msg)
-            initialization_status['error'] = error_msg
-            initialization_status['in_progress'] = False
-    
-    thread = threading.Thread(target=init_data_thread)
-    thread.daemon = True
-    thread.start()
-    return True
+    Returns:
+        Job: The refresh job this request was merged into
+    """
+    job, created = refresh_jobs.submit()
+    if created:
+        print(f"数据初始化已在后台启动 (任务 {job.id})")
+    else:
+        print(f"已有刷新任务 {job.id}，本次请求已合并")
+    return job
 
 @app.route('/initialize', methods=['GET'])
 def start_initialization():
     """Start the initialization process on demand"""
-    start_background_initialization()
-    return jsonify({'status': 'success', 'message': 'Initialization started in background'})
+    job = start_background_initialization()
+    return jsonify({
+        'status': 'success',
+        'message': 'Initialization started in background',
+        'job_id': job.id,
+        'job': job.to_dict()
+    })
+
+@app.route('/api/scheduler')
+def scheduler_status():
+    """API endpoint with the market sessions and the background refresh schedule"""
+    return jsonify({'status': 'success', 'scheduler': refresh_scheduler.get_status()})
+
+@app.route('/api/jobs')
+def list_jobs():
+    """API endpoint listing the running, pending and recent refresh jobs"""
+    return jsonify({'status': 'success', 'jobs': [job.to_dict() for job in refresh_jobs.list_jobs()]})
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """API endpoint with the status and progress of one refresh job"""
+    job = refresh_jobs.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'Unknown job {job_id}'}), 404
+    return jsonify({'status': 'success', 'job': job.to_dict()})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """API endpoint to cancel a pending or running refresh job"""
+    job = refresh_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': f'No unfinished job {job_id}'}), 404
+    return jsonify({'status': 'success', 'job': job.to_dict()})
 
 @app.route('/api/init-status')
 def check_init_status():
@@ -94,17 +199,9 @@ def check_init_status():
     global initialization_status
     
     try:
-        # Check if sectors have data in the database regardless of initialization status
-        has_data = False
-        from datetime import datetime, timedelta
-        import db
-        
-        # Check if at least one sector has data in the database
-        for sector in SECTORS.keys():
-            data, fetch_time = db.get_latest_sector_data(sector)
-            if data is not None:
-                has_data = True
-                break
+        # Check if sector data exists regardless of initialization status (tracked
+        # in memory from data_version events, so polling never hits the database)
+        has_data = has_cached_data()
         
         # If we have data but initialization status is not properly set, fix it
         if has_data and not initialization_status['complete'] and not initialization_status['in_progress']:
@@ -137,6 +234,34 @@ def check_init_status():
             }
         })
 
+@app.route('/api/events')
+def stream_events():
+    """Server-Sent Events stream of refresh progress, status and data version events
+    
+    A new connection first receives the latest event of every type, then
+    'progress' events while a refresh runs and a 'data_version' event whenever
+    a refresh commits a new snapshot.
+    """
+    subscriber = events.subscribe()
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            for message in events.stream_events(subscriber):
+                yield message
+        finally:
+            events.unsubscribe(subscriber)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose the instrumentation counters and histograms in the Prometheus text format"""
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     """Render the home page without starting initialization"""
@@ -147,62 +272,289 @@ def sector_comparison():
     """Render the sector comparison page without starting initialization"""
     return render_template('sector_comparison.html')
 
+# Formatted payload ('payload', version) and serialized /api/sector-data
+# responses (version, since, format, fields, encoding) of the latest snapshot version
+_sector_response_cache = {}
+_sector_response_lock = threading.Lock()
+
+def _format_sector_payload(sector_data):
+    """Build the /api/sector-data response dict from the sector comparison data"""
+    # Calculate sector scores for sorting
+    sector_scores = {}
+    for sector, stocks in sector_data.items():
+        if stocks and isinstance(stocks[0], dict) and 'sector_score' in stocks[0]:
+            sector_scores[sector] = stocks[0]['sector_score']
+        else:
+            sector_scores[sector] = 0
+    
+    # Transform data for JSON response
+    formatted_data = {}
+    for sector, stocks in sector_data.items():
+        formatted_stocks = []
+        for stock in stocks:
+            formatted_stocks.append({
+                'name': stock['name'],
+                'code': stock['code'],
+                'latest_price': float(stock['latest_price']) if stock['latest_price'] else None,
+                'highest_price': float(stock['highest_price']) if stock['highest_price'] else None,
+                'highest_date': stock['highest_date'],
+                'max_4m_increase': float(stock.get('max_4m_increase', stock.get('max_3m_increase', 0))) if stock.get('max_4m_increase') or stock.get('max_3m_increase') else None,  # Handle both old and new field names
+                'drop_percentage': float(stock['drop_percentage']) if stock['drop_percentage'] else None,
+                'sector_score': float(stock['sector_score']) if 'sector_score' in stock else 0,
+                'latest_volume': float(stock.get('latest_volume', 0)) if stock.get('latest_volume') else None,
+                'max_volume': float(stock.get('max_volume', 0)) if stock.get('max_volume') else None,
+                'volume_ratio': float(stock.get('volume_ratio', 0)) if stock.get('volume_ratio') else None
+            })
+        formatted_data[sector] = formatted_stocks
+    
+    # Create a sorted response with sectors in order by score
+    sorted_sectors = sorted(formatted_data.keys(), 
+                           key=lambda x: sector_scores.get(x, 0), 
+                           reverse=True)
+    
+    return {
+        'status': 'success', 
+        'data': formatted_data,
+        'sorted_sectors': sorted_sectors,
+        'sector_scores': sector_scores
+    }
+
+def _snapshot_sector_data(version):
+    """Get the sectors of one snapshot version with their scores, never fetching anything
+    
+    Sectors missing from the snapshot are empty.
+    
+    Returns:
+        dict: sector -> stocks, or None if the snapshot does not exist (e.g. pruned)
+    """
+    snapshot = db.get_sector_snapshot(version)
+    if snapshot is None:
+        return None
+    
+    sector_data = {}
+    for sector in SECTORS:
+        stocks = snapshot.get(sector, [])
+        # The snapshot is shared, so data saved without scores gets scored copies
+        if not all(isinstance(stock, dict) and 'sector_score' in stock for stock in stocks):
+            sector_score = calculate_sector_score(stocks)
+            stocks = [dict(stock, sector_score=sector_score) if isinstance(stock, dict) else stock
+                      for stock in stocks]
+        sector_data[sector] = stocks
+    return sector_data
+
+def _get_sector_payload(version):
+    """Get the formatted payload of one snapshot version, or None if the snapshot does not exist
+    
+    The payload is built from exactly that snapshot, outside the cache lock,
+    so a request never waits for another request's database read.
+    """
+    with _sector_response_lock:
+        payload = _sector_response_cache.get(('payload', version))
+    instrumentation.record_cache('sector_payload', payload is not None)
+    if payload is not None:
+        return payload
+    
+    sector_data = _snapshot_sector_data(version)
+    if sector_data is None:
+        return None
+    payload = _format_sector_payload(sector_data)
+    payload['version'] = version
+    
+    with _sector_response_lock:
+        newest = max((key[1] for key in _sector_response_cache if key[0] == 'payload'), default=None)
+        if newest is None or version > newest:
+            # Responses of older versions are never served again
+            _sector_response_cache.clear()
+            _sector_response_cache[('payload', version)] = payload
+        elif version == newest:
+            # Built concurrently by another request
+            payload = _sector_response_cache[('payload', version)]
+    return payload
+
+def _serialize_payload(payload, etag, encoding='json'):
+    """Serialize and gzip compress a response payload once for reuse"""
+    body, mimetype = wire_format.encode(payload, encoding)
+    return {
+        'etag': etag,
+        'mimetype': mimetype,
+        'body': body,
+        'gzip_body': gzip.compress(body, GZIP_LEVEL) if len(body) >= GZIP_MIN_BYTES else None
+    }
+
+def _without_score(stock):
+    """A formatted stock without its sector_score, for comparing versions"""
+    if stock is None:
+        return None
+    return {key: value for key, value in stock.items() if key != 'sector_score'}
+
+def _build_sector_delta(since, payload):
+    """Diff the formatted payload of one snapshot version against snapshot `since`
+    
+    Both sides are read by snapshot version, so the delta leads from exactly
+    `since` to exactly payload['version'].
+    
+    Returns:
+        dict: Delta payload with the changed stocks and sector scores, or None
+        if `since` is newer, the old snapshot no longer exists or the set
+        of sectors changed
+    """
+    if since > payload['version']:
+        return None
+    old_data = _snapshot_sector_data(since)
+    if old_data is None:
+        return None
+    old_payload = _format_sector_payload(old_data)
+    if set(old_payload['data']) != set(payload['data']):
+        return None
+    
+    changed = {}
+    removed = {}
+    sector_scores = {}
+    for sector, stocks in payload['data'].items():
+        old_stocks = {stock['code']: stock for stock in old_payload['data'][sector]}
+        new_codes = {stock['code'] for stock in stocks}
+        
+        # The sector score repeated on every stock is sent once per sector instead
+        changed_stocks = [stock for stock in stocks
+                          if _without_score(old_stocks.get(stock['code'])) != _without_score(stock)]
+        if changed_stocks:
+            changed[sector] = changed_stocks
+        removed_codes = [code for code in old_stocks if code not in new_codes]
+        if removed_codes:
+            removed[sector] = removed_codes
+        if old_payload['sector_scores'].get(sector) != payload['sector_scores'].get(sector):
+            sector_scores[sector] = payload['sector_scores'].get(sector)
+    
+    return {
+        'status': 'success',
+        'delta': True,
+        'since': since,
+        'version': payload['version'],
+        'changed': changed,
+        'removed': removed,
+        'sector_scores': sector_scores,
+        'sorted_sectors': payload['sorted_sectors']
+    }
+
+def _get_sector_response_entry(version, since=None, fmt='rows', fields=None, encoding='json'):
+    """Get the serialized and gzip compressed response of a snapshot version
+    
+    The payload is formatted once per version, and each requested variant
+    (delta since a version, rows or columnar layout, field projection,
+    encoding) is serialized once; later requests reuse the bytes until a
+    refresh commits a newer snapshot. A delta that cannot be computed falls
+    back to the full response. Deltas are always row based.
+    
+    Returns:
+        dict: The cache entry, or None if the snapshot does not exist
+    """
+    payload = _get_sector_payload(version)
+    if payload is None:
+        return None
+    
+    key = (version, since, fmt, fields, encoding)
+    with _sector_response_lock:
+        entry = _sector_response_cache.get(key)
+    instrumentation.record_cache('sector_response', entry is not None)
+    if entry is not None:
+        return entry
+    
+    delta = _build_sector_delta(since, payload) if since is not None else None
+    if delta is not None:
+        variant, etag = wire_format.project_rows(delta, fields), f'sector-delta-{since}-{version}'
+    elif fmt == 'columnar':
+        variant, etag = wire_format.to_columnar(payload, fields), f'sector-columnar-{version}'
+    else:
+        variant, etag = wire_format.project_rows(payload, fields), f'sector-data-{version}'
+    if fields is not None:
+        etag += '-' + '.'.join(fields)
+    if encoding != 'json':
+        etag += '-' + encoding
+    entry = _serialize_payload(variant, etag, encoding)
+    
+    with _sector_response_lock:
+        # Only responses of the newest cached version are kept
+        if ('payload', version) in _sector_response_cache:
+            response_keys = [cached_key for cached_key in _sector_response_cache if cached_key[0] != 'payload']
+            if len(response_keys) >= MAX_CACHED_RESPONSES:
+                del _sector_response_cache[response_keys[0]]
+            _sector_response_cache[key] = entry
+    return entry
+
+def _cached_sector_response(version, since=None, fmt='rows', fields=None, encoding='json'):
+    """Answer /api/sector-data from the response cache, honouring If-None-Match
+    
+    Returns None if the snapshot does not exist.
+    """
+    entry = _get_sector_response_entry(version, since, fmt, fields, encoding)
+    if entry is None:
+        return None
+    
+    if request.if_none_match.contains_weak(entry['etag']):
+        response = Response(status=304)
+    elif entry['gzip_body'] is not None and request.accept_encodings['gzip']:
+        response = Response(entry['gzip_body'], mimetype=entry['mimetype'])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(entry['body'], mimetype=entry['mimetype'])
+    
+    response.set_etag(entry['etag'], weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/sector-data')
 def get_sector_data():
-    """API endpoint to get sector comparison data in JSON format"""
+    """API endpoint to get sector comparison data in JSON format
+    
+    Query parameters:
+        refresh: true to start a background refresh
+        since: Version held by the client, to get only the changes since then
+        format: rows (default, one dict per stock) or columnar (each distinct
+            stock once as columns, sectors as lists of row indexes)
+        fields: Comma separated stock fields to send (code is always included)
+        encoding: json (default) or msgpack (if installed)
+    """
     try:
         # Check if we need to force a refresh
         force_refresh = request.args.get('refresh', 'false').lower() == 'true'
         
-        # Check if initialization is complete (and use that data if available)
-        if initialization_status['complete'] and not force_refresh:
-            # Use cached data from initialization
-            sector_data = get_sector_comparison(force_refresh=False)
-        elif force_refresh:
-            # If refresh is requested, use the optimized function to get all data at once
-            sector_data = get_all_sector_stocks_data(days=120)  # Changed to 120 days
-        else:
-            # If initialization is not complete and no refresh requested, try to use cached data
-            sector_data = get_sector_comparison(force_refresh=False)
+        # Clients holding an earlier version ask only for what changed since then
+        since = request.args.get('since', type=int)
         
-        # Calculate sector scores for sorting
-        sector_scores = {}
-        for sector, stocks in sector_data.items():
-            if stocks and isinstance(stocks[0], dict) and 'sector_score' in stocks[0]:
-                sector_scores[sector] = stocks[0]['sector_score']
-            else:
-                sector_scores[sector] = 0
+        # Wire format of the response
+        fmt = request.args.get('format', 'rows')
+        encoding = request.args.get('encoding', 'json')
+        try:
+            fields = wire_format.parse_fields(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if fmt not in wire_format.FORMATS:
+            return jsonify({'status': 'error', 'message': f'Unknown format {fmt}'}), 400
+        if encoding not in wire_format.ENCODINGS:
+            return jsonify({'status': 'error', 'message': f'Unknown encoding {encoding}'}), 400
+        if not wire_format.is_encoding_available(encoding):
+            return jsonify({'status': 'error', 'message': f'Encoding {encoding} is not available'}), 406
         
-        # Transform data for JSON response
-        formatted_data = {}
-        for sector, stocks in sector_data.items():
-            formatted_stocks = []
-            for stock in stocks:
-                formatted_stocks.append({
-                    'name': stock['name'],
-                    'code': stock['code'],
-                    'latest_price': float(stock['latest_price']) if stock['latest_price'] else None,
-                    'highest_price': float(stock['highest_price']) if stock['highest_price'] else None,
-                    'highest_date': stock['highest_date'],
-                    'max_4m_increase': float(stock.get('max_4m_increase', stock.get('max_3m_increase', 0))) if stock.get('max_4m_increase') or stock.get('max_3m_increase') else None,  # Handle both old and new field names
-                    'drop_percentage': float(stock['drop_percentage']) if stock['drop_percentage'] else None,
-                    'sector_score': float(stock['sector_score']) if 'sector_score' in stock else 0,
-                    'latest_volume': float(stock.get('latest_volume', 0)) if stock.get('latest_volume') else None,
-                    'max_volume': float(stock.get('max_volume', 0)) if stock.get('max_volume') else None,
-                    'volume_ratio': float(stock.get('volume_ratio', 0)) if stock.get('volume_ratio') else None
-                })
-            formatted_data[sector] = formatted_stocks
+        # A requested refresh runs as a background job; the response never waits for it
+        job = start_background_initialization() if force_refresh else None
         
-        # Create a sorted response with sectors in order by score
-        sorted_sectors = sorted(formatted_data.keys(), 
-                               key=lambda x: sector_scores.get(x, 0), 
-                               reverse=True)
+        # Serve the cached response of the latest snapshot (the refresh job
+        # commits a new version and announces it as a data_version event)
+        version = db.get_latest_sector_version()
+        response = _cached_sector_response(version, since, fmt, fields, encoding) if version is not None else None
+        if response is not None:
+            if job is not None:
+                response.headers['X-Refresh-Job'] = job.id
+            return response
         
+        # Nothing has been saved yet: start the first refresh and tell the client to wait
+        job = job or start_background_initialization()
         return jsonify({
-            'status': 'success', 
-            'data': formatted_data,
-            'sorted_sectors': sorted_sectors,
-            'sector_scores': sector_scores
+            'status': 'pending',
+            'message': 'No sector data yet, a refresh has been started',
+            'job_id': job.id,
+            'job': job.to_dict()
         })
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
@@ -316,25 +668,62 @@ def get_sector_data_debug():
 def refresh_all_data():
     """API endpoint to refresh all stock data in one go"""
     try:
-        # Start refreshing in a background thread
-        def refresh_thread():
-            try:
-                get_all_sector_stocks_data(days=120)  # Changed to 120 days
-                print("一次性刷新所有股票数据完成")
-            except Exception as e:
-                print(f"刷新数据时发生错误: {e}")
-        
-        thread = threading.Thread(target=refresh_thread)
-        thread.daemon = True
-        thread.start()
+        # Start refreshing in the background (or join the refresh already running)
+        job = start_background_initialization()
         
         return jsonify({
             'status': 'success',
-            'message': 'Started refreshing all stock data in the background'
+            'message': 'Started refreshing all stock data in the background',
+            'job_id': job.id,
+            'job': job.to_dict()
         })
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/refresh', methods=['GET', 'POST'])
+def refresh_targets():
+    """API endpoint to refresh only some sectors (?sector=X) or stocks (?code=Y)
+    
+    Both parameters can be repeated; code accepts a ts_code or a stock name.
+    Only the affected stocks are fetched and only the sectors containing them
+    are recomputed, in a background job merged with any overlapping refresh.
+    """
+    sectors = request.args.getlist('sector')
+    codes = request.args.getlist('code')
+    if not sectors and not codes:
+        return jsonify({'status': 'error', 'message': 'Pass at least one sector or code'}), 400
+    
+    unknown_sectors = [sector for sector in sectors if sector not in SECTORS]
+    if unknown_sectors:
+        return jsonify({'status': 'error', 'message': f'Unknown sectors: {", ".join(unknown_sectors)}'}), 404
+    
+    targets = set(get_sector_stock_codes(sectors)) if sectors else set()
+    if codes:
+        sector_codes = set(get_sector_stock_codes())
+        unknown_codes = []
+        for code in codes:
+            ts_code = code if code in sector_codes else get_stock_code(code)
+            if ts_code in sector_codes:
+                targets.add(ts_code)
+            else:
+                unknown_codes.append(code)
+        if unknown_codes:
+            return jsonify({'status': 'error',
+                            'message': f'Not a stock of any sector: {", ".join(unknown_codes)}'}), 404
+    
+    if not targets:
+        return jsonify({'status': 'error', 'message': 'No stock codes could be resolved'}), 404
+    
+    job, created = refresh_jobs.submit(targets)
+    print(f"定向刷新 {len(targets)} 只股票 (任务 {job.id}{'' if created else '，已合并'})")
+    return jsonify({
+        'status': 'success',
+        'message': f'Started refreshing {len(targets)} stocks in the background',
+        'codes': sorted(targets),
+        'job_id': job.id,
+        'job': job.to_dict()
+    })
+
 if __name__ == '__main__':
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description='Stock Analysis Web Application')
@@ -344,8 +733,13 @@ if __name__ == '__main__':
                         help='Port to run the application on (default: 5000)')
     parser.add_argument('--debug', action='store_true',
                         help='Enable additional debug output')
+    parser.add_argument('--no-scheduler', action='store_true',
+                        help='Disable the background refreshes during market sessions')
     args = parser.parse_args()
     
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    
     # Set debug mode
     app.config['DEBUG_MODE'] = args.debug
     
@@ -353,12 +747,19 @@ if __name__ == '__main__':
     if not args.no_init:
         print("正在启动应用，首先初始化数据...")
         try:
-            initialize_data()
+            start_background_initialization().wait()
         except Exception as e:
             print(f"初始化数据时发生错误: {e}")
             print("应用将继续启动，但可能需要手动更新数据")
     else:
         print("按照参数设置跳过自动数据初始化。请使用网页界面上的'初始化股票数据'按钮手动初始化。")
     
+    # Keep the data fresh during market sessions. The reloader runs this
+    # script twice; only the serving child process schedules refreshes.
+    if args.no_scheduler:
+        print("按照参数设置禁用后台定时刷新。")
+    elif os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        refresh_scheduler.start()
+    
     # Start the Flask app
     app.run(debug=True, port=args.port)
@@ -0,0 +1,216 @@
+"""
+Offline Tushare stand-in serving a deterministic synthetic stock universe
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# Characters combined into the synthetic stock names (4 characters each)
+NAME_CHARACTERS = '华中国东南新金银天海长大通安宏兴盛达信恒力龙泰鼎光电科技智能源汽车'
+
+# Characters of names listed in sectors but missing from stock_basic (never resolvable)
+UNKNOWN_NAME_CHARACTERS = '甲乙丙丁戊己庚辛'
+
+# Share of the universe listed in Hong Kong
+HK_SHARE = 0.25
+
+# Share of the sector names that do not exist in stock_basic
+UNKNOWN_SHARE = 0.01
+
+# Stocks per synthetic sector, and stocks each sector borrows from its neighbour
+SECTOR_SIZE = 10
+SECTOR_OVERLAP = 2
+
+# Calendar days of synthetic history before today
+HISTORY_DAYS = 400
+
+def _format_date(date):
+    return date.strftime('%Y%m%d')
+
+def _synthetic_name(index, characters):
+    base = len(characters)
+    chars = []
+    for _ in range(4):
+        index, digit = divmod(index, base)
+        chars.append(characters[digit])
+    return ''.join(chars)
+
+class SyntheticUniverse:
+    """Deterministic stock codes, names, sectors and daily bars
+    
+    The same size and seed always produce the same universe, so timings of
+    different runs process identical data.
+    """
+    
+    def __init__(self, size, seed=0, history_days=HISTORY_DAYS, today=None):
+        self.size = size
+        today = today or datetime.now()
+        
+        # Weekdays are trading days (the fake calendars say the same)
+        start = today - timedelta(days=history_days)
+        self.trade_dates = [_format_date(start + timedelta(days=offset)) for offset in range(history_days + 1)
+                            if (start + timedelta(days=offset)).weekday() < 5]
+        self.first_date = _format_date(start)
+        self.last_date = _format_date(today)
+        
+        hk_count = int(size * HK_SHARE)
+        self.codes = []
+        self.names = []
+        for index in range(size):
+            if index < hk_count:
+                self.codes.append(f'{index + 1:05d}.HK')
+                # Some Hong Kong names carry a share class suffix, like the real ones
+                name = _synthetic_name(index, NAME_CHARACTERS)
+                self.names.append(name + '-W' if index % 7 == 0 else name)
+            else:
+                number, suffix = (600000 + index, '.SH') if index % 2 else (index, '.SZ')
+                self.codes.append(f'{number:06d}{suffix}')
+                self.names.append(_synthetic_name(index, NAME_CHARACTERS))
+        self.index = {code: position for position, code in enumerate(self.codes)}
+        
+        # Random walk closes, one row per stock and one column per trade date
+        rng = np.random.default_rng(seed)
+        returns = rng.normal(0.0005, 0.02, size=(size, len(self.trade_dates)))
+        first_close = rng.uniform(5, 200, size=(size, 1))
+        self.close = np.round(first_close * np.exp(np.cumsum(returns, axis=1)), 2)
+        self.pre_close = np.concatenate([first_close.round(2), self.close[:, :-1]], axis=1)
+        spread = rng.uniform(0.0, 0.03, size=self.close.shape)
+        self.high = np.round(np.maximum(self.close, self.pre_close) * (1 + spread), 2)
+        self.low = np.round(np.minimum(self.close, self.pre_close) * (1 - spread), 2)
+        self.open = np.round((self.pre_close + self.close) / 2, 2)
+        self.vol = np.round(rng.lognormal(11, 0.6, size=self.close.shape), 2)
+        
+        # Sectors of SECTOR_SIZE consecutive stocks plus a few of the next sector's,
+        # with the occasional name that cannot be resolved
+        display_names = [name[:-2] if name.endswith('-W') else name for name in self.names]
+        unknown_every = max(1, int(1 / UNKNOWN_SHARE)) if UNKNOWN_SHARE else None
+        self.sectors = {}
+        for number, start_index in enumerate(range(0, size, SECTOR_SIZE)):
+            members = display_names[start_index:start_index + SECTOR_SIZE + SECTOR_OVERLAP]
+            if unknown_every and number % unknown_every == unknown_every - 1:
+                members.append(_synthetic_name(number, UNKNOWN_NAME_CHARACTERS))
+            self.sectors[f'合成行业{number + 1:04d}'] = members
+    
+    def is_hk(self, code):
+        return code.endswith('.HK')
+    
+    def market_codes(self, hk):
+        return [code for code in self.codes if self.is_hk(code) == hk]
+    
+    def bars(self, codes, start_date=None, end_date=None):
+        """Daily bars of some stocks in the Tushare daily layout, newest first"""
+        start_date = start_date or self.first_date
+        end_date = end_date or self.last_date
+        columns = [position for position, trade_date in enumerate(self.trade_dates)
+                   if start_date <= trade_date <= end_date]
+        rows = [self.index[code] for code in codes if code in self.index]
+        if not rows or not columns:
+            return pd.DataFrame(columns=['ts_code', 'trade_date', 'open', 'high', 'low', 'close',
+                                         'pre_close', 'change', 'pct_chg', 'vol', 'amount'])
+        
+        grid = np.ix_(rows, columns[::-1])
+        close = self.close[grid].ravel()
+        pre_close = self.pre_close[grid].ravel()
+        vol = self.vol[grid].ravel()
+        return pd.DataFrame({
+            'ts_code': np.repeat([self.codes[row] for row in rows], len(columns)),
+            'trade_date': np.tile([self.trade_dates[column] for column in columns[::-1]], len(rows)),
+            'open': self.open[grid].ravel(),
+            'high': self.high[grid].ravel(),
+            'low': self.low[grid].ravel(),
+            'close': close,
+            'pre_close': pre_close,
+            'change': np.round(close - pre_close, 2),
+            'pct_chg': np.round((close / pre_close - 1) * 100, 4),
+            'vol': vol,
+            'amount': np.round(vol * close / 10, 2)
+        })
+
+class FakeTushare:
+    """Offline replacement of the Tushare pro API object
+    
+    Implements the endpoints the application calls (daily, hk_daily,
+    stock_basic, hk_basic, trade_cal, hk_tradecal) on top of a
+    SyntheticUniverse, sleeping `latency` seconds per call to model the
+    network round trip.
+    """
+    
+    def __init__(self, universe, latency=0.0):
+        self.universe = universe
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+    
+    def _call(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+    
+    def call_count(self):
+        """Total number of calls served so far"""
+        with self._lock:
+            return sum(self.calls.values())
+    
+    def _daily(self, hk, ts_code=None, trade_date=None, start_date=None, end_date=None):
+        if trade_date:
+            return self.universe.bars(self.universe.market_codes(hk), trade_date, trade_date)
+        codes = [code for code in (ts_code or '').split(',') if code and self.universe.is_hk(code) == hk]
+        return self.universe.bars(codes, start_date, end_date)
+    
+    def daily(self, ts_code=None, trade_date=None, start_date=None, end_date=None, **kwargs):
+        self._call('daily')
+        return self._daily(False, ts_code, trade_date, start_date, end_date)
+    
+    def hk_daily(self, ts_code=None, trade_date=None, start_date=None, end_date=None, **kwargs):
+        self._call('hk_daily')
+        return self._daily(True, ts_code, trade_date, start_date, end_date)
+    
+    def stock_basic(self, **kwargs):
+        self._call('stock_basic')
+        codes = self.universe.market_codes(False)
+        names = [self.universe.names[self.universe.index[code]] for code in codes]
+        return pd.DataFrame({
+            'ts_code': codes,
+            'symbol': [code[:6] for code in codes],
+            'name': names,
+            'area': '合成',
+            'industry': '合成',
+            'market': '主板'
+        })
+    
+    def hk_basic(self, **kwargs):
+        self._call('hk_basic')
+        codes = self.universe.market_codes(True)
+        names = [self.universe.names[self.universe.index[code]] for code in codes]
+        return pd.DataFrame({'ts_code': codes, 'name': names, 'fullname': names, 'enname': '', 'market': '主板'})
+    
+    def _calendar(self, start_date=None, end_date=None):
+        start = datetime.strptime(start_date, '%Y%m%d')
+        end = datetime.strptime(end_date, '%Y%m%d')
+        days = [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+        is_open = [1 if day.weekday() < 5 else 0 for day in days]
+        previous = []
+        last_open = None
+        for day, day_open in zip(days, is_open):
+            previous.append(last_open)
+            if day_open:
+                last_open = _format_date(day)
+        return pd.DataFrame({
+            'cal_date': [_format_date(day) for day in days],
+            'is_open': is_open,
+            'pretrade_date': previous
+        })
+    
+    def trade_cal(self, exchange='SSE', start_date=None, end_date=None, **kwargs):
+        self._call('trade_cal')
+        calendar = self._calendar(start_date, end_date)
+        calendar.insert(0, 'exchange', exchange)
+        return calendar
+    
+    def hk_tradecal(self, start_date=None, end_date=None, **kwargs):
+        self._call('hk_tradecal')
+        return self._calendar(start_date, end_date)
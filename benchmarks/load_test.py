@@ -0,0 +1,309 @@
+"""
+HTTP load test of the dashboard endpoints on a seeded synthetic database
+
+The app is served by a threaded werkzeug server in a child process, after a
+full refresh of a synthetic universe (see benchmarks.fake_tushare) has seeded
+a scratch database. Concurrent clients then request a weighted mix of
+endpoints for a fixed time, and the latency percentiles, throughput and error
+rate are reported per endpoint. With --refresh, refreshes keep writing new
+bars to SQLite while the clients run.
+
+Usage:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --concurrency 32 --duration 30 --refresh
+    python benchmarks/load_test.py --mix sector-data=1,sector-data-columnar=1 --output results.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+# Request paths of the endpoints a mix can contain
+ENDPOINTS = {
+    'sector-data': '/api/sector-data',
+    'sector-data-columnar': '/api/sector-data?format=columnar',
+    'init-status': '/api/init-status',
+    'sector-comparison': '/sector-comparison',
+    'jobs': '/api/jobs',
+    'metrics': '/metrics'
+}
+
+# Default weights: dashboards mostly poll the status and load the data
+DEFAULT_MIX = 'sector-data=5,init-status=4,sector-comparison=1'
+
+# Default universe size, number of concurrent clients and run length
+DEFAULT_SIZE = 1000
+DEFAULT_CONCURRENCY = 16
+DEFAULT_DURATION_SECONDS = 20
+
+# Simulated round trip of one Tushare call in the server process
+DEFAULT_LATENCY_MS = 20
+
+# Calendar days of bars each concurrent refresh fetches and writes again
+REFRESH_REWIND_DAYS = 7
+
+# Seconds to wait for the server to seed its database and start
+SERVER_START_TIMEOUT_SECONDS = 600
+
+# Timeout of one request
+REQUEST_TIMEOUT_SECONDS = 30
+
+PERCENTILES = (50, 95, 99)
+
+def parse_mix(value):
+    """Parse 'endpoint=weight,...' into a dict endpoint -> weight
+    
+    Raises:
+        ValueError: If an endpoint is unknown or a weight is not a positive number
+    """
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}', expected one of: {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+        if mix[name] <= 0:
+            raise ValueError(f"Weight of '{name}' must be positive")
+    return mix
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+def summarize(latencies, errors, elapsed):
+    """Count, throughput, error rate and latency percentiles (ms) of one endpoint or of all"""
+    count = len(latencies) + errors
+    ordered = sorted(latencies)
+    summary = {
+        'requests': count,
+        'errors': errors,
+        'error_rate': round(errors / count, 4) if count else 0.0,
+        'throughput': round(count / elapsed, 2) if elapsed else 0.0
+    }
+    for percent in PERCENTILES:
+        value = percentile(ordered, percent)
+        summary[f'p{percent}_ms'] = round(value * 1000, 2) if value is not None else None
+    summary['max_ms'] = round(ordered[-1] * 1000, 2) if ordered else None
+    return summary
+
+def _rewind_watermarks(days):
+    """Make the next refresh fetch and write the last `days` of bars again"""
+    import db
+    rewound = (datetime.now() - timedelta(days=days)).strftime('%Y%m%d')
+    with db.transaction() as conn:
+        conn.execute('UPDATE price_watermarks SET last_trade_date = ? WHERE last_trade_date > ?',
+                     (rewound, rewound))
+
+def _refresh_loop(app_module):
+    """Keep one refresh with real SQLite writes running at all times"""
+    while True:
+        _rewind_watermarks(REFRESH_REWIND_DAYS)
+        job, _ = app_module.refresh_jobs.submit()
+        job.wait()
+
+def _serve(args):
+    """Seed a scratch database and serve the app (inside the child process)"""
+    from werkzeug.serving import make_server
+    
+    logging.basicConfig(level=logging.ERROR)
+    # werkzeug raises its own logger to INFO and would log every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    ready = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    
+    import fetcher
+    import stock_data
+    from benchmarks.fake_tushare import FakeTushare, SyntheticUniverse
+    
+    universe = SyntheticUniverse(args.size)
+    stock_data.set_pro(FakeTushare(universe, latency=args.latency_ms / 1000))
+    stock_data.SECTORS = universe.sectors
+    fetcher.ENDPOINT_QUOTAS = {}
+    fetcher.DEFAULT_QUOTA_PER_MINUTE = 10 ** 9
+    
+    import app as app_module
+    app_module.SECTORS = universe.sectors
+    app_module.start_background_initialization().wait()
+    
+    if args.refresh:
+        thread = threading.Thread(target=_refresh_loop, args=(app_module,), name='load-refresh')
+        thread.daemon = True
+        thread.start()
+    
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    print(f'READY {server.server_port}', file=ready, flush=True)
+    server.serve_forever()
+
+def _start_server(args, workdir):
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--size', str(args.size),
+               '--latency-ms', str(args.latency_ms)]
+    if args.refresh:
+        command.append('--refresh')
+    env = dict(os.environ, STOCK_DATA_DB=os.path.join(workdir, 'load_test.db'))
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+    
+    # The only line the child writes to stdout is the READY line
+    result = {}
+    def wait_ready():
+        line = process.stdout.readline()
+        if line.startswith('READY '):
+            result['port'] = int(line.split()[1])
+    waiter = threading.Thread(target=wait_ready)
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(SERVER_START_TIMEOUT_SECONDS)
+    if 'port' not in result:
+        process.kill()
+        raise RuntimeError('服务进程启动失败或超时')
+    return process, f"http://127.0.0.1:{result['port']}"
+
+def _request(base_url, path):
+    request = urllib.request.Request(base_url + path, headers={'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+        response.read()
+        return response.status
+
+def _completed_refreshes(base_url):
+    """Number of refreshes that reached the saving stage, from /metrics"""
+    request = urllib.request.Request(base_url + '/metrics')
+    with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+        text = response.read().decode('utf-8')
+    match = re.search(r'^stockapp_refresh_stage_seconds_count\{stage="saving"\} (\d+)', text, re.MULTILINE)
+    return int(match.group(1)) if match else 0
+
+def run_load(base_url, mix, concurrency, duration, seed=0):
+    """Request the endpoints of `mix` from `concurrency` threads for `duration` seconds
+    
+    Returns:
+        dict: 'total' and per-endpoint summaries (see summarize) and 'error_samples'
+    """
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    error_samples = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    
+    def client(number):
+        rng = random.Random(seed + number)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = _request(base_url, ENDPOINTS[name])
+                error = None if status < 400 else f'HTTP {status}'
+            except urllib.error.HTTPError as e:
+                error = f'HTTP {e.code}'
+            except Exception as e:
+                error = str(e)
+            elapsed = time.perf_counter() - start
+            with lock:
+                if error is None:
+                    latencies[name].append(elapsed)
+                else:
+                    errors[name] += 1
+                    if len(error_samples) < 10:
+                        error_samples.append(f'{name}: {error}')
+    
+    started_at = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    
+    endpoints = {name: summarize(latencies[name], errors[name], elapsed) for name in names}
+    total = summarize([value for values in latencies.values() for value in values], sum(errors.values()), elapsed)
+    return {'total': total, 'endpoints': endpoints, 'error_samples': error_samples}
+
+def print_report(results):
+    header = f"{'endpoint':<22}{'requests':>9}{'req/s':>9}{'errors':>8}" + ''.join(
+        f"{f'p{percent} ms':>10}" for percent in PERCENTILES) + f"{'max ms':>10}"
+    print(header)
+    rows = list(results['endpoints'].items()) + [('total', results['total'])]
+    for name, summary in rows:
+        print(f"{name:<22}{summary['requests']:>9}{summary['throughput']:>9.1f}"
+              f"{summary['error_rate'] * 100:>7.1f}%" + ''.join(
+                  f"{summary[f'p{percent}_ms'] if summary[f'p{percent}_ms'] is not None else '-':>10}"
+                  for percent in PERCENTILES) + f"{summary['max_ms'] if summary['max_ms'] is not None else '-':>10}")
+    for sample in results['error_samples']:
+        print(f"  错误示例: {sample}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dashboard endpoints on a synthetic database')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help=f'Stocks in the synthetic universe (default: {DEFAULT_SIZE})')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Concurrent clients (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION_SECONDS,
+                        help=f'Seconds to run (default: {DEFAULT_DURATION_SECONDS})')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'Weighted endpoints, e.g. {DEFAULT_MIX} (available: {", ".join(ENDPOINTS)})')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Keep a background refresh writing to the database during the run')
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                        help=f'Simulated latency of every Tushare call (default: {DEFAULT_LATENCY_MS})')
+    parser.add_argument('--output', help='Write the results JSON to this file')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.serve:
+        _serve(args)
+        return 0
+    
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    with tempfile.TemporaryDirectory(prefix='stock-load-test-') as workdir:
+        print(f"准备 {args.size} 只股票的合成数据库并启动服务...", flush=True)
+        process, base_url = _start_server(args, workdir)
+        try:
+            refreshes_before = _completed_refreshes(base_url)
+            print(f"以 {args.concurrency} 个并发客户端运行 {args.duration:g} 秒"
+                  f"{'，同时后台刷新' if args.refresh else ''}...", flush=True)
+            results = run_load(base_url, mix, args.concurrency, args.duration)
+            refreshes = _completed_refreshes(base_url) - refreshes_before
+        finally:
+            process.terminate()
+            process.wait()
+    
+    results.update({
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'size': args.size,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'mix': mix,
+        'refresh': args.refresh,
+        'refreshes_completed': refreshes
+    })
+    print_report(results)
+    if args.refresh:
+        print(f"运行期间完成 {refreshes} 次后台刷新")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    return 1 if results['total']['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
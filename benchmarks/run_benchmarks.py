@@ -0,0 +1,238 @@
+"""
+Benchmarks of the refresh path on synthetic universes, without a Tushare token
+
+Every universe size runs in its own process against a scratch database, with
+benchmarks.fake_tushare standing in for the Tushare API. Results are written
+as JSON; compared with a saved baseline, slower cases and cases that make more
+API calls are reported as regressions (exit status 1).
+
+Usage:
+    python benchmarks/run_benchmarks.py                          # 100, 1000 and 5000 stocks
+    python benchmarks/run_benchmarks.py --sizes 100 --latency-ms 0
+    python benchmarks/run_benchmarks.py --save-baseline          # update benchmarks/baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+# Universe sizes benchmarked by default
+DEFAULT_SIZES = (100, 1000, 5000)
+
+# Simulated round trip of one Tushare call
+DEFAULT_LATENCY_MS = 20
+
+# Runs of the warm (repeatable) cases; the median is reported
+DEFAULT_REPEAT = 3
+
+# Baseline the results are compared with
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+# A case regresses when it is this much slower than the baseline...
+DEFAULT_TOLERANCE = 0.25
+
+# ...and at least this many seconds slower (timer noise of the fast cases)
+MIN_REGRESSION_SECONDS = 0.05
+
+# Names resolved one by one in the get_stock_code case
+STOCK_CODE_SAMPLE = 200
+
+def _measure(fake, func, repeat=1):
+    """Time func, returning the median seconds and the Tushare calls of one run"""
+    timings = []
+    calls_before = fake.call_count()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {
+        'seconds': round(statistics.median(timings), 4),
+        'calls': (fake.call_count() - calls_before) // repeat
+    }
+
+def run_universe(size, latency, repeat, workdir):
+    """Run every case on one universe (inside the worker process)
+    
+    Returns:
+        dict: case -> {'seconds', 'calls'}
+    """
+    import db
+    import fetcher
+    import stock_data
+    from benchmarks.fake_tushare import FakeTushare, SyntheticUniverse
+    
+    universe = SyntheticUniverse(size)
+    fake = FakeTushare(universe, latency=latency)
+    stock_data.set_pro(fake)
+    stock_data.SECTORS = universe.sectors
+    
+    # The injected latency models the API; Tushare's quotas would only measure the limiter
+    fetcher.ENDPOINT_QUOTAS = {}
+    fetcher.DEFAULT_QUOTA_PER_MINUTE = 10 ** 9
+    
+    codes = list(universe.codes)
+    days = db.METRICS_WINDOW_DAYS
+    results = {}
+    
+    # Bulk insert of the whole price window into an empty database
+    db.use_database(os.path.join(workdir, 'save_daily_price.db'))
+    bars = universe.bars(codes, (datetime.now() - timedelta(days=days)).strftime('%Y%m%d'))
+    results['save_daily_price'] = _measure(fake, lambda: db.save_daily_price(bars))
+    results['save_daily_price']['rows'] = len(bars)
+    
+    # The same window written one trade date per batch, newest first: the
+    # date-major fetches run concurrently and reach the writer out of date order
+    db.use_database(os.path.join(workdir, 'upsert_date_major.db'))
+    date_frames = [frame for _, frame in bars.groupby('trade_date', sort=True)][::-1]
+    results['upsert_daily_prices_date_major'] = _measure(
+        fake, lambda: [db.upsert_daily_prices(frame) for frame in date_frames])
+    results['upsert_daily_prices_date_major']['rows'] = len(bars)
+    
+    # Price fetches alone, first into an empty database, then with nothing new to fetch
+    db.use_database(os.path.join(workdir, 'update_daily_data_batch.db'))
+    results['update_daily_data_batch_cold'] = _measure(
+        fake, lambda: stock_data.update_daily_data_batch(codes, days=days))
+    results['update_daily_data_batch_warm'] = _measure(
+        fake, lambda: stock_data.update_daily_data_batch(codes, days=days), repeat)
+    
+    # The whole refresh: stock_basic download, name resolution, fetch, metrics and snapshot
+    db.use_database(os.path.join(workdir, 'refresh.db'))
+    results['get_all_sector_stocks_data_cold'] = _measure(
+        fake, lambda: stock_data.get_all_sector_stocks_data(days=days))
+    results['get_all_sector_stocks_data_warm'] = _measure(
+        fake, lambda: stock_data.get_all_sector_stocks_data(days=days), repeat)
+    
+    # Names resolved through the stored aliases
+    names = [name for stocks in universe.sectors.values() for name in stocks][:STOCK_CODE_SAMPLE]
+    results['get_stock_code'] = _measure(fake, lambda: [stock_data.get_stock_code(name) for name in names], repeat)
+    
+    results['get_sector_comparison'] = _measure(fake, stock_data.get_sector_comparison, repeat)
+    return results
+
+def _run_worker(args):
+    # The application prints its progress; only failures matter here
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory(prefix='stock-benchmark-') as workdir:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                results = run_universe(args.worker, args.latency_ms / 1000, args.repeat, workdir)
+            finally:
+                sys.stdout = stdout
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f)
+
+def run_benchmarks(sizes, latency_ms, repeat):
+    """Run the cases for every universe size, each in a fresh process
+    
+    Returns:
+        dict: The results document (environment, settings and per-size results)
+    """
+    results = {}
+    for size in sizes:
+        print(f"基准测试: {size} 只股票...", flush=True)
+        with tempfile.TemporaryDirectory(prefix='stock-benchmark-') as workdir:
+            output = os.path.join(workdir, 'results.json')
+            # Importing db initializes its database, so point it at a scratch file first
+            env = dict(os.environ, STOCK_DATA_DB=os.path.join(workdir, 'import.db'))
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', str(size),
+                            '--output', output, '--latency-ms', str(latency_ms), '--repeat', str(repeat)],
+                           env=env, check=True)
+            with open(output, encoding='utf-8') as f:
+                results[str(size)] = json.load(f)
+        for case, result in results[str(size)].items():
+            print(f"  {case:<34} {result['seconds']:>9.4f}s {result['calls']:>6} 次调用")
+    
+    return {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency_ms': latency_ms,
+        'repeat': repeat,
+        'results': results
+    }
+
+def compare_with_baseline(current, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=MIN_REGRESSION_SECONDS):
+    """List the cases that got slower or make more Tushare calls than in the baseline
+    
+    Returns:
+        list: Human readable regression descriptions
+    """
+    regressions = []
+    for size, cases in current['results'].items():
+        baseline_cases = baseline.get('results', {}).get(size, {})
+        for case, result in cases.items():
+            expected = baseline_cases.get(case)
+            if expected is None:
+                continue
+            slower = result['seconds'] - expected['seconds']
+            if slower > min_seconds and result['seconds'] > expected['seconds'] * (1 + tolerance):
+                regressions.append(f"{size}/{case}: {result['seconds']:.4f}s (基线 {expected['seconds']:.4f}s, "
+                                   f"+{slower / expected['seconds'] * 100 if expected['seconds'] else 0:.0f}%)")
+            if result['calls'] > expected['calls']:
+                regressions.append(f"{size}/{case}: {result['calls']} 次调用 (基线 {expected['calls']} 次)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the refresh path on synthetic stock universes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='Universe sizes to benchmark (default: 100 1000 5000)')
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                        help=f'Simulated latency of every Tushare call (default: {DEFAULT_LATENCY_MS})')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'Runs of the warm cases (default: {DEFAULT_REPEAT})')
+    parser.add_argument('--output', help='Write the results JSON to this file')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='Baseline JSON to compare with (default: benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'Allowed slowdown before a case counts as a regression (default: {DEFAULT_TOLERANCE})')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker is not None:
+        _run_worker(args)
+        return 0
+    
+    current = run_benchmarks(args.sizes, args.latency_ms, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+    
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"已保存基线: {args.baseline}")
+        return 0
+    
+    if not os.path.exists(args.baseline):
+        print(f"没有基线文件 {args.baseline}，使用 --save-baseline 创建")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get('latency_ms') != args.latency_ms:
+        print(f"警告: 基线的模拟延迟为 {baseline.get('latency_ms')} ms，本次为 {args.latency_ms} ms")
+    
+    regressions = compare_with_baseline(current, baseline, args.tolerance)
+    if regressions:
+        print("性能回退:")
+        for regression in regressions:
+            print(f"  - {regression}")
+        return 1
+    print("与基线相比没有性能回退")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,68 +2,396 @@ import sqlite3
 import pandas as pd
 import os
 import json
+import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-# Database file path
-DB_PATH = os.path.join(os.path.dirname(__file__), 'stock_data.db')
+import instrumentation
+import price_codec
 
-def init_db():
-    """Initialize the database with required tables"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+logger = logging.getLogger(__name__)
+
+# Records the duration of a database operation in instrumentation.DB_OPERATION_SECONDS
+_timed = instrumentation.DB_OPERATION_SECONDS.timed
+
+# Database file path (the STOCK_DATA_DB environment variable overrides it)
+DB_PATH = os.environ.get('STOCK_DATA_DB') or os.path.join(os.path.dirname(__file__), 'stock_data.db')
+
+# Pragmas applied once to every pooled connection when it is opened
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',       # Readers no longer block on a concurrent writer
+    'PRAGMA synchronous=NORMAL',     # Safe with WAL and much cheaper than FULL
+    'PRAGMA cache_size=-32000',      # ~32MB page cache per connection
+    'PRAGMA mmap_size=268435456',    # Memory-map up to 256MB of the database file
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=10000',
+]
+
+# Number of prepared statements each connection keeps cached for reuse
+STATEMENT_CACHE_SIZE = 256
+
+# Maximum number of idle connections kept in the pool
+POOL_MAX_IDLE = 8
+
+# Number of calendar days covered by the materialized stock_metrics aggregates
+METRICS_WINDOW_DAYS = 120
+
+# Bars older than this many calendar days are moved from daily_prices into
+# compressed per-stock-per-year blobs in daily_prices_cold (at least METRICS_WINDOW_DAYS)
+COLD_HORIZON_DAYS = 730
+
+# Stocks compacted per transaction, so writers are never blocked for long
+COMPACTION_BATCH_STOCKS = 200
+
+# Retention of sector snapshots: the newest SNAPSHOT_KEEP_LAST are kept, and
+# older ones are also dropped once they are older than SNAPSHOT_MAX_AGE_DAYS
+# (the latest snapshot is always kept)
+SNAPSHOT_KEEP_LAST = 48
+SNAPSHOT_MAX_AGE_DAYS = 7
+
+# Index of stock_basic names; created again whenever save_stock_basic replaces the table
+_STOCK_BASIC_NAME_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS idx_stock_basic_name ON stock_basic (name)'
+
+# Incremented whenever stock_basic is rewritten, so in-memory indexes know to rebuild
+_stock_basic_version = 0
+
+# Callables notified with a DataFrame of the bars committed by every daily_prices upsert
+_price_write_listeners = []
+
+class ConnectionPool:
+    """Pool of configured SQLite connections, checked out by one thread at a time
     
-    # Create stock basic info table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS stock_basic (
-        ts_code TEXT PRIMARY KEY,
-        symbol TEXT,
-        name TEXT,
-        area TEXT,
-        industry TEXT,
-        last_updated TIMESTAMP
-    )
-    ''')
+    A thread keeps the same connection for nested calls and returns it to the
+    pool when its outermost `connection()` block exits, so Flask request threads
+    and refresh threads reuse already configured connections.
+    """
     
-    # Create price data table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS daily_prices (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        ts_code TEXT,
-        trade_date TEXT,
-        open REAL,
-        high REAL,
-        low REAL,
-        close REAL,
-        pre_close REAL,
-        change REAL,
-        pct_chg REAL,
-        vol REAL,
-        amount REAL,
-        UNIQUE(ts_code, trade_date)
-    )
-    ''')
+    def __init__(self, db_path, max_idle=POOL_MAX_IDLE):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
     
-    # Create sector comparison data table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS sector_data (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sector TEXT,
-        data_json TEXT,
-        fetch_time TIMESTAMP
-    )
-    ''')
+    def _open(self):
+        # Autocommit mode: write transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Check out the calling thread's connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        
+        self._local.conn = conn
+        self._local.tx_depth = 0
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one write transaction (nested calls join it)"""
+        with self.connection() as conn:
+            if self._local.tx_depth > 0:
+                self._local.tx_depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._local.tx_depth -= 1
+                return
+            
+            # IMMEDIATE takes the write lock up front, so the transaction never
+            # fails halfway through when it upgrades from reading to writing
+            conn.execute('BEGIN IMMEDIATE')
+            self._local.tx_depth = 1
+            try:
+                yield conn
+                # Helpers such as DataFrame.to_sql may already have committed
+                if conn.in_transaction:
+                    conn.execute('COMMIT')
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            finally:
+                self._local.tx_depth = 0
+    
+    def close_all(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+# Parsed copy of the latest sector snapshot: (version, created_at, data)
+_snapshot_cache = None
+_snapshot_cache_lock = threading.Lock()
+
+# created_at of the last stale snapshot a warning was logged for
+_stale_snapshot_warned = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Get the connection pool for the current DB_PATH"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != DB_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+def get_connection():
+    """Context manager yielding the calling thread's pooled connection"""
+    return get_pool().connection()
+
+def transaction():
+    """Context manager yielding a pooled connection inside a write transaction"""
+    return get_pool().transaction()
+
+def close_all_connections():
+    """Close all idle pooled connections (e.g. on shutdown)"""
+    if _pool is not None:
+        _pool.close_all()
+
+def use_database(db_path):
+    """Switch to another database file (e.g. a scratch file for benchmarks) and initialize it
     
-    conn.commit()
-    conn.close()
+    In-memory copies of the previous database's data are dropped.
+    """
+    global DB_PATH, _snapshot_cache, _stock_basic_version
+    with _pool_lock:
+        DB_PATH = db_path
+    with _snapshot_cache_lock:
+        _snapshot_cache = None
+    _stock_basic_version += 1
+    init_db()
+
+def init_db():
+    """Initialize the database with required tables and apply pending schema migrations
+    
+    The CREATE TABLE statements below are the version 1 schema; later changes
+    are made by SCHEMA_MIGRATIONS.
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
+        # Create stock basic info table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_basic (
+            ts_code TEXT PRIMARY KEY,
+            symbol TEXT,
+            name TEXT,
+            area TEXT,
+            industry TEXT,
+            last_updated TIMESTAMP
+        )
+        ''')
+        
+        # Create price data table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_prices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts_code TEXT,
+            trade_date TEXT,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            pre_close REAL,
+            change REAL,
+            pct_chg REAL,
+            vol REAL,
+            amount REAL,
+            UNIQUE(ts_code, trade_date)
+        )
+        ''')
+        
+        # Create cold tier of old bars: one compressed columnar blob per stock and year
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_prices_cold (
+            ts_code TEXT,
+            year INTEGER,
+            first_date TEXT,
+            last_date TEXT,
+            row_count INTEGER,
+            data BLOB,
+            PRIMARY KEY (ts_code, year)
+        )
+        ''')
+        
+        # Create per-stock fetch watermark table (last stored bar and the start of
+        # the contiguous range that has been downloaded for the stock)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_watermarks (
+            ts_code TEXT PRIMARY KEY,
+            last_trade_date TEXT,
+            covered_from TEXT,
+            last_updated TIMESTAMP
+        )
+        ''')
+        
+        # Create sector comparison data table
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sector_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sector TEXT,
+            data_json TEXT,
+            fetch_time TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sector_data_sector_time ON sector_data (sector, fetch_time)
+        ''')
+        
+        # Create versioned snapshots holding all sectors of one refresh
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sector_snapshots (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP,
+            data_json TEXT
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sector_snapshots_created ON sector_snapshots (created_at)
+        ''')
+        
+        # Create materialized per-stock aggregates over the rolling metrics window
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_metrics (
+            ts_code TEXT PRIMARY KEY,
+            window_start TEXT,
+            latest_date TEXT,
+            latest_price REAL,
+            latest_volume REAL,
+            highest_price REAL,
+            highest_date TEXT,
+            max_volume REAL,
+            max_volume_date TEXT,
+            max_increase REAL,
+            max_increase_date TEXT,
+            last_updated TIMESTAMP
+        )
+        ''')
+        
+        # Create table of stock names that have been resolved to a code
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_aliases (
+            name TEXT PRIMARY KEY,
+            ts_code TEXT,
+            last_updated TIMESTAMP
+        )
+        ''')
+        
+        # Create negative cache of names that could not be resolved
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_name_misses (
+            name TEXT PRIMARY KEY,
+            expires_at TIMESTAMP
+        )
+        ''')
+        
+        # Create trading calendar of every exchange (SSE, SZSE, HKEX)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trade_cal (
+            exchange TEXT,
+            cal_date TEXT,
+            is_open INTEGER,
+            pretrade_date TEXT,
+            last_updated TIMESTAMP,
+            PRIMARY KEY (exchange, cal_date)
+        )
+        ''')
+        
+        # Create table of the applied schema migrations
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP
+        )
+        ''')
+        _apply_migrations(cursor)
+
+def _migrate_daily_prices_without_rowid(cursor):
+    # Bars are clustered by (ts_code, trade_date): per-stock latest-bar and
+    # date-range reads are primary key range scans without a rowid lookup
+    cursor.execute(f'''
+    CREATE TABLE daily_prices_v2 (
+        ts_code TEXT NOT NULL,
+        trade_date INTEGER NOT NULL,
+        {', '.join(f'{col} REAL' for col in DAILY_PRICE_COLUMNS[2:])},
+        PRIMARY KEY (ts_code, trade_date)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute(f'''
+    INSERT INTO daily_prices_v2 ({', '.join(DAILY_PRICE_COLUMNS)})
+    SELECT ts_code, CAST(trade_date AS INTEGER), {', '.join(DAILY_PRICE_COLUMNS[2:])}
+    FROM daily_prices WHERE ts_code IS NOT NULL AND trade_date IS NOT NULL
+    ORDER BY ts_code, trade_date
+    ''')
+    cursor.execute('DROP TABLE daily_prices')
+    cursor.execute('ALTER TABLE daily_prices_v2 RENAME TO daily_prices')
+    cursor.execute(_STOCK_BASIC_NAME_INDEX_SQL)
+
+# Schema migrations applied in order by init_db: (version, description, function(cursor))
+SCHEMA_MIGRATIONS = [
+    (2, 'daily_prices WITHOUT ROWID keyed on (ts_code, trade_date INTEGER); '
+        'index on stock_basic(name)', _migrate_daily_prices_without_rowid),
+]
+
+def _apply_migrations(cursor):
+    """Run the migrations newer than the recorded schema version (inside the init_db transaction)"""
+    current = cursor.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 1
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("升级数据库结构到版本 %d: %s", version, description)
+        migrate(cursor)
+        cursor.execute(
+            'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+            (version, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        current = version
+
+def get_schema_version():
+    """Get the schema version of the current database"""
+    with get_connection() as conn:
+        return conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0] or 1
 
+@_timed(operation='save_stock_basic')
 def save_stock_basic(df):
     """Save stock basic information to database with better error handling"""
     if df is None or df.empty:
-        print("保存股票基本信息失败: 数据为空")
+        logger.warning("保存股票基本信息失败: 数据为空")
         return False
     
-    print(f"准备保存 {len(df)} 条股票基本信息到数据库...")
-    conn = sqlite3.connect(DB_PATH)
+    logger.info("准备保存 %d 条股票基本信息到数据库...", len(df))
     # Add last_updated column
     df['last_updated'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
@@ -72,152 +400,616 @@ def save_stock_basic(df):
         if 'market' not in df.columns:
             df['market'] = 'CN'  # Default to Chinese market
         
-        # Save to database
-        print("执行数据库保存操作...")
-        df.to_sql('stock_basic', conn, if_exists='replace', index=False)
-        print("股票基本信息保存完成")
+        with transaction() as conn:
+            # Save to database
+            logger.debug("执行数据库保存操作...")
+            df.to_sql('stock_basic', conn, if_exists='replace', index=False)
+            conn.execute(_STOCK_BASIC_NAME_INDEX_SQL)
+            logger.debug("股票基本信息保存完成")
+            
+            # Show statistics
+            cursor = conn.cursor()
+            cursor.execute("SELECT market, COUNT(*) FROM stock_basic GROUP BY market")
+            market_stats = cursor.fetchall()
         
-        # Show statistics
-        cursor = conn.cursor()
-        cursor.execute("SELECT market, COUNT(*) FROM stock_basic GROUP BY market")
-        market_stats = cursor.fetchall()
-        print("保存的股票统计:")
-        for market, count in market_stats:
-            market_name = {'CN': 'A股', 'HK': '港股', None: '其他'}.get(market, market)
-            print(f"  {market_name}: {count} 只")
+        global _stock_basic_version
+        _stock_basic_version += 1
+        
+        market_names = {'CN': 'A股', 'HK': '港股', None: '其他'}
+        logger.info("保存的股票统计: %s", '，'.join(f"{market_names.get(market, market)} {count} 只"
+                                                 for market, count in market_stats))
         
-        conn.close()
         return True
-    except Exception as e:
-        print(f"保存股票基本信息到数据库时发生错误: {e}")
-        conn.close()
+    except Exception:
+        logger.exception("保存股票基本信息到数据库时发生错误")
         return False
 
 def get_stock_basic():
     """Retrieve all stock basic info from database"""
-    conn = sqlite3.connect(DB_PATH)
     try:
-        df = pd.read_sql('SELECT * FROM stock_basic', conn)
-        conn.close()
-        return df
+        with get_connection() as conn:
+            return pd.read_sql('SELECT * FROM stock_basic', conn)
     except:
-        conn.close()
         return None
 
+def get_stock_basic_version():
+    """Get the version counter of the stock_basic table (changes on every rewrite)"""
+    return _stock_basic_version
+
+def get_stock_basic_last_updated():
+    """Get the time stock_basic was last downloaded, or None if it is empty"""
+    try:
+        with get_connection() as conn:
+            result = conn.execute('SELECT MAX(last_updated) FROM stock_basic').fetchone()
+        if result and result[0]:
+            return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
+    except Exception:
+        logger.exception("读取股票基本信息更新时间时发生错误")
+    return None
+
+@_timed(operation='get_stock_aliases')
+def get_stock_aliases(names):
+    """Get the saved name -> ts_code mappings for the given names"""
+    if not names:
+        return {}
+    
+    with get_connection() as conn:
+        cursor = conn.execute(
+            'SELECT name, ts_code FROM stock_aliases WHERE name IN (SELECT value FROM json_each(?))',
+            (json.dumps(list(names), ensure_ascii=False),)
+        )
+        return dict(cursor.fetchall())
+
+@_timed(operation='save_stock_aliases')
+def save_stock_aliases(aliases):
+    """Save resolved name -> ts_code mappings"""
+    if not aliases:
+        return True
+    
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO stock_aliases (name, ts_code, last_updated) VALUES (?, ?, ?)',
+            [(name, ts_code, now) for name, ts_code in aliases.items()]
+        )
+        # A name that resolves is no longer a miss
+        conn.executemany('DELETE FROM stock_name_misses WHERE name = ?',
+                         [(name,) for name in aliases])
+    return True
+
+def get_stock_name_misses(names):
+    """Get the names that are in the negative cache and have not expired yet"""
+    if not names:
+        return set()
+    
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_connection() as conn:
+        cursor = conn.execute(
+            '''SELECT name FROM stock_name_misses
+               WHERE name IN (SELECT value FROM json_each(?)) AND expires_at > ?''',
+            (json.dumps(list(names), ensure_ascii=False), now)
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+def save_stock_name_misses(names, ttl_minutes):
+    """Put unresolvable names into the negative cache for ttl_minutes"""
+    if not names:
+        return True
+    
+    expires_at = (datetime.now() + timedelta(minutes=ttl_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO stock_name_misses (name, expires_at) VALUES (?, ?)',
+            [(name, expires_at) for name in names]
+        )
+    return True
+
+@_timed(operation='save_trade_calendar')
+def save_trade_calendar(exchange, df):
+    """Save the calendar days of one exchange (cal_date, is_open, pretrade_date)"""
+    if df is None or df.empty:
+        return False
+    
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [(exchange, str(cal_date), int(is_open),
+             str(pretrade_date) if pretrade_date is not None and not pd.isna(pretrade_date) else None, now)
+            for cal_date, is_open, pretrade_date in df[['cal_date', 'is_open', 'pretrade_date']].itertuples(index=False)]
+    with transaction() as conn:
+        conn.executemany(
+            '''INSERT OR REPLACE INTO trade_cal (exchange, cal_date, is_open, pretrade_date, last_updated)
+               VALUES (?, ?, ?, ?, ?)''',
+            rows
+        )
+    return True
+
+@_timed(operation='get_trade_calendar')
+def get_trade_calendar(exchange):
+    """Get the stored calendar of one exchange
+    
+    Returns:
+        tuple: (open_dates, first_date, last_date, last_updated) with the sorted
+        trading days and the range the stored calendar covers, or None if
+        nothing is stored for the exchange
+    """
+    with get_connection() as conn:
+        first_date, last_date, last_updated = conn.execute(
+            'SELECT MIN(cal_date), MAX(cal_date), MAX(last_updated) FROM trade_cal WHERE exchange = ?',
+            (exchange,)
+        ).fetchone()
+        if first_date is None:
+            return None
+        cursor = conn.execute(
+            'SELECT cal_date FROM trade_cal WHERE exchange = ? AND is_open = 1 ORDER BY cal_date',
+            (exchange,)
+        )
+        open_dates = [row[0] for row in cursor.fetchall()]
+    return open_dates, first_date, last_date, datetime.strptime(last_updated, '%Y-%m-%d %H:%M:%S')
+
 def get_stock_code_from_db(stock_name):
     """Get stock code from database by name with fuzzy matching"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Try exact match first
-    cursor.execute('SELECT ts_code FROM stock_basic WHERE name = ?', (stock_name,))
-    result = cursor.fetchone()
-    
-    if result:
-        conn.close()
-        return result[0]
-    
-    # Try fuzzy matching for common variations
-    name_patterns = [
-        f'%{stock_name}%',  # Contains the name
-        f'{stock_name}%',   # Starts with the name
-        f'%{stock_name}',   # Ends with the name
-    ]
-    
-    for pattern in name_patterns:
-        cursor.execute('SELECT ts_code, name FROM stock_basic WHERE name LIKE ? LIMIT 5', (pattern,))
-        results = cursor.fetchall()
+    with get_connection() as conn:
+        cursor = conn.cursor()
         
-        if results:
-            # If multiple matches, try to find the best one
-            for ts_code, db_name in results:
-                # Prefer exact matches without extra words
-                if db_name == stock_name:
-                    conn.close()
-                    return ts_code
-                # Prefer matches that start with the search term
-                if db_name.startswith(stock_name):
-                    print(f"模糊匹配找到: '{stock_name}' -> '{db_name}' ({ts_code})")
-                    conn.close()
-                    return ts_code
+        # Try exact match first
+        cursor.execute('SELECT ts_code FROM stock_basic WHERE name = ?', (stock_name,))
+        result = cursor.fetchone()
+        
+        if result:
+            return result[0]
+        
+        # Try fuzzy matching for common variations
+        name_patterns = [
+            f'%{stock_name}%',  # Contains the name
+            f'{stock_name}%',   # Starts with the name
+            f'%{stock_name}',   # Ends with the name
+        ]
+        
+        for pattern in name_patterns:
+            cursor.execute('SELECT ts_code, name FROM stock_basic WHERE name LIKE ? LIMIT 5', (pattern,))
+            results = cursor.fetchall()
             
-            # If no perfect match, return the first result
-            ts_code, db_name = results[0]
-            print(f"模糊匹配找到: '{stock_name}' -> '{db_name}' ({ts_code})")
-            conn.close()
-            return ts_code
+            if results:
+                # If multiple matches, try to find the best one
+                for ts_code, db_name in results:
+                    # Prefer exact matches without extra words
+                    if db_name == stock_name:
+                        return ts_code
+                    # Prefer matches that start with the search term
+                    if db_name.startswith(stock_name):
+                        logger.debug("模糊匹配找到: '%s' -> '%s' (%s)", stock_name, db_name, ts_code)
+                        return ts_code
+                
+                # If no perfect match, return the first result
+                ts_code, db_name = results[0]
+                logger.debug("模糊匹配找到: '%s' -> '%s' (%s)", stock_name, db_name, ts_code)
+                return ts_code
     
-    conn.close()
     return None
 
-def save_daily_price(df):
-    """Save daily price data to database"""
-    if df is None or df.empty:
-        print("保存股票价格数据失败: 数据为空")
-        return False
+# Columns of the daily_prices table that are written by the bulk upsert
+DAILY_PRICE_COLUMNS = ['ts_code', 'trade_date', 'open', 'high', 'low', 'close',
+                       'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+
+_STAGING_INSERT_SQL = (
+    f"INSERT INTO daily_prices_staging ({', '.join(DAILY_PRICE_COLUMNS)}) "
+    f"VALUES ({', '.join(['?'] * len(DAILY_PRICE_COLUMNS))})"
+)
+
+# daily_prices stores trade_date as an INTEGER; reads return YYYYMMDD strings
+_DAILY_PRICE_SELECT = f"SELECT {', '.join(DAILY_PRICE_COLUMNS)} FROM daily_prices"
+
+def _read_daily_prices(conn, query, params):
+    prices = pd.read_sql(query, conn, params=params)
+    prices['trade_date'] = prices['trade_date'].astype(str)
+    return prices
+
+_UPSERT_FROM_STAGING_SQL = (
+    f"INSERT INTO daily_prices ({', '.join(DAILY_PRICE_COLUMNS)}) "
+    f"SELECT {', '.join(DAILY_PRICE_COLUMNS)} FROM daily_prices_staging WHERE true "
+    "ON CONFLICT(ts_code, trade_date) DO UPDATE SET "
+    + ', '.join(f"{col} = COALESCE(excluded.{col}, daily_prices.{col})"
+                for col in DAILY_PRICE_COLUMNS[2:])
+)
+
+# Columns of stock_metrics returned by get_stock_metrics (matches metrics.METRIC_COLUMNS)
+STOCK_METRIC_COLUMNS = ['latest_date', 'latest_price', 'latest_volume', 'highest_price',
+                        'highest_date', 'max_volume', 'max_increase']
+
+# Per-stock aggregates of the bars in {source} for the codes queued in
+# stock_metrics_codes with the given mode. Ties on the high, volume and pct_chg
+# extremes keep the earliest date.
+_METRICS_AGGREGATE_SQL = '''
+    SELECT ts_code,
+           MAX(CASE WHEN latest_rank = 1 THEN trade_date END) AS latest_date,
+           MAX(CASE WHEN latest_rank = 1 THEN close END) AS latest_price,
+           MAX(CASE WHEN latest_rank = 1 THEN vol END) AS latest_volume,
+           MAX(CASE WHEN high_rank = 1 THEN high END) AS highest_price,
+           MAX(CASE WHEN high_rank = 1 AND high IS NOT NULL THEN trade_date END) AS highest_date,
+           MAX(CASE WHEN vol_rank = 1 THEN vol END) AS max_volume,
+           MAX(CASE WHEN vol_rank = 1 AND vol IS NOT NULL THEN trade_date END) AS max_volume_date,
+           MAX(CASE WHEN increase_rank = 1 THEN pct_chg END) AS max_increase,
+           MAX(CASE WHEN increase_rank = 1 AND pct_chg IS NOT NULL THEN trade_date END) AS max_increase_date
+    FROM (
+        SELECT b.ts_code, b.trade_date, b.close, b.vol, b.high, b.pct_chg,
+               ROW_NUMBER() OVER (PARTITION BY b.ts_code ORDER BY b.trade_date DESC) AS latest_rank,
+               ROW_NUMBER() OVER (PARTITION BY b.ts_code ORDER BY b.high IS NULL, b.high DESC, b.trade_date) AS high_rank,
+               ROW_NUMBER() OVER (PARTITION BY b.ts_code ORDER BY b.vol IS NULL, b.vol DESC, b.trade_date) AS vol_rank,
+               ROW_NUMBER() OVER (PARTITION BY b.ts_code ORDER BY b.pct_chg IS NULL, b.pct_chg DESC, b.trade_date) AS increase_rank
+        FROM {source} b
+        JOIN stock_metrics_codes c ON c.ts_code = b.ts_code AND c.mode = {mode}
+        WHERE b.trade_date >= :window_start
+    )
+    GROUP BY ts_code
+'''
+
+# Metrics refresh modes of the codes queued in stock_metrics_codes
+_METRICS_RECOMPUTE = 0   # Rescan the stock's bars inside the window
+_METRICS_APPEND = 1      # Only new bars were added: fold them into the stored aggregates
+
+def get_metrics_window_start(now=None):
+    """Get the first trade date (YYYYMMDD) of the current stock_metrics window"""
+    now = now or datetime.now()
+    return (now - timedelta(days=METRICS_WINDOW_DAYS)).strftime('%Y%m%d')
+
+def _prepare_metrics_codes(cursor):
+    cursor.execute('''
+    CREATE TEMP TABLE IF NOT EXISTS stock_metrics_codes (
+        ts_code TEXT PRIMARY KEY,
+        mode INTEGER
+    )
+    ''')
+    cursor.execute('DELETE FROM stock_metrics_codes')
+
+def _recompute_stock_metrics(cursor, window_start, now):
+    """Rebuild the metrics rows of the queued recompute codes from daily_prices"""
+    cursor.execute(
+        f'''DELETE FROM stock_metrics WHERE ts_code IN
+               (SELECT ts_code FROM stock_metrics_codes WHERE mode = {_METRICS_RECOMPUTE})'''
+    )
+    cursor.execute(
+        f'''INSERT INTO stock_metrics (ts_code, window_start, latest_date, latest_price, latest_volume,
+                                       highest_price, highest_date, max_volume, max_volume_date,
+                                       max_increase, max_increase_date, last_updated)
+            SELECT ts_code, :window_start, latest_date, latest_price, latest_volume,
+                   highest_price, highest_date, max_volume, max_volume_date,
+                   max_increase, max_increase_date, :now
+            FROM ({_METRICS_AGGREGATE_SQL.format(source='daily_prices', mode=_METRICS_RECOMPUTE)})''',
+        {'window_start': window_start, 'now': now}
+    )
+
+def _classify_staged_metrics(cursor, window_start):
+    """Queue the stocks in daily_prices_staging for _merge_staged_metrics
     
-    print(f"准备保存 {len(df)} 条股票价格记录到数据库...")
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    Must run before the staged bars are upserted: a stock can only be folded
+    into its stored aggregates when none of its staged bars inside the window
+    replaces a stored one (a revised bar may have been one of the extremes).
+    """
+    _prepare_metrics_codes(cursor)
+    cursor.execute(
+        f'''INSERT INTO stock_metrics_codes (ts_code, mode)
+            SELECT s.ts_code,
+                   CASE WHEN m.window_start = :window_start AND NOT s.revised
+                        THEN {_METRICS_APPEND} ELSE {_METRICS_RECOMPUTE} END
+            FROM (SELECT s.ts_code, MAX(p.ts_code IS NOT NULL AND s.trade_date >= :window_start) AS revised
+                  FROM daily_prices_staging s
+                  LEFT JOIN daily_prices p ON p.ts_code = s.ts_code AND p.trade_date = s.trade_date
+                  GROUP BY s.ts_code) s
+            LEFT JOIN stock_metrics m ON m.ts_code = s.ts_code''',
+        {'window_start': window_start}
+    )
+
+def _replaces_extreme(value, date):
+    """SQL condition under which the added extreme replaces the stored one"""
+    return (f'(stock_metrics.{value} IS NULL OR added.{value} > stock_metrics.{value} '
+            f'OR (added.{value} = stock_metrics.{value} AND added.{date} < stock_metrics.{date}))')
+
+def _merge_staged_metrics(cursor, window_start, now):
+    """Fold the bars in daily_prices_staging into stock_metrics
     
-    try:
-        # Convert DataFrame to list of tuples for batch insertion
-        records = df.to_dict('records')
-        new_records = 0
-        updated_records = 0
+    Stocks whose staged bars are all new (daily appends, but also back-filled
+    or out of order date batches) are updated from their stored aggregates and
+    the new bars only. Stocks with revised bars, or whose row belongs to an
+    older window, are recomputed from their bars inside the window.
+    """
+    # Ties on an extreme keep the earlier date, like a rescan of the window does
+    cursor.execute(
+        f'''WITH added AS ({_METRICS_AGGREGATE_SQL.format(source='daily_prices_staging', mode=_METRICS_APPEND)})
+            UPDATE stock_metrics SET
+                latest_date = CASE WHEN added.latest_date > stock_metrics.latest_date
+                                   THEN added.latest_date ELSE stock_metrics.latest_date END,
+                latest_price = CASE WHEN added.latest_date > stock_metrics.latest_date
+                                    THEN added.latest_price ELSE stock_metrics.latest_price END,
+                latest_volume = CASE WHEN added.latest_date > stock_metrics.latest_date
+                                     THEN added.latest_volume ELSE stock_metrics.latest_volume END,
+                highest_date = CASE WHEN {_replaces_extreme('highest_price', 'highest_date')}
+                                    THEN added.highest_date ELSE stock_metrics.highest_date END,
+                highest_price = CASE WHEN {_replaces_extreme('highest_price', 'highest_date')}
+                                     THEN added.highest_price ELSE stock_metrics.highest_price END,
+                max_volume_date = CASE WHEN {_replaces_extreme('max_volume', 'max_volume_date')}
+                                       THEN added.max_volume_date ELSE stock_metrics.max_volume_date END,
+                max_volume = CASE WHEN {_replaces_extreme('max_volume', 'max_volume_date')}
+                                  THEN added.max_volume ELSE stock_metrics.max_volume END,
+                max_increase_date = CASE WHEN {_replaces_extreme('max_increase', 'max_increase_date')}
+                                         THEN added.max_increase_date ELSE stock_metrics.max_increase_date END,
+                max_increase = CASE WHEN {_replaces_extreme('max_increase', 'max_increase_date')}
+                                    THEN added.max_increase ELSE stock_metrics.max_increase END,
+                last_updated = :now
+            FROM added
+            WHERE stock_metrics.ts_code = added.ts_code''',
+        {'window_start': window_start, 'now': now}
+    )
+    
+    _recompute_stock_metrics(cursor, window_start, now)
+    cursor.execute('DELETE FROM stock_metrics_codes')
+
+@_timed(operation='refresh_stock_metrics')
+def refresh_stock_metrics(ts_codes, window_start=None):
+    """Bring the stock_metrics rows of the given codes up to the current window
+    
+    Rows of an older window only need a rescan when one of their extremes
+    (high, max volume, max pct_chg) fell on a bar that has since left the
+    window; otherwise just their window start is moved forward.
+    
+    Returns:
+        int: Number of stocks whose bars were rescanned
+    """
+    if not ts_codes:
+        return 0
+    
+    window_start = window_start or get_metrics_window_start()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    codes_json = json.dumps(list(ts_codes))
+    
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''UPDATE stock_metrics SET window_start = :window_start
+               WHERE ts_code IN (SELECT value FROM json_each(:codes))
+                 AND window_start < :window_start
+                 AND highest_date >= :window_start
+                 AND max_volume_date >= :window_start
+                 AND max_increase_date >= :window_start''',
+            {'window_start': window_start, 'codes': codes_json}
+        )
         
-        for record in records:
-            # Check if this record already exists
-            cursor.execute(
-                'SELECT id FROM daily_prices WHERE ts_code = ? AND trade_date = ?',
-                (record['ts_code'], record['trade_date'])
+        _prepare_metrics_codes(cursor)
+        cursor.execute(
+            f'''INSERT INTO stock_metrics_codes (ts_code, mode)
+                SELECT DISTINCT c.value, {_METRICS_RECOMPUTE} FROM json_each(:codes) c
+                LEFT JOIN stock_metrics m ON m.ts_code = c.value
+                WHERE m.ts_code IS NULL OR m.window_start IS NOT :window_start''',
+            {'window_start': window_start, 'codes': codes_json}
+        )
+        rescanned = cursor.execute('SELECT COUNT(*) FROM stock_metrics_codes').fetchone()[0]
+        if rescanned:
+            _recompute_stock_metrics(cursor, window_start, now)
+        cursor.execute('DELETE FROM stock_metrics_codes')
+    return rescanned
+
+@_timed(operation='get_stock_metrics')
+def get_stock_metrics(ts_codes, window_start=None):
+    """Get the materialized window aggregates of many stocks with one indexed read
+    
+    Rows that are missing or belong to an older window are refreshed first.
+    
+    Returns:
+        DataFrame indexed by ts_code with STOCK_METRIC_COLUMNS (stocks without
+        bars in the window are absent)
+    """
+    empty = pd.DataFrame(columns=STOCK_METRIC_COLUMNS, index=pd.Index([], name='ts_code'))
+    if not ts_codes:
+        return empty
+    
+    window_start = window_start or get_metrics_window_start()
+    try:
+        refresh_stock_metrics(ts_codes, window_start)
+        with get_connection() as conn:
+            metrics = pd.read_sql(
+                f'''SELECT ts_code, {', '.join(STOCK_METRIC_COLUMNS)} FROM stock_metrics
+                    WHERE ts_code IN (SELECT value FROM json_each(?))''',
+                conn, params=[json.dumps(list(ts_codes))]
             )
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Update existing record
-                update_fields = []
-                update_values = []
+        return metrics.set_index('ts_code')
+    except Exception:
+        logger.exception("读取股票指标时发生错误")
+        return empty
+
+def _prepare_daily_price_rows(data):
+    """Combine one or more price DataFrames into deduplicated insert tuples"""
+    if isinstance(data, pd.DataFrame):
+        frames = [data]
+    else:
+        frames = [df for df in data if df is not None and not df.empty]
+    if not frames:
+        return []
+    
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    if df.empty:
+        return []
+    
+    df = df.reindex(columns=DAILY_PRICE_COLUMNS)
+    df['trade_date'] = df['trade_date'].astype(str)
+    df = df.drop_duplicates(subset=['ts_code', 'trade_date'], keep='last')
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+def add_price_write_listener(listener):
+    """Call listener(bars) after every committed upsert into daily_prices
+    
+    bars is a DataFrame with DAILY_PRICE_COLUMNS. Errors of a listener are
+    logged and never fail the write.
+    """
+    if listener not in _price_write_listeners:
+        _price_write_listeners.append(listener)
+
+def _notify_price_write_listeners(rows):
+    if not rows or not _price_write_listeners:
+        return
+    bars = pd.DataFrame(rows, columns=DAILY_PRICE_COLUMNS)
+    for listener in list(_price_write_listeners):
+        try:
+            listener(bars)
+        except Exception as e:
+            logger.warning("价格写入监听器 %s 发生错误: %s", getattr(listener, '__name__', listener), e)
+
+@_timed(operation='upsert_daily_prices')
+def upsert_daily_prices(data, coverage=None, rewind=None):
+    """Bulk upsert daily price bars in a single transaction
+    
+    Rows are loaded into a temporary staging table and merged into daily_prices
+    with one set-based INSERT ... ON CONFLICT statement, so no per-row lookups
+    are needed. The watermarks and stock_metrics rows of all touched stocks are
+    updated in the same transaction.
+    
+    Args:
+        data: A DataFrame (may contain many stocks) or an iterable of DataFrames
+        coverage: Optional dict ts_code -> first date of a fully downloaded range
+        rewind: Optional dict ts_code -> first trade date that is missing (its
+            download or write failed). Applied last, it moves the watermark back
+            to the last stored bar before that date and drops a covered_from
+            that is not before it, so the next refresh fetches the date again
+            even though later bars were stored.
+    
+    Returns:
+        tuple: (inserted_count, updated_count), or None if the write failed
+    """
+    rows = _prepare_daily_price_rows(data)
+    if not rows and not coverage and not rewind:
+        return 0, 0
+    
+    new_records = updated_records = 0
+    try:
+        with transaction() as conn:
+            cursor = conn.cursor()
+            if rows:
+                cursor.execute(f'''
+                CREATE TEMP TABLE IF NOT EXISTS daily_prices_staging (
+                    ts_code TEXT,
+                    trade_date TEXT,
+                    {', '.join(f'{col} REAL' for col in DAILY_PRICE_COLUMNS[2:])}
+                )
+                ''')
+                cursor.execute('DELETE FROM daily_prices_staging')
+                cursor.executemany(_STAGING_INSERT_SQL, rows)
+                
+                # Count the rows that already exist with one join instead of per-row checks
+                cursor.execute('''
+                    SELECT COUNT(*) FROM daily_prices_staging s
+                    JOIN daily_prices p ON p.ts_code = s.ts_code AND p.trade_date = s.trade_date
+                ''')
+                updated_records = cursor.fetchone()[0]
+                new_records = len(rows) - updated_records
+                
+                # Keep the materialized metrics of the touched stocks in step;
+                # whether a stock's bars are new has to be known before the upsert
+                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                window_start = get_metrics_window_start()
+                with instrumentation.METRICS_COMPUTE_SECONDS.time(step='stock_metrics_merge'):
+                    _classify_staged_metrics(cursor, window_start)
                 
-                for key, value in record.items():
-                    if key not in ('ts_code', 'trade_date'):
-                        update_fields.append(f"{key} = ?")
-                        update_values.append(value)
+                cursor.execute(_UPSERT_FROM_STAGING_SQL)
                 
-                # Add the WHERE clause parameters
-                update_values.append(record['ts_code'])
-                update_values.append(record['trade_date'])
+                with instrumentation.METRICS_COMPUTE_SECONDS.time(step='stock_metrics_merge'):
+                    _merge_staged_metrics(cursor, window_start, now)
                 
+                # Advance the watermark of every stock in this batch
                 cursor.execute(
-                    f"UPDATE daily_prices SET {', '.join(update_fields)} WHERE ts_code = ? AND trade_date = ?",
-                    update_values
+                    '''INSERT INTO price_watermarks (ts_code, last_trade_date, last_updated)
+                       SELECT ts_code, MAX(trade_date), ? FROM daily_prices_staging WHERE true GROUP BY ts_code
+                       ON CONFLICT(ts_code) DO UPDATE SET
+                           last_trade_date = MAX(COALESCE(last_trade_date, ''), excluded.last_trade_date),
+                           last_updated = excluded.last_updated''',
+                    (now,)
                 )
-                updated_records += 1
-            else:
-                # Insert new record
-                placeholders = ', '.join(['?'] * len(record))
-                fields = ', '.join(record.keys())
-                cursor.execute(
-                    f"INSERT INTO daily_prices ({fields}) VALUES ({placeholders})",
-                    list(record.values())
+                cursor.execute('DELETE FROM daily_prices_staging')
+            
+            if coverage:
+                cursor.executemany(
+                    'UPDATE price_watermarks SET covered_from = ? WHERE ts_code = ?',
+                    [(covered_from, ts_code) for ts_code, covered_from in coverage.items()]
                 )
-                new_records += 1
+            
+            if rewind:
+                cursor.executemany(
+                    '''UPDATE price_watermarks SET
+                           last_trade_date = (SELECT CAST(MAX(p.trade_date) AS TEXT) FROM daily_prices p
+                                              WHERE p.ts_code = price_watermarks.ts_code AND p.trade_date < :missing),
+                           covered_from = CASE WHEN covered_from < :missing THEN covered_from END
+                       WHERE ts_code = :ts_code''',
+                    [{'ts_code': ts_code, 'missing': str(missing)} for ts_code, missing in rewind.items()]
+                )
+        instrumentation.PRICE_ROWS_WRITTEN.inc(len(rows))
+    except Exception:
+        logger.exception("批量保存股票价格数据时发生错误")
+        return None
     
-        conn.commit()
-        print(f"股票价格数据保存完成: {new_records} 条新记录, {updated_records} 条更新记录")
-        conn.close()
-        return True
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        print(f"保存股票价格数据时发生错误: {e}")
+    _notify_price_write_listeners(rows)
+    return new_records, updated_records
+
+def save_daily_price(df, coverage=None):
+    """Save daily price data to database
+    
+    Accepts a DataFrame with bars of one or many stocks (or a list of DataFrames)
+    and writes them with a single bulk upsert.
+    """
+    if df is None or (isinstance(df, pd.DataFrame) and df.empty):
+        logger.warning("保存股票价格数据失败: 数据为空")
+        return False
+    
+    counts = upsert_daily_prices(df, coverage=coverage)
+    if counts is None:
         return False
+    
+    new_records, updated_records = counts
+    logger.debug("股票价格数据保存完成: %d 条新记录, %d 条更新记录", new_records, updated_records)
+    return True
+
+def _read_cold_prices(conn, ts_codes, start_date=None, end_date=None):
+    """Decode the cold tier bars of some stocks (None: every stock) within a date range"""
+    query = "SELECT ts_code, data FROM daily_prices_cold WHERE true"
+    params = []
+    if ts_codes is not None:
+        query += " AND ts_code IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(ts_codes)))
+    
+    # Only the blobs of the years that overlap the range are decoded
+    if start_date:
+        query += " AND last_date >= ?"
+        params.append(start_date)
+    
+    if end_date:
+        query += " AND first_date <= ?"
+        params.append(end_date)
+    
+    frames = []
+    for ts_code, data in conn.execute(query, params):
+        bars = price_codec.decode_bars(data)
+        if start_date:
+            bars = bars[bars['trade_date'] >= start_date]
+        if end_date:
+            bars = bars[bars['trade_date'] <= end_date]
+        bars.insert(0, 'ts_code', ts_code)
+        frames.append(bars)
+    if not frames:
+        return pd.DataFrame(columns=DAILY_PRICE_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+def _merge_price_tiers(hot, cold):
+    """Combine daily_prices rows with cold tier bars (stored values of daily_prices win)"""
+    if cold.empty:
+        return hot
+    key = ['ts_code', 'trade_date']
+    merged = hot.set_index(key).combine_first(cold.set_index(key)).reset_index()
+    return merged.reindex(columns=hot.columns)
 
+@_timed(operation='get_daily_prices')
 def get_daily_prices(ts_code, start_date=None, end_date=None, limit=None):
-    """Retrieve daily price data for a stock code within date range"""
-    conn = sqlite3.connect(DB_PATH)
+    """Retrieve daily price data for a stock code within date range
     
-    query = "SELECT * FROM daily_prices WHERE ts_code = ?"
+    Reads daily_prices and the compressed cold tier (see compact_cold_history),
+    newest bars first.
+    """
+    query = _DAILY_PRICE_SELECT + " WHERE ts_code = ?"
     params = [ts_code]
     
     if start_date:
@@ -235,87 +1027,372 @@ def get_daily_prices(ts_code, start_date=None, end_date=None, limit=None):
         params.append(int(limit))
     
     try:
-        df = pd.read_sql(query, conn, params=params)
-        conn.close()
-        return df
-    except Exception as e:
-        conn.close()
-        print(f"Error retrieving daily prices: {e}")
+        with get_connection() as conn:
+            hot = _read_daily_prices(conn, query, params)
+            cold_start = start_date
+            if limit and len(hot) >= int(limit):
+                # Only cold bars newer than the oldest returned row can displace one
+                cold_start = max(start_date or '', hot['trade_date'].iloc[-1])
+            cold = _read_cold_prices(conn, [ts_code], cold_start, end_date)
+        if cold.empty:
+            return hot
+        prices = _merge_price_tiers(hot, cold).sort_values('trade_date', ascending=False, ignore_index=True)
+        return prices.head(int(limit)) if limit else prices
+    except Exception:
+        logger.exception("读取日线数据时发生错误")
         return pd.DataFrame()  # Return empty DataFrame instead of None
 
+@_timed(operation='get_daily_prices_window')
+def get_daily_prices_window(ts_codes, start_date=None, end_date=None):
+    """Retrieve the daily prices of many stocks (None: every stock) within a date range in one query
+    
+    Bars of the compressed cold tier in the range are included.
+    """
+    if ts_codes is not None and not ts_codes:
+        return pd.DataFrame()
+    
+    query = _DAILY_PRICE_SELECT + " WHERE true"
+    params = []
+    if ts_codes is not None:
+        query += " AND ts_code IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(ts_codes)))
+    
+    if start_date:
+        query += " AND trade_date >= ?"
+        params.append(start_date)
+    
+    if end_date:
+        query += " AND trade_date <= ?"
+        params.append(end_date)
+    
+    try:
+        with get_connection() as conn:
+            hot = _read_daily_prices(conn, query, params)
+            cold = _read_cold_prices(conn, ts_codes, start_date, end_date)
+        return _merge_price_tiers(hot, cold)
+    except Exception:
+        logger.exception("读取日线数据窗口时发生错误")
+        return pd.DataFrame()
+
+def get_cold_horizon_start(horizon_days=None, now=None):
+    """First trade_date (YYYYMMDD) that stays in daily_prices when compacting"""
+    horizon_days = COLD_HORIZON_DAYS if horizon_days is None else horizon_days
+    return ((now or datetime.now()) - timedelta(days=horizon_days)).strftime('%Y%m%d')
+
+@_timed(operation='compact_cold_history')
+def compact_cold_history(horizon_days=None):
+    """Move the bars older than horizon_days from daily_prices into the cold tier
+    
+    The old bars of every stock are grouped by year, merged with the blob
+    already stored for that year (values in daily_prices win) and written back
+    as one compressed blob (see price_codec), then deleted from daily_prices.
+    Stocks are compacted COMPACTION_BATCH_STOCKS at a time, one transaction each,
+    so readers always see every bar in exactly one of the tiers.
+    
+    Args:
+        horizon_days: Calendar days kept in daily_prices (default: COLD_HORIZON_DAYS)
+    
+    Returns:
+        dict: {'rows': bars moved, 'blobs': blobs written}
+    """
+    horizon_days = COLD_HORIZON_DAYS if horizon_days is None else horizon_days
+    if horizon_days < METRICS_WINDOW_DAYS:
+        # stock_metrics is recomputed from the bars of daily_prices
+        raise ValueError(f"horizon_days must be at least METRICS_WINDOW_DAYS ({METRICS_WINDOW_DAYS})")
+    cutoff = get_cold_horizon_start(horizon_days)
+    
+    with get_connection() as conn:
+        codes = [row[0] for row in conn.execute(
+            'SELECT DISTINCT ts_code FROM daily_prices WHERE trade_date < ?', (cutoff,))]
+    
+    moved = blobs = 0
+    for offset in range(0, len(codes), COMPACTION_BATCH_STOCKS):
+        codes_json = json.dumps(codes[offset:offset + COMPACTION_BATCH_STOCKS])
+        with transaction() as conn:
+            old = _read_daily_prices(
+                conn, _DAILY_PRICE_SELECT + ' WHERE ts_code IN (SELECT value FROM json_each(?)) AND trade_date < ?',
+                [codes_json, cutoff]
+            )
+            if old.empty:
+                continue
+            stored = {(ts_code, year): data for ts_code, year, data in conn.execute(
+                'SELECT ts_code, year, data FROM daily_prices_cold WHERE ts_code IN (SELECT value FROM json_each(?))',
+                (codes_json,)
+            )}
+            
+            rows = []
+            years = old['trade_date'].str[:4].astype(int)
+            for (ts_code, year), bars in old.groupby([old['ts_code'], years], sort=False):
+                bars = bars.drop(columns='ts_code')
+                if (ts_code, year) in stored:
+                    previous = price_codec.decode_bars(stored[(ts_code, year)])
+                    bars = bars.set_index('trade_date').combine_first(previous.set_index('trade_date')).reset_index()
+                bars = bars.sort_values('trade_date')
+                rows.append((ts_code, int(year), bars['trade_date'].iloc[0], bars['trade_date'].iloc[-1],
+                             len(bars), price_codec.encode_bars(bars)))
+            
+            conn.executemany(
+                '''INSERT OR REPLACE INTO daily_prices_cold (ts_code, year, first_date, last_date, row_count, data)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                rows
+            )
+            conn.execute(
+                'DELETE FROM daily_prices WHERE ts_code IN (SELECT value FROM json_each(?)) AND trade_date < ?',
+                (codes_json, cutoff)
+            )
+        moved += len(old)
+        blobs += len(rows)
+    
+    if moved:
+        logger.info("已将 %d 条早于 %s 的日线数据压缩到冷存储 (%d 个数据块)", moved, cutoff, blobs)
+    return {'rows': moved, 'blobs': blobs}
+
+def get_last_price_write_time():
+    """Get the time bars were last written for any stock, or None"""
+    with get_connection() as conn:
+        result = conn.execute('SELECT MAX(last_updated) FROM price_watermarks').fetchone()
+    if result and result[0]:
+        return datetime.strptime(result[0], '%Y-%m-%d %H:%M:%S')
+    return None
+
+@_timed(operation='get_price_watermarks')
+def get_price_watermarks(ts_codes):
+    """Get the fetch watermarks for the given stock codes
+    
+    Returns:
+        dict: ts_code -> {'last_trade_date': str, 'covered_from': str or None}
+        for every code that has a watermark
+    """
+    if not ts_codes:
+        return {}
+    
+    watermarks = {}
+    try:
+        with get_connection() as conn:
+            # Pass the codes as one JSON array so the statement text never changes
+            cursor = conn.execute(
+                '''SELECT ts_code, last_trade_date, covered_from FROM price_watermarks
+                   WHERE ts_code IN (SELECT value FROM json_each(?))''',
+                (json.dumps(list(ts_codes)),)
+            )
+            for ts_code, last_trade_date, covered_from in cursor.fetchall():
+                watermarks[ts_code] = {
+                    'last_trade_date': last_trade_date,
+                    'covered_from': covered_from
+                }
+    except Exception:
+        logger.exception("读取价格水位时发生错误")
+    
+    return watermarks
+
 def save_sector_data(sector, data):
     """Save sector comparison data as JSON"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    data_json = json.dumps(data)
     
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO sector_data (sector, data_json, fetch_time) VALUES (?, ?, ?)',
+            (sector, data_json, now)
+        )
+    return True
+
+@_timed(operation='save_sector_snapshot')
+def save_sector_snapshot(data):
+    """Save the data of all sectors from one refresh as a new snapshot
+    
+    Old snapshots are pruned by the retention policy in the same transaction.
+    
+    Args:
+        data: Dict sector -> list of stock dicts
+        
+    Returns:
+        int: Version of the new snapshot
+    """
+    global _snapshot_cache
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     data_json = json.dumps(data)
     
-    cursor.execute(
-        'INSERT INTO sector_data (sector, data_json, fetch_time) VALUES (?, ?, ?)',
-        (sector, data_json, now)
-    )
+    with transaction() as conn:
+        cursor = conn.execute(
+            'INSERT INTO sector_snapshots (created_at, data_json) VALUES (?, ?)',
+            (now, data_json)
+        )
+        version = cursor.lastrowid
+        prune_sector_snapshots()
     
-    conn.commit()
-    conn.close()
-    return True
+    with _snapshot_cache_lock:
+        _snapshot_cache = (version, now, json.loads(data_json))
+    return version
 
-def get_latest_sector_data(sector, max_age_minutes=30):
-    """Get the latest sector data if it's fresh enough"""
+@_timed(operation='prune_sector_snapshots')
+def prune_sector_snapshots(keep_last=None, max_age_days=None):
+    """Delete snapshots outside the retention policy
+    
+    Keeps the newest keep_last snapshots, minus those older than max_age_days
+    (the latest snapshot is never deleted). Rows of the legacy per-sector
+    sector_data table older than max_age_days are deleted as well.
+    
+    Returns:
+        int: Number of snapshots deleted
+    """
+    keep_last = SNAPSHOT_KEEP_LAST if keep_last is None else keep_last
+    max_age_days = SNAPSHOT_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    cutoff = (datetime.now() - timedelta(days=max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    with transaction() as conn:
+        cursor = conn.execute(
+            '''DELETE FROM sector_snapshots
+               WHERE version < (SELECT MAX(version) FROM sector_snapshots)
+                 AND (version NOT IN (SELECT version FROM sector_snapshots ORDER BY version DESC LIMIT ?)
+                      OR created_at < ?)''',
+            (max(1, keep_last), cutoff)
+        )
+        deleted = cursor.rowcount
+        conn.execute('DELETE FROM sector_data WHERE fetch_time < ?', (cutoff,))
+    return deleted
+
+@_timed(operation='get_latest_sector_snapshot')
+def get_latest_sector_snapshot():
+    """Get the latest snapshot of all sectors with one indexed query
+    
+    The parsed data is cached in memory and only reloaded when a newer version
+    exists, so the returned dict is shared and must not be modified.
+    
+    Returns:
+        tuple: (data, created_at, version), or (None, None, None) if there is no snapshot
+    """
+    global _snapshot_cache
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            row = conn.execute(
+                'SELECT version, created_at FROM sector_snapshots ORDER BY version DESC LIMIT 1'
+            ).fetchone()
+            if row is None:
+                return None, None, None
+            
+            version, created_at = row
+            cached = _snapshot_cache
+            if cached is not None and cached[0] == version:
+                instrumentation.record_cache('sector_snapshot', True)
+                return cached[2], cached[1], cached[0]
+            instrumentation.record_cache('sector_snapshot', False)
+            
+            data_json = conn.execute(
+                'SELECT data_json FROM sector_snapshots WHERE version = ?', (version,)
+            ).fetchone()[0]
         
-        # Calculate the oldest acceptable timestamp
+        data = json.loads(data_json)
+        with _snapshot_cache_lock:
+            if _snapshot_cache is None or _snapshot_cache[0] < version:
+                _snapshot_cache = (version, created_at, data)
+        return data, created_at, version
+    except Exception:
+        logger.exception("读取行业数据快照时发生错误")
+        return None, None, None
+
+@_timed(operation='get_sector_snapshot')
+def get_sector_snapshot(version):
+    """Get the data of one snapshot version, or None if it does not exist (e.g. pruned)"""
+    cached = _snapshot_cache
+    if cached is not None and cached[0] == version:
+        return cached[2]
+    
+    try:
+        with get_connection() as conn:
+            row = conn.execute(
+                'SELECT data_json FROM sector_snapshots WHERE version = ?', (version,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception:
+        logger.exception("读取行业数据快照 %s 时发生错误", version)
+        return None
+
+def get_latest_sector_version():
+    """Get the version of the latest sector snapshot, or None if there is none"""
+    try:
+        with get_connection() as conn:
+            return conn.execute('SELECT MAX(version) FROM sector_snapshots').fetchone()[0]
+    except Exception:
+        logger.exception("读取行业数据快照版本时发生错误")
+        return None
+
+def _log_stale_snapshot(sector, created_at):
+    """Warn once per stale snapshot instead of once per sector read from it"""
+    global _stale_snapshot_warned
+    if _stale_snapshot_warned != created_at:
+        _stale_snapshot_warned = created_at
+        logger.warning("使用过期的行业数据快照 (获取时间: %s)", created_at)
+    else:
+        logger.debug("使用过期的 %s 行业数据 (获取时间: %s)", sector, created_at)
+
+def get_latest_sector_data(sector, max_age_minutes=30):
+    """Get the latest sector data if it's fresh enough
+    
+    Reads the sector from the latest snapshot and falls back to the legacy
+    per-sector sector_data rows for databases without snapshots.
+    """
+    data, created_at, _ = get_latest_sector_snapshot()
+    if data is not None and sector in data:
         oldest_acceptable = (datetime.now() - timedelta(minutes=max_age_minutes)).strftime('%Y-%m-%d %H:%M:%S')
-        
-        # First try to get data newer than the specified age
-        cursor.execute(
-            'SELECT data_json, fetch_time FROM sector_data WHERE sector = ? AND fetch_time > ? ORDER BY fetch_time DESC LIMIT 1',
-            (sector, oldest_acceptable)
-        )
-        
-        result = cursor.fetchone()
-        
-        # If no fresh data, try to get any data for this sector as a fallback
-        if not result:
+        if created_at <= oldest_acceptable:
+            _log_stale_snapshot(sector, created_at)
+        return data[sector], created_at
+    
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Calculate the oldest acceptable timestamp
+            oldest_acceptable = (datetime.now() - timedelta(minutes=max_age_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+            
+            # First try to get data newer than the specified age
             cursor.execute(
-                'SELECT data_json, fetch_time FROM sector_data WHERE sector = ? ORDER BY fetch_time DESC LIMIT 1',
-                (sector,)
+                'SELECT data_json, fetch_time FROM sector_data WHERE sector = ? AND fetch_time > ? ORDER BY fetch_time DESC LIMIT 1',
+                (sector, oldest_acceptable)
             )
+            
             result = cursor.fetchone()
-            # If we found older data, log that we're using it
-            if result:
-                print(f"警告: 使用过期的 {sector} 行业数据 (获取时间: {result[1]})")
-        
-        conn.close()
+            
+            # If no fresh data, try to get any data for this sector as a fallback
+            if not result:
+                cursor.execute(
+                    'SELECT data_json, fetch_time FROM sector_data WHERE sector = ? ORDER BY fetch_time DESC LIMIT 1',
+                    (sector,)
+                )
+                result = cursor.fetchone()
+                # If we found older data, log that we're using it
+                if result:
+                    logger.warning("使用过期的 %s 行业数据 (获取时间: %s)", sector, result[1])
         
         if result:
             try:
                 return json.loads(result[0]), result[1]
             except json.JSONDecodeError:
-                print(f"Error decoding JSON for sector {sector}")
+                logger.warning("%s 行业数据的 JSON 无法解析", sector)
                 return [], result[1]
         return None, None
-    except Exception as e:
-        print(f"Error retrieving sector data: {e}")
+    except Exception:
+        logger.exception("读取行业数据时发生错误")
         return None, None
 
 def is_data_fresh(ts_code, days=1):
-    """Check if we have fresh data for a stock"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    """Check if we have fresh data for a stock
     
-    # Calculate the oldest acceptable timestamp
-    oldest_acceptable = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    The data is fresh if it has a bar within the last `days` trading days of
+    the stock's exchange, so weekends and holidays do not make it stale.
+    """
+    import trade_calendar
     
-    cursor.execute(
-        'SELECT COUNT(*) FROM daily_prices WHERE ts_code = ? AND trade_date >= ?',
-        (ts_code, oldest_acceptable.replace('-', ''))
-    )
+    # The oldest trading day that still counts as fresh
+    oldest_acceptable = trade_calendar.get_oldest_fresh_trade_date(ts_code, days)
     
-    count = cursor.fetchone()[0]
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.execute(
+            'SELECT COUNT(*) FROM daily_prices WHERE ts_code = ? AND trade_date >= ?',
+            (ts_code, oldest_acceptable)
+        )
+        count = cursor.fetchone()[0]
     
     return count > 0
 
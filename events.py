@@ -0,0 +1,210 @@
+"""
+In-process publish/subscribe of refresh progress and data version events
+"""
+import json
+import queue
+import threading
+import time
+
+import instrumentation
+
+# Maximum number of undelivered events buffered per subscriber (oldest dropped beyond this)
+SUBSCRIBER_QUEUE_SIZE = 256
+
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT_SECONDS = 15
+
+# Minimum seconds between two progress events of one reporter (stage changes are always sent)
+PROGRESS_MIN_INTERVAL = 0.5
+
+class EventBus:
+    """Fan out events to any number of subscriber queues
+    
+    The last event of every type is kept, so a new subscriber (e.g. a page
+    that just opened its event stream) immediately learns the current state.
+    Publishing never blocks: a subscriber that falls behind loses its oldest
+    events instead.
+    """
+    
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._last_events = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+    
+    def publish(self, event_type, data):
+        """Publish an event to every subscriber and return it"""
+        with self._lock:
+            event = {'id': self._next_id, 'type': event_type, 'data': data, 'time': time.time()}
+            self._next_id += 1
+            self._last_events[event_type] = event
+            subscribers = list(self._subscribers)
+        
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+        return event
+    
+    def subscribe(self):
+        """Register a new subscriber queue, pre-filled with the last event of every type"""
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            for event in sorted(self._last_events.values(), key=lambda event: event['id']):
+                subscriber.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+    
+    def unsubscribe(self, subscriber):
+        """Stop delivering events to a subscriber queue"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+    
+    def get_last_event(self, event_type):
+        """Get the most recent event of a type, or None"""
+        with self._lock:
+            return self._last_events.get(event_type)
+
+bus = EventBus()
+
+def publish(event_type, data):
+    """Publish an event on the shared bus"""
+    return bus.publish(event_type, data)
+
+def subscribe():
+    """Subscribe to the shared bus"""
+    return bus.subscribe()
+
+def unsubscribe(subscriber):
+    """Remove a subscriber from the shared bus"""
+    bus.unsubscribe(subscriber)
+
+def get_last_event(event_type):
+    """Get the most recent event of a type on the shared bus"""
+    return bus.get_last_event(event_type)
+
+def format_sse(event):
+    """Encode an event in the Server-Sent Events wire format"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+def stream_events(subscriber, heartbeat_seconds=HEARTBEAT_SECONDS):
+    """Yield SSE messages from a subscriber queue, with keep-alive comments while idle"""
+    while True:
+        try:
+            event = subscriber.get(timeout=heartbeat_seconds)
+        except queue.Empty:
+            yield ': keep-alive\n\n'
+            continue
+        yield format_sse(event)
+
+class Cancelled(Exception):
+    """Raised inside a job once its cancellation has been requested"""
+
+class ProgressReporter:
+    """Thread-safe counters of a running job, published as 'progress' events
+    
+    Counters (e.g. resolved, fetched, written_rows, sectors) are advanced by
+    the worker threads; events are throttled to one per PROGRESS_MIN_INTERVAL.
+    The ETA is extrapolated from the 'calls' counter, i.e. the Tushare calls
+    done so far against the calls planned. The reporter also carries the
+    job's cancellation flag to the code doing the work. The duration of every
+    stage is recorded in instrumentation.REFRESH_STAGE_SECONDS.
+    """
+    
+    def __init__(self, job='refresh', enabled=True, min_interval=PROGRESS_MIN_INTERVAL,
+                 cancel_event=None):
+        self.job = job
+        self.enabled = enabled
+        self.cancel_event = cancel_event
+        self.min_interval = min_interval
+        self.stage_name = 'starting'
+        self.counters = {}
+        self.totals = {}
+        self.extra = {}
+        self.started_at = time.monotonic()
+        self._stage_started_at = self.started_at
+        self._calls_started_at = None
+        self._last_published = 0.0
+        self._lock = threading.Lock()
+    
+    def is_cancelled(self):
+        """Check whether the job has been asked to stop"""
+        return self.cancel_event is not None and self.cancel_event.is_set()
+    
+    def raise_if_cancelled(self):
+        """Raise Cancelled if the job has been asked to stop"""
+        if self.is_cancelled():
+            raise Cancelled(self.job)
+    
+    def stage(self, name, **totals):
+        """Enter a new stage, optionally setting counter totals"""
+        with self._lock:
+            self._end_stage()
+            self.stage_name = name
+            self.totals.update(totals)
+        self._publish(force=True)
+    
+    def add_total(self, counter, amount):
+        """Add to the planned total of a counter"""
+        with self._lock:
+            self.totals[counter] = self.totals.get(counter, 0) + amount
+        self._publish()
+    
+    def advance(self, counter, amount=1):
+        """Add completed work to a counter"""
+        with self._lock:
+            if counter == 'calls' and self._calls_started_at is None:
+                self._calls_started_at = time.monotonic()
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+        self._publish()
+    
+    def finish(self, stage='done', **extra):
+        """Publish the final state of the job"""
+        with self._lock:
+            self._end_stage()
+            self.stage_name = stage
+            self.extra.update(extra)
+        self._publish(force=True)
+    
+    def _end_stage(self):
+        # Called with the lock held
+        now = time.monotonic()
+        instrumentation.REFRESH_STAGE_SECONDS.observe(now - self._stage_started_at, stage=self.stage_name)
+        self._stage_started_at = now
+    
+    def snapshot(self):
+        """Get the current progress as a JSON friendly dict"""
+        with self._lock:
+            now = time.monotonic()
+            eta = None
+            calls_done = self.counters.get('calls', 0)
+            calls_total = self.totals.get('calls', 0)
+            if self._calls_started_at is not None and calls_done and calls_total > calls_done:
+                eta = (now - self._calls_started_at) / calls_done * (calls_total - calls_done)
+            elif calls_total and calls_done >= calls_total:
+                eta = 0.0
+            return dict(self.extra, **{
+                'job': self.job,
+                'stage': self.stage_name,
+                'counters': dict(self.counters),
+                'totals': dict(self.totals),
+                'elapsed_seconds': round(now - self.started_at, 2),
+                'eta_seconds': None if eta is None else round(eta, 1)
+            })
+    
+    def _publish(self, force=False):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_published < self.min_interval:
+                return
+            self._last_published = now
+        publish('progress', self.snapshot())
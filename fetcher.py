@@ -0,0 +1,133 @@
+"""
+Concurrent Tushare fetching with per-endpoint rate limiting
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Per-minute call quotas of the Tushare endpoints (adjust to your account's points level)
+ENDPOINT_QUOTAS = {
+    'daily': 500,
+    'hk_daily': 200,
+    'stock_basic': 100,
+    'hk_basic': 100,
+}
+
+# Quota used for endpoints that are not listed above
+DEFAULT_QUOTA_PER_MINUTE = 100
+
+# Default number of concurrent fetch threads
+DEFAULT_WORKERS = 8
+
+# Retry settings for calls rejected by Tushare's rate limiter
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+
+# Fragments of the error messages Tushare returns when a quota is exceeded
+RATE_LIMIT_MARKERS = ('每分钟最多访问', '最多访问该接口', '访问频率', 'rate limit', 'too many requests')
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at a per-minute rate"""
+    
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        # A small burst allowance keeps a fresh bucket from firing a whole minute's quota at once
+        self.capacity = capacity or max(1, min(rate_per_minute, 10))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(endpoint):
+    """Get the shared token bucket of an endpoint"""
+    with _buckets_lock:
+        bucket = _buckets.get(endpoint)
+        if bucket is None:
+            bucket = TokenBucket(ENDPOINT_QUOTAS.get(endpoint, DEFAULT_QUOTA_PER_MINUTE))
+            _buckets[endpoint] = bucket
+        return bucket
+
+def is_rate_limit_error(error):
+    """Check whether an exception is Tushare rejecting a call for exceeding the quota"""
+    message = str(error).lower()
+    return any(marker.lower() in message for marker in RATE_LIMIT_MARKERS)
+
+def call_api(api, endpoint, **kwargs):
+    """Call a Tushare endpoint through its rate limiter
+    
+    Calls rejected because the quota was exceeded are retried with exponential
+    backoff and full jitter; any other error is raised immediately. The latency
+    and outcome of every attempt are recorded in instrumentation.
+    
+    Args:
+        api: Tushare pro API object
+        endpoint: Endpoint name, e.g. 'daily' or 'hk_daily'
+        **kwargs: Parameters passed to the endpoint
+    """
+    bucket = get_bucket(endpoint)
+    
+    for attempt in range(MAX_RETRIES + 1):
+        bucket.acquire()
+        start = time.perf_counter()
+        try:
+            result = getattr(api, endpoint)(**kwargs)
+        except Exception as e:
+            rate_limited = is_rate_limit_error(e)
+            instrumentation.TUSHARE_CALL_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+            instrumentation.TUSHARE_CALLS.inc(endpoint=endpoint, outcome='rate_limited' if rate_limited else 'error')
+            if not rate_limited or attempt == MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            logger.warning("接口 %s 触发频率限制，%.1f 秒后重试 (%d/%d)", endpoint, delay, attempt + 1, MAX_RETRIES)
+            time.sleep(delay)
+        else:
+            instrumentation.TUSHARE_CALL_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+            instrumentation.TUSHARE_CALLS.inc(endpoint=endpoint, outcome='ok')
+            return result
+
+def fetch_many(func, items, max_workers=None):
+    """Run func(item) for every item on a thread pool
+    
+    Returns:
+        dict: item -> return value of func(item); items whose call raised map to False
+    """
+    items = list(items)
+    if not items:
+        return {}
+    
+    results = {}
+    workers = max(1, min(max_workers or DEFAULT_WORKERS, len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                logger.warning("处理 %s 时发生错误: %s", item, e)
+                results[item] = False
+    
+    # Keep the input order
+    return {item: results[item] for item in items}
@@ -46,28 +46,49 @@ def format_hk_volume(volume):
     # This function can be extended based on actual data format
     return volume
 
-def get_hk_market_status():
-    """Get Hong Kong market trading status"""
+# Hong Kong continuous trading sessions (morning, afternoon), local time
+HK_MARKET_SESSIONS = (((9, 30), (12, 0)), ((13, 0), (16, 0)))
+
+def get_hk_market_status(now=None):
+    """Get Hong Kong market trading status
+    
+    Args:
+        now: Optional aware datetime to evaluate instead of the current time
+    
+    Returns:
+        dict: is_open is only True inside a trading session (the 12:00-13:00
+        lunch break is closed); is_after_close is True once the afternoon
+        session of a trading day has ended, close_time is that day's close
+    """
     from datetime import datetime
     import pytz
     
     try:
         # Hong Kong timezone
         hk_tz = pytz.timezone('Asia/Hong_Kong')
-        now_hk = datetime.now(hk_tz)
+        now_hk = now.astimezone(hk_tz) if now is not None else datetime.now(hk_tz)
         
-        # Basic market hours (can be enhanced)
-        market_open = now_hk.replace(hour=9, minute=30, second=0, microsecond=0)
-        market_close = now_hk.replace(hour=16, minute=0, second=0, microsecond=0)
+        # Session boundaries of the day
+        sessions = [(now_hk.replace(hour=start[0], minute=start[1], second=0, microsecond=0),
+                     now_hk.replace(hour=end[0], minute=end[1], second=0, microsecond=0))
+                    for start, end in HK_MARKET_SESSIONS]
+        market_open = sessions[0][0]
+        market_close = sessions[-1][1]
         
         is_trading_day = now_hk.weekday() < 5  # Monday = 0, Friday = 4
-        is_trading_hours = market_open <= now_hk <= market_close
+        is_trading_hours = any(start <= now_hk <= end for start, end in sessions)
+        is_lunch_break = sessions[0][1] < now_hk < sessions[1][0]
         
         return {
             'is_open': is_trading_day and is_trading_hours,
             'local_time': now_hk.strftime('%Y-%m-%d %H:%M:%S %Z'),
             'is_trading_day': is_trading_day,
-            'is_trading_hours': is_trading_hours
+            'is_trading_hours': is_trading_hours,
+            'is_lunch_break': is_trading_day and is_lunch_break,
+            'is_after_close': is_trading_day and now_hk > market_close,
+            'trade_date': now_hk.strftime('%Y%m%d'),
+            'open_time': market_open,
+            'close_time': market_close
         }
     except Exception as e:
         print(f"Error getting HK market status: {e}")
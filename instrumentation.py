@@ -0,0 +1,176 @@
+"""
+Lightweight counters and histograms exposed in the Prometheus text format
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets in seconds (1 ms to 1 minute)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefix of every exported metric name
+METRIC_PREFIX = 'stockapp_'
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """Common parts of a metric family: name, help text, labels and a lock"""
+    
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            children = sorted(self._children.items())
+            lines.extend(self._render_child(key, child) for key, child in children)
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    """Monotonic counter, optionally split by labels (name it with a _total suffix)"""
+    
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._children[key] = self._children.get(key, 0) + amount
+    
+    def value(self, **labels):
+        with self._lock:
+            return self._children.get(self._key(labels), 0)
+    
+    def _render_child(self, key, value):
+        return f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+
+class Histogram(_Metric):
+    """Histogram of observed values (e.g. durations in seconds), optionally split by labels"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                child = self._children[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            child[0][index] += 1
+            child[1] += value
+            child[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def timed(self, **labels):
+        """Decorator observing the duration of every call of a function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    def summary(self, **labels):
+        """Get (count, sum) of the observations with the given labels"""
+        with self._lock:
+            child = self._children.get(self._key(labels))
+            return (child[2], child[1]) if child else (0, 0.0)
+    
+    def _render_child(self, key, child):
+        counts, total, count = child
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return '\n'.join(lines)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def counter(name, documentation, labelnames=()):
+    """Create and register a counter"""
+    metric = Counter(name, documentation, labelnames)
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Create and register a histogram"""
+    metric = Histogram(name, documentation, labelnames, buckets)
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+def render():
+    """Render every registered metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# Metrics shared by the modules of the application
+
+TUSHARE_CALL_SECONDS = histogram('tushare_call_seconds', 'Latency of Tushare API calls', ['endpoint'])
+TUSHARE_CALLS = counter('tushare_calls_total', 'Tushare API calls by outcome (ok, error, rate_limited)',
+                        ['endpoint', 'outcome'])
+
+PRICE_ROWS_WRITTEN = counter('price_rows_written_total', 'Daily price rows inserted or updated')
+DB_OPERATION_SECONDS = histogram('db_operation_seconds', 'Duration of database operations', ['operation'])
+
+METRICS_COMPUTE_SECONDS = histogram('metrics_compute_seconds', 'Duration of stock and sector metric computations',
+                                    ['step'])
+
+CACHE_REQUESTS = counter('cache_requests_total', 'Cache lookups by cache and result (hit, miss)', ['cache', 'result'])
+
+REFRESH_STAGE_SECONDS = histogram('refresh_stage_seconds', 'Duration of the stages of a data refresh',
+                                  ['stage'], buckets=DEFAULT_BUCKETS + (120.0, 300.0, 600.0, 1800.0))
+
+HTTP_REQUEST_SECONDS = histogram('http_request_seconds', 'Latency of HTTP requests per route',
+                                 ['route', 'method', 'status'])
+
+def record_cache(cache, hit):
+    """Count a hit or miss of a named cache"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
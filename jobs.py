@@ -0,0 +1,216 @@
+"""
+Single-flight refresh jobs with coalescing and cancellation
+"""
+import itertools
+import threading
+from datetime import datetime
+
+import events
+
+# Number of finished jobs kept for status lookups
+JOB_HISTORY_SIZE = 20
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+class Job:
+    """One refresh run, shared by every request that was merged into it"""
+    
+    def __init__(self, job_id, targets=None):
+        """
+        Args:
+            job_id: Unique job id
+            targets: Set of refresh targets, or None for everything
+        """
+        self.id = job_id
+        self.targets = None if targets is None else set(targets)
+        self.status = PENDING
+        self.requests = 1              # Number of submissions merged into this job
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.progress = events.ProgressReporter(job=job_id, cancel_event=self.cancel_event)
+        self._done = threading.Event()
+    
+    def covers(self, targets):
+        """Check whether this job already refreshes everything in targets"""
+        if self.targets is None:
+            return True
+        return targets is not None and set(targets) <= self.targets
+    
+    def merge(self, targets):
+        """Widen the job to also refresh targets"""
+        if self.targets is None or targets is None:
+            self.targets = None
+        else:
+            self.targets.update(targets)
+        self.requests += 1
+    
+    @property
+    def finished(self):
+        return self._done.is_set()
+    
+    def wait(self, timeout=None):
+        """Block until the job has finished, returning True if it did"""
+        return self._done.wait(timeout)
+    
+    def to_dict(self):
+        """JSON friendly description of the job"""
+        def format_time(value):
+            return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+        
+        return {
+            'id': self.id,
+            'status': self.status,
+            'targets': None if self.targets is None else sorted(self.targets),
+            'requests': self.requests,
+            'created_at': format_time(self.created_at),
+            'started_at': format_time(self.started_at),
+            'finished_at': format_time(self.finished_at),
+            'result': self.result,
+            'error': self.error,
+            'progress': self.progress.snapshot()
+        }
+
+class JobManager:
+    """Run at most one refresh at a time and coalesce overlapping requests
+    
+    A submission that the running job already covers joins it. Anything else
+    is merged into a single pending job that starts when the running one
+    finishes, so any number of clicks cost at most one extra refresh.
+    """
+    
+    def __init__(self, runner, name='refresh'):
+        """
+        Args:
+            runner: Callable(job) doing the work; a falsy return value marks
+                the job as failed. It should stop early once job.cancel_event
+                is set.
+            name: Prefix of the job ids
+        """
+        self.runner = runner
+        self.name = name
+        self.running = None
+        self.pending = None
+        self._jobs = {}
+        self._history = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+    
+    def submit(self, targets=None):
+        """Request a refresh of targets (None for everything)
+        
+        Returns:
+            tuple: (job, created) where created is False if the request was
+            merged into an existing job
+        """
+        with self._lock:
+            if self.running is not None and self.running.covers(targets):
+                self.running.requests += 1
+                return self.running, False
+            
+            if self.pending is not None:
+                self.pending.merge(targets)
+                return self.pending, False
+            
+            job = Job(f'{self.name}-{next(self._ids)}', targets)
+            self._jobs[job.id] = job
+            if self.running is None:
+                self._start(job)
+            else:
+                self.pending = job
+        
+        self._publish(job)
+        return job, True
+    
+    def get(self, job_id):
+        """Get a job by id, or None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def list_jobs(self):
+        """Get the running, pending and recently finished jobs, newest first"""
+        with self._lock:
+            jobs = list(self._history)
+            if self.running is not None:
+                jobs.append(self.running)
+            if self.pending is not None:
+                jobs.append(self.pending)
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+    
+    def cancel(self, job_id):
+        """Cancel a pending or running job
+        
+        Returns:
+            Job: The job, or None if there is no unfinished job with that id
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return None
+            
+            job.cancel_event.set()
+            if job is self.pending:
+                # Never started, finish it right away
+                self.pending = None
+                self._finish(job, CANCELLED)
+        
+        self._publish(job)
+        return job
+    
+    def is_busy(self):
+        """Check whether a job is running or waiting to run"""
+        with self._lock:
+            return self.running is not None or self.pending is not None
+    
+    def _start(self, job):
+        # Called with the lock held
+        self.running = job
+        thread = threading.Thread(target=self._run, args=(job,), name=f'{self.name}-worker')
+        thread.daemon = True
+        thread.start()
+    
+    def _run(self, job):
+        while job is not None:
+            job.status = RUNNING
+            job.started_at = datetime.now()
+            self._publish(job)
+            
+            status = FAILED
+            try:
+                job.result = self.runner(job)
+                if job.cancel_event.is_set():
+                    status = CANCELLED
+                elif job.result:
+                    status = SUCCEEDED
+            except Exception as e:
+                job.error = str(e)
+                status = CANCELLED if job.cancel_event.is_set() else FAILED
+                print(f"任务 {job.id} 执行失败: {e}")
+            
+            finished = job
+            with self._lock:
+                self._finish(finished, status)
+                # Run the coalesced pending job next on this thread
+                job, self.pending = self.pending, None
+                self.running = job
+            self._publish(finished)
+    
+    def _finish(self, job, status):
+        # Called with the lock held
+        job.status = status
+        job.finished_at = datetime.now()
+        job._done.set()
+        self._history.append(job)
+        while len(self._history) > JOB_HISTORY_SIZE:
+            self._jobs.pop(self._history.pop(0).id, None)
+    
+    def _publish(self, job):
+        events.publish('job', job.to_dict())
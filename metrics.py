@@ -0,0 +1,161 @@
+"""
+Vectorized per-stock metrics for the sector comparison view
+"""
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+# Columns of the per-stock aggregate frame produced by compute_stock_metrics
+METRIC_COLUMNS = ['latest_date', 'latest_price', 'latest_volume', 'highest_price',
+                  'highest_date', 'max_volume', 'max_increase']
+
+@instrumentation.METRICS_COMPUTE_SECONDS.timed(step='compute_stock_metrics')
+def compute_stock_metrics(prices):
+    """Compute the window aggregates of every stock in one groupby pass
+    
+    Args:
+        prices: DataFrame of daily bars for any number of stocks
+            (ts_code, trade_date, high, close, vol, pct_chg)
+    
+    Returns:
+        DataFrame indexed by ts_code with METRIC_COLUMNS. highest_date is the
+        earliest date on which the window high was reached.
+    """
+    if prices is None or prices.empty:
+        return pd.DataFrame(columns=METRIC_COLUMNS, index=pd.Index([], name='ts_code'))
+    
+    df = prices[['ts_code', 'trade_date', 'high', 'close', 'vol', 'pct_chg']].copy()
+    df['trade_date'] = df['trade_date'].astype(str)
+    for column in ('high', 'close', 'vol', 'pct_chg'):
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    df = df.sort_values(['ts_code', 'trade_date'], kind='mergesort').reset_index(drop=True)
+    
+    # Latest bar of every stock
+    latest = df.drop_duplicates('ts_code', keep='last').set_index('ts_code')
+    
+    # Highest high; idxmax returns the first (earliest) row in date order
+    with_high = df.dropna(subset=['high'])
+    high_rows = with_high.loc[with_high.groupby('ts_code', sort=False)['high'].idxmax()].set_index('ts_code')
+    
+    aggregates = df.groupby('ts_code', sort=False).agg(max_volume=('vol', 'max'),
+                                                       max_increase=('pct_chg', 'max'))
+    
+    result = pd.DataFrame({
+        'latest_date': latest['trade_date'],
+        'latest_price': latest['close'],
+        'latest_volume': latest['vol'],
+    })
+    result['highest_price'] = high_rows['high']
+    result['highest_date'] = high_rows['trade_date']
+    result = result.join(aggregates)
+    result.index.name = 'ts_code'
+    return result[METRIC_COLUMNS]
+
+@instrumentation.METRICS_COMPUTE_SECONDS.timed(step='compute_cube_metrics')
+def compute_cube_metrics(cube, ts_codes, start_date, end_date=None):
+    """Compute the same aggregates as compute_stock_metrics from a price_cube.PriceCube
+    
+    Every stock of the window is reduced at once with column operations on
+    the [trade_date x stock] arrays. The latest bar of a stock is its last day
+    with a close. The cube stores prices as float32, so values are rounded to
+    4 decimals; volumes are float64 and exact.
+    
+    Returns:
+        DataFrame indexed by ts_code with METRIC_COLUMNS (stocks without bars
+        in the window are left out)
+    """
+    dates, codes, arrays = cube.window(start_date, end_date, ts_codes, ('high', 'close', 'vol', 'pct_chg'))
+    close = arrays['close']
+    if not dates or not codes:
+        return pd.DataFrame(columns=METRIC_COLUMNS, index=pd.Index([], name='ts_code'))
+    
+    dates = np.array(dates)
+    columns = np.arange(len(codes))
+    has_close = ~np.isnan(close)
+    present = has_close.any(axis=0)
+    latest_rows = len(dates) - 1 - np.argmax(has_close[::-1], axis=0)
+    
+    high = arrays['high']
+    has_high = ~np.isnan(high).all(axis=0)
+    # argmax returns the first (earliest) row of the window high
+    high_rows = np.argmax(np.where(np.isnan(high), -np.inf, high), axis=0)
+    
+    with warnings.catch_warnings():
+        # All-NaN columns (no volume or no pct_chg in the window) give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        max_volume = np.nanmax(arrays['vol'], axis=0)
+        max_increase = np.nanmax(arrays['pct_chg'], axis=0)
+    
+    def rounded(values):
+        return np.round(values.astype(np.float64), 4)
+    
+    result = pd.DataFrame({
+        'latest_date': dates[latest_rows],
+        'latest_price': rounded(close[latest_rows, columns]),
+        'latest_volume': rounded(arrays['vol'][latest_rows, columns]),
+        'highest_price': np.where(has_high, rounded(high[high_rows, columns]), np.nan),
+        'highest_date': np.where(has_high, dates[high_rows], None),
+        'max_volume': rounded(max_volume),
+        'max_increase': rounded(max_increase)
+    }, index=pd.Index(codes, name='ts_code'))
+    return result[present][METRIC_COLUMNS]
+
+def _to_float(value):
+    """Convert a numpy scalar to a JSON friendly float (None for NaN)"""
+    if value is None or pd.isna(value):
+        return None
+    return float(value)
+
+@instrumentation.METRICS_COMPUTE_SECONDS.timed(step='build_stock_records')
+def build_stock_records(metrics_frame, now=None):
+    """Derive the display fields of every stock from its aggregates
+    
+    Drop percentage, volume ratio and the formatted highest date are computed
+    as column operations over the whole frame.
+    
+    Returns:
+        dict: ts_code -> record dict with the fields of a sector table row
+            (without name and sector_score)
+    """
+    if metrics_frame is None or metrics_frame.empty:
+        return {}
+    
+    now = now or datetime.now()
+    frame = metrics_frame.copy()
+    
+    latest_price = frame['latest_price'].astype(float)
+    highest_price = frame['highest_price'].astype(float)
+    latest_volume = frame['latest_volume'].astype(float)
+    max_volume = frame['max_volume'].astype(float)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['drop_percentage'] = np.where(highest_price != 0,
+                                            (latest_price - highest_price) / highest_price * 100,
+                                            np.nan)
+        frame['volume_ratio'] = np.where(max_volume > 0, latest_volume / max_volume * 100, 0.0)
+    
+    # Convert date format for display, replacing future or invalid dates with today
+    today = now.strftime('%Y-%m-%d')
+    highest_dates = pd.to_datetime(frame['highest_date'].astype(str), format='%Y%m%d', errors='coerce')
+    formatted = highest_dates.dt.strftime('%Y-%m-%d')
+    formatted[highest_dates.isna() | (highest_dates > now)] = today
+    frame['highest_date_display'] = formatted
+    
+    records = {}
+    for row in frame.itertuples():
+        records[row.Index] = {
+            'code': row.Index,
+            'latest_price': _to_float(row.latest_price),
+            'highest_price': _to_float(row.highest_price),
+            'highest_date': row.highest_date_display,
+            'max_4m_increase': _to_float(row.max_increase),
+            'drop_percentage': _to_float(row.drop_percentage),
+            'latest_volume': _to_float(row.latest_volume),
+            'max_volume': _to_float(row.max_volume),
+            'volume_ratio': _to_float(row.volume_ratio)
+        }
+    return records
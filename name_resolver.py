@@ -0,0 +1,198 @@
+"""
+In-memory stock name -> code resolver built from the stock_basic table
+"""
+import logging
+import threading
+import unicodedata
+
+import db
+import instrumentation
+from hk_stock_utils import get_hk_stock_name_variations
+from sector import HK_STOCK_NAME_MAPPING
+
+# Invisible characters that sneak into copied names (e.g. the 创新药 sector list)
+ZERO_WIDTH_CHARS = '\u200b\u200c\u200d\u2060\ufeff'
+
+# Share class suffixes that are dropped when comparing names (longest first)
+NAME_SUFFIXES = ('-SW', '-WD', '-W', '-S')
+
+_ZERO_WIDTH_TABLE = {ord(char): None for char in ZERO_WIDTH_CHARS}
+
+logger = logging.getLogger(__name__)
+
+def strip_invisible(name):
+    """Remove zero-width characters and surrounding whitespace from a name"""
+    if not name:
+        return ''
+    return name.translate(_ZERO_WIDTH_TABLE).strip()
+
+def normalize_name(name):
+    """Normalize a stock name for matching
+    
+    Drops zero-width characters, folds full-width characters and case, removes
+    spaces and strips share class suffixes such as -W and -SW.
+    """
+    name = unicodedata.normalize('NFKC', strip_invisible(name)).upper()
+    name = ''.join(name.split())
+    for suffix in NAME_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name
+
+def get_name_variations(stock_name):
+    """Get the name variations tried when a name has no direct match, in priority order"""
+    variations = [
+        stock_name,
+        stock_name.replace('集团', ''),
+        stock_name.replace('股份', ''),
+        stock_name.replace('有限公司', ''),
+        stock_name.replace('公司', ''),
+        stock_name + '集团',
+        stock_name + '股份'
+    ]
+    # Hong Kong style variations (English suffixes, 控股/集团 ...) come last
+    variations.extend(sorted(get_hk_stock_name_variations(stock_name)))
+    
+    ordered = []
+    for variation in variations:
+        if variation and variation not in ordered:
+            ordered.append(variation)
+    return ordered
+
+def _ngrams(text):
+    """Character bigrams of a string (the string itself if shorter)"""
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i+2] for i in range(len(text) - 1)}
+
+class StockNameResolver:
+    """Hash and bigram indexes over the stock names in stock_basic
+    
+    Exact names resolve with one dict lookup; substring matches intersect the
+    bigram posting lists and only verify the few remaining candidates, instead
+    of running LIKE '%name%' scans over the whole table.
+    """
+    
+    def __init__(self, rows, name_mapping=None, version=None):
+        """
+        Args:
+            rows: Iterable of (ts_code, name) tuples
+            name_mapping: Optional dict alias -> official name (e.g. HK_STOCK_NAME_MAPPING)
+            version: stock_basic version the index was built from
+        """
+        self.version = version
+        self.names = []          # Entry id -> official name
+        self.codes = []          # Entry id -> ts_code
+        self.normalized = []     # Entry id -> normalized name
+        self.exact = {}          # Official name -> ts_code
+        self.normalized_exact = {}
+        self.ngram_index = {}    # Bigram of a normalized name -> set of entry ids
+        
+        for ts_code, name in rows:
+            if not ts_code or not name:
+                continue
+            entry_id = len(self.names)
+            normalized = normalize_name(name)
+            self.names.append(name)
+            self.codes.append(ts_code)
+            self.normalized.append(normalized)
+            self.exact.setdefault(name, ts_code)
+            self.normalized_exact.setdefault(normalized, ts_code)
+            for gram in _ngrams(normalized):
+                self.ngram_index.setdefault(gram, set()).add(entry_id)
+        
+        # Aliases resolve to the code of their official name
+        for alias, official_name in (name_mapping or {}).items():
+            ts_code = self.exact.get(official_name) or self.normalized_exact.get(normalize_name(official_name))
+            if ts_code:
+                self.exact.setdefault(alias, ts_code)
+                self.normalized_exact.setdefault(normalize_name(alias), ts_code)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def lookup(self, name):
+        """Resolve one name without variations: exact, then normalized, then substring match"""
+        name = strip_invisible(name)
+        if not name:
+            return None
+        
+        ts_code = self.exact.get(name)
+        if ts_code:
+            return ts_code
+        
+        normalized = normalize_name(name)
+        ts_code = self.normalized_exact.get(normalized)
+        if ts_code:
+            return ts_code
+        
+        if len(normalized) < 2:
+            # Single characters are not indexed, scan the names instead
+            candidates = range(len(self.names))
+        else:
+            candidates = None
+            for gram in _ngrams(normalized):
+                postings = self.ngram_index.get(gram)
+                if not postings:
+                    return None
+                candidates = set(postings) if candidates is None else candidates & postings
+                if not candidates:
+                    return None
+        
+        matches = [entry_id for entry_id in candidates
+                   if normalized in self.normalized[entry_id]]
+        if not matches:
+            return None
+        
+        # Prefer names that start with the search term, then the shortest name
+        best = min(matches, key=lambda entry_id: (
+            not self.normalized[entry_id].startswith(normalized),
+            len(self.normalized[entry_id]),
+            entry_id
+        ))
+        logger.debug("模糊匹配找到: '%s' -> '%s' (%s)", name, self.names[best], self.codes[best])
+        return self.codes[best]
+    
+    def resolve(self, stock_name):
+        """Resolve a name, trying its variations in order"""
+        stock_name = strip_invisible(stock_name)
+        if not stock_name:
+            return None
+        
+        ts_code = self.lookup(stock_name)
+        if ts_code:
+            return ts_code
+        
+        for variation in get_name_variations(stock_name)[1:]:
+            ts_code = self.lookup(variation)
+            if ts_code:
+                logger.debug("通过名称变体 '%s' 找到股票 '%s' 的代码: %s", variation, stock_name, ts_code)
+                return ts_code
+        return None
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def build_resolver():
+    """Build a resolver from the current stock_basic table"""
+    version = db.get_stock_basic_version()
+    stock_basic = db.get_stock_basic()
+    rows = []
+    if stock_basic is not None and not stock_basic.empty:
+        rows = stock_basic[['ts_code', 'name']].itertuples(index=False, name=None)
+    return StockNameResolver(rows, HK_STOCK_NAME_MAPPING, version=version)
+
+def get_resolver():
+    """Get the shared resolver, rebuilding it when stock_basic has changed"""
+    global _resolver
+    with _resolver_lock:
+        current = _resolver is not None and _resolver.version == db.get_stock_basic_version()
+        instrumentation.record_cache('name_resolver', current)
+        if not current:
+            _resolver = build_resolver()
+        return _resolver
+
+def resolve_stock_code(stock_name):
+    """Resolve a stock name to its ts_code with the shared resolver"""
+    return get_resolver().resolve(stock_name)
@@ -0,0 +1,225 @@
+"""
+Streaming pipeline that overlaps Tushare fetching with SQLite writes
+"""
+import logging
+import queue
+import threading
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of fetched DataFrames waiting for the writer (fetchers block beyond this)
+DEFAULT_QUEUE_SIZE = 64
+
+# The writer commits once this many rows are buffered...
+DEFAULT_BATCH_ROWS = 20000
+
+# ...or once the oldest buffered frame has waited this long
+DEFAULT_BATCH_SECONDS = 1.0
+
+_STOP = object()
+
+def _merge_rewind(rewind, other):
+    """Merge ts_code -> first missing trade date dicts, keeping the earliest date"""
+    for ts_code, missing in other.items():
+        if ts_code not in rewind or missing < rewind[ts_code]:
+            rewind[ts_code] = missing
+
+class PriceWritePipeline:
+    """Bounded queue of fetched price frames drained by one dedicated writer thread
+    
+    Fetch workers call put() with each DataFrame they download and go on with
+    the next request while the writer thread merges queued frames into batches
+    and commits each batch with one bulk upsert. Having a single writer also
+    means fetch threads never contend for the SQLite write lock. When a batch
+    fails to commit, the watermarks of its stocks are held before the lost bars
+    (even if later batches commit), so the next refresh fetches them again.
+    """
+    
+    def __init__(self, max_queue=DEFAULT_QUEUE_SIZE, batch_rows=DEFAULT_BATCH_ROWS,
+                 batch_seconds=DEFAULT_BATCH_SECONDS, on_flush=None):
+        """
+        Args:
+            on_flush: Optional callback(written_rows, codes) run on the writer
+                thread after every committed batch
+        """
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self.on_flush = on_flush
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._failed_codes = set()
+        # Earliest trade date per stock of the bars in failed batches; sent with
+        # every later batch, so their commits cannot move a watermark past it
+        self._lost_dates = {}
+        self._lost_dates_pending = False
+        self._started_at = None
+        self._finished_at = None
+        self.stats = {
+            'queued_frames': 0,
+            'queued_rows': 0,
+            'written_rows': 0,
+            'inserted_rows': 0,
+            'updated_rows': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'write_seconds': 0.0,
+            'put_wait_seconds': 0.0,   # Time fetchers spent blocked on a full queue
+            'blocked_puts': 0,
+            'max_queue_depth': 0,
+        }
+    
+    def start(self):
+        """Start the writer thread"""
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='price-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+    
+    def put(self, frame=None, codes=None, coverage=None, rewind=None):
+        """Queue fetched bars for writing, blocking while the queue is full
+        
+        Args:
+            frame: DataFrame of daily bars (may be None for a coverage-only item)
+            codes: Stock codes whose result depends on this item being written
+            coverage: Optional dict ts_code -> first date of a fully downloaded range
+            rewind: Optional dict ts_code -> first missing trade date, applied
+                after the frames queued before it (see db.upsert_daily_prices)
+        """
+        item = (frame, list(codes or []), coverage, rewind)
+        rows = 0 if frame is None else len(frame)
+        
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # Backpressure: the writer is behind, so slow the fetchers down
+            wait_start = time.monotonic()
+            self._queue.put(item)
+            with self._lock:
+                self.stats['blocked_puts'] += 1
+                self.stats['put_wait_seconds'] += time.monotonic() - wait_start
+        
+        with self._lock:
+            self.stats['queued_frames'] += 1
+            self.stats['queued_rows'] += rows
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self._queue.qsize())
+    
+    def close(self):
+        """Flush everything still queued and stop the writer thread"""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        if self._lost_dates_pending:
+            # The last batch failed: no later commit has rewound the watermarks yet
+            if db.upsert_daily_prices([], rewind=self._lost_dates) is not None:
+                self._lost_dates_pending = False
+        self._finished_at = time.monotonic()
+    
+    def is_written(self, stock_code):
+        """Check that no batch holding bars of a stock failed to commit"""
+        with self._lock:
+            return stock_code not in self._failed_codes
+    
+    def get_stats(self):
+        """Return a copy of the counters with per-stage throughput"""
+        with self._lock:
+            stats = dict(self.stats)
+        end = self._finished_at or time.monotonic()
+        elapsed = end - self._started_at if self._started_at else 0.0
+        stats['elapsed_seconds'] = elapsed
+        stats['queue_depth'] = self._queue.qsize()
+        stats['fetch_rows_per_second'] = stats['queued_rows'] / elapsed if elapsed > 0 else 0.0
+        stats['write_rows_per_second'] = (stats['written_rows'] / stats['write_seconds']
+                                          if stats['write_seconds'] > 0 else 0.0)
+        return stats
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    
+    def _run(self):
+        batch = []
+        batch_rows = 0
+        batch_started = None
+        stopping = False
+        
+        while not stopping:
+            timeout = None
+            if batch:
+                timeout = max(0.0, self.batch_seconds - (time.monotonic() - batch_started))
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            
+            if item is _STOP:
+                stopping = True
+            elif item is not None:
+                if not batch:
+                    batch_started = time.monotonic()
+                batch.append(item)
+                batch_rows += 0 if item[0] is None else len(item[0])
+            
+            due = batch and (stopping or item is None or batch_rows >= self.batch_rows
+                             or time.monotonic() - batch_started >= self.batch_seconds)
+            if due:
+                self._flush(batch)
+                batch = []
+                batch_rows = 0
+    
+    def _flush(self, batch):
+        frames = [frame for frame, _, _, _ in batch if frame is not None and not frame.empty]
+        coverage = {}
+        rewind = {}
+        codes = set()
+        for frame, item_codes, item_coverage, item_rewind in batch:
+            codes.update(item_codes)
+            if item_coverage:
+                coverage.update(item_coverage)
+            if item_rewind:
+                _merge_rewind(rewind, item_rewind)
+            if frame is not None and not frame.empty:
+                codes.update(frame['ts_code'].unique())
+        _merge_rewind(rewind, self._lost_dates)
+        lost_dates_sent = self._lost_dates_pending
+        
+        write_start = time.monotonic()
+        try:
+            counts = db.upsert_daily_prices(frames, coverage=coverage, rewind=rewind)
+        except Exception:
+            logger.exception("写入线程保存数据时发生错误")
+            counts = None
+        write_seconds = time.monotonic() - write_start
+        
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['write_seconds'] += write_seconds
+            if counts is None:
+                self.stats['failed_batches'] += 1
+                self._failed_codes.update(codes)
+                for frame in frames:
+                    _merge_rewind(self._lost_dates,
+                                  frame['trade_date'].astype(str).groupby(frame['ts_code']).min().to_dict())
+                _merge_rewind(self._lost_dates, rewind)
+                self._lost_dates_pending = bool(self._lost_dates)
+            else:
+                if lost_dates_sent:
+                    self._lost_dates_pending = False
+                inserted, updated = counts
+                self.stats['inserted_rows'] += inserted
+                self.stats['updated_rows'] += updated
+                self.stats['written_rows'] += inserted + updated
+        
+        if counts is not None and self.on_flush is not None:
+            try:
+                self.on_flush(counts[0] + counts[1], codes)
+            except Exception:
+                logger.exception("写入线程回调发生错误")
@@ -0,0 +1,142 @@
+"""
+Compressed columnar encoding of one stock's daily bars (cold history blobs)
+"""
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Columns stored in a blob besides trade_date (the value columns of daily_prices)
+BAR_FIELDS = ['open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+
+# Largest number of decimals tried when storing a column as scaled integers;
+# columns that need more are stored as raw float64
+MAX_DECIMALS = 6
+
+FORMAT_VERSION = 1
+ZLIB_LEVEL = 6
+
+# Integer types deltas are narrowed to, by code
+_INT_TYPES = (np.int8, np.int16, np.int32, np.int64)
+
+# Marks a column stored as raw float64 instead of scaled integers
+_RAW_FLOAT = -1
+
+_EPOCH = np.datetime64('1970-01-01', 'D')
+
+def _narrowest_int_type(values):
+    if len(values) == 0:
+        return 0
+    low, high = values.min(), values.max()
+    for code, int_type in enumerate(_INT_TYPES):
+        info = np.iinfo(int_type)
+        if info.min <= low and high <= info.max:
+            return code
+    return len(_INT_TYPES) - 1
+
+def _pack_deltas(values):
+    """First value, then the narrowed differences of an int64 array"""
+    deltas = np.diff(values)
+    code = _narrowest_int_type(deltas)
+    first = int(values[0]) if len(values) else 0
+    return struct.pack('<qB', first, code) + deltas.astype(_INT_TYPES[code]).tobytes()
+
+def _scale(values):
+    """Find the fewest decimals that represent every value exactly
+    
+    Returns:
+        tuple: (decimals, int64 scaled values), or (_RAW_FLOAT, None)
+    """
+    for decimals in range(MAX_DECIMALS + 1):
+        factor = 10.0 ** decimals
+        scaled = np.round(values * factor)
+        if np.all(np.abs(scaled) < 2 ** 53) and np.array_equal(scaled / factor, values):
+            return decimals, scaled.astype(np.int64)
+    return _RAW_FLOAT, None
+
+def encode_bars(bars):
+    """Encode the bars of one stock as a compressed blob
+    
+    Dates are stored as day offsets from the first date and every field as
+    delta-encoded integers at the fewest decimals that keep it exact (raw
+    float64 otherwise), with a bitmap of the missing values. Decoding gives
+    back exactly the stored values.
+    
+    Args:
+        bars: DataFrame with trade_date (YYYYMMDD) and BAR_FIELDS, one row per date
+    """
+    bars = bars.sort_values('trade_date')
+    days = (pd.to_datetime(bars['trade_date'].astype(str), format='%Y%m%d').to_numpy()
+            .astype('datetime64[D]') - _EPOCH).astype(np.int64)
+    parts = [struct.pack('<BI', FORMAT_VERSION, len(bars)), _pack_deltas(days)]
+    
+    for field in BAR_FIELDS:
+        values = pd.to_numeric(bars[field], errors='coerce').to_numpy(dtype=np.float64)
+        missing = np.isnan(values)
+        present = values[~missing]
+        decimals, scaled = _scale(present)
+        parts.append(struct.pack('<bB', decimals, int(missing.any())))
+        if missing.any():
+            parts.append(np.packbits(missing).tobytes())
+        if decimals == _RAW_FLOAT:
+            parts.append(present.tobytes())
+        else:
+            parts.append(_pack_deltas(scaled))
+    return zlib.compress(b''.join(parts), ZLIB_LEVEL)
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+    
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values
+    
+    def array(self, dtype, count):
+        array = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes
+        return array
+    
+    def deltas(self, count):
+        first, code = self.unpack('<qB')
+        deltas = self.array(_INT_TYPES[code], max(count - 1, 0)).astype(np.int64)
+        values = np.empty(count, dtype=np.int64)
+        if count:
+            values[0] = first
+            np.cumsum(deltas, out=values[1:])
+            values[1:] += first
+        return values
+
+def decode_bars(blob):
+    """Decode a blob from encode_bars
+    
+    Returns:
+        DataFrame with trade_date (YYYYMMDD strings) and BAR_FIELDS, oldest first
+    """
+    reader = _Reader(zlib.decompress(blob))
+    version, count = reader.unpack('<BI')
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unsupported cold history format version {version}')
+    
+    days = reader.deltas(count)
+    dates = np.datetime_as_string(_EPOCH + days.astype('timedelta64[D]'))
+    columns = {'trade_date': np.char.replace(dates, '-', '').astype(object)}
+    
+    for field in BAR_FIELDS:
+        decimals, has_missing = reader.unpack('<bB')
+        if has_missing:
+            missing = np.unpackbits(reader.array(np.uint8, (count + 7) // 8), count=count).astype(bool)
+        else:
+            missing = np.zeros(count, dtype=bool)
+        present_count = count - int(missing.sum())
+        if decimals == _RAW_FLOAT:
+            present = reader.array(np.float64, present_count)
+        else:
+            present = reader.deltas(present_count) / 10.0 ** decimals
+        values = np.full(count, np.nan)
+        values[~missing] = present
+        columns[field] = values
+    return pd.DataFrame(columns)
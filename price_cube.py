@@ -0,0 +1,338 @@
+"""
+Memory-mapped [trade_date x stock] arrays of the recent daily bars
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Fields stored in the cube, one array each
+CUBE_FIELDS = ('open', 'high', 'low', 'close', 'vol', 'amount', 'pct_chg')
+
+# Storage type of every field: prices and percentages fit float32, volumes and
+# amounts exceed 2**24 and would be rounded, so they stay float64
+CUBE_DTYPES = {'open': np.float32, 'high': np.float32, 'low': np.float32, 'close': np.float32,
+               'vol': np.float64, 'amount': np.float64, 'pct_chg': np.float32}
+
+# Layout version of the arrays; a cube written in another layout is rebuilt
+CUBE_FORMAT = 2
+
+# Calendar days of bars kept in the cube (older days are dropped when it is reshaped)
+CUBE_WINDOW_DAYS = 400
+
+# Rows (trading days) and columns (stocks) allocated at a time, so appends
+# rarely need to copy the arrays
+DAY_CAPACITY_STEP = 64
+STOCK_CAPACITY_STEP = 512
+
+META_FILE = 'meta.json'
+
+# Marker of a cube that missed a write of daily_prices and needs a rebuild
+DIRTY_FILE = 'dirty'
+
+def get_cube_dir():
+    """Directory of the cube that belongs to the current database file"""
+    return os.path.splitext(db.DB_PATH)[0] + '_cube'
+
+def _round_up(value, step):
+    return max(step, -(-value // step) * step)
+
+def _array_path(directory, field, generation):
+    return os.path.join(directory, f'{field}-{generation}.npy')
+
+def _has_current_format(meta):
+    return meta is None or meta.get('format') == CUBE_FORMAT
+
+def _read_meta(directory):
+    try:
+        with open(os.path.join(directory, META_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _write_meta(directory, meta):
+    # Readers only ever see a complete file
+    path = os.path.join(directory, META_FILE)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, path)
+
+class PriceCube:
+    """Read view of the cube: one [trade_date x stock] array per field
+    
+    dates are sorted ascending and codes keep the order in which the stocks
+    were first written. Missing bars are NaN. The arrays are memory-mapped, so
+    several processes can share one cube and slices do not copy.
+    """
+    
+    def __init__(self, directory, meta, mode='r'):
+        self.directory = directory
+        self.generation = meta['generation']
+        self.dates = meta['dates']
+        self.codes = meta['codes']
+        self.date_index = {date: row for row, date in enumerate(self.dates)}
+        self.code_index = {code: column for column, code in enumerate(self.codes)}
+        self._arrays = {field: np.load(_array_path(directory, field, self.generation), mmap_mode=mode)
+                        for field in meta['fields']}
+    
+    def __len__(self):
+        return len(self.dates)
+    
+    def field(self, name):
+        """[trade_date x stock] array of one field (a view of the mapped file)"""
+        return self._arrays[name][:len(self.dates), :len(self.codes)]
+    
+    def window(self, start_date=None, end_date=None, codes=None, fields=CUBE_FIELDS):
+        """Slice the days between two dates (YYYYMMDD, inclusive) and optionally some stocks
+        
+        Returns:
+            tuple: (dates, codes, {field: 2D array}); codes that are not in the
+            cube are left out. Without codes the arrays are views, otherwise copies.
+        """
+        first = bisect.bisect_left(self.dates, start_date) if start_date else 0
+        last = bisect.bisect_right(self.dates, end_date) if end_date else len(self.dates)
+        if codes is None:
+            columns = slice(0, len(self.codes))
+            selected = list(self.codes)
+        else:
+            selected = [code for code in codes if code in self.code_index]
+            columns = [self.code_index[code] for code in selected]
+        arrays = {field: self._arrays[field][first:last, columns] for field in fields}
+        return self.dates[first:last], selected, arrays
+    
+    def series(self, ts_code, field='close'):
+        """Bars of one field of one stock as a Series indexed by trade_date"""
+        column = self.code_index.get(ts_code)
+        if column is None:
+            return pd.Series(dtype='float32')
+        return pd.Series(self.field(field)[:, column], index=self.dates, name=ts_code)
+
+_write_lock = threading.Lock()
+_cube = None
+_cube_lock = threading.Lock()
+
+# Cube directories marked dirty in this process only (the marker file could not be written)
+_dirty_dirs = set()
+
+# Failed cube writes in this process, so a rebuild knows whether one happened meanwhile
+_write_failures = 0
+
+def is_dirty():
+    """Check whether the cube missed bars written to daily_prices (until it is rebuilt)"""
+    directory = get_cube_dir()
+    return directory in _dirty_dirs or os.path.exists(os.path.join(directory, DIRTY_FILE))
+
+def _mark_dirty():
+    global _write_failures
+    directory = get_cube_dir()
+    _write_failures += 1
+    try:
+        os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, DIRTY_FILE), 'w').close()
+    except OSError as e:
+        logger.warning("无法写入价格立方体的失效标记 %s: %s", directory, e)
+        _dirty_dirs.add(directory)
+
+def _clear_dirty():
+    directory = get_cube_dir()
+    _dirty_dirs.discard(directory)
+    try:
+        os.remove(os.path.join(directory, DIRTY_FILE))
+    except FileNotFoundError:
+        pass
+
+def _window_start(now=None):
+    return ((now or datetime.now()) - timedelta(days=CUBE_WINDOW_DAYS)).strftime('%Y%m%d')
+
+def covers(start_date):
+    """Check whether the cube holds every stored bar from start_date (YYYYMMDD) on"""
+    return start_date >= _window_start() and not is_dirty()
+
+def _prepare_bars(bars):
+    """Bars inside the cube window with numeric fields, deduplicated"""
+    frame = bars.reindex(columns=['ts_code', 'trade_date', *CUBE_FIELDS]).copy()
+    frame['trade_date'] = frame['trade_date'].astype(str)
+    frame = frame[frame['trade_date'] >= _window_start()]
+    frame = frame.drop_duplicates(subset=['ts_code', 'trade_date'], keep='last')
+    for field in CUBE_FIELDS:
+        frame[field] = pd.to_numeric(frame[field], errors='coerce').astype(CUBE_DTYPES[field])
+    return frame
+
+def _allocate(directory, generation, day_capacity, stock_capacity):
+    arrays = {}
+    for field in CUBE_FIELDS:
+        array = np.lib.format.open_memmap(_array_path(directory, field, generation), mode='w+',
+                                          dtype=CUBE_DTYPES[field], shape=(day_capacity, stock_capacity))
+        array[:] = np.nan
+        arrays[field] = array
+    return arrays
+
+def _write_values(arrays, frame, rows, columns):
+    for field in CUBE_FIELDS:
+        values = frame[field].to_numpy()
+        # Like the daily_prices upsert, a missing value keeps the stored one
+        present = ~np.isnan(values)
+        arrays[field][rows[present], columns[present]] = values[present]
+
+def append_prices(bars):
+    """Write daily bars into the cube, growing or reshaping it as needed
+    
+    Days after the last stored day and new stocks are appended in place while
+    the allocated capacity lasts. Anything else (a day before the last one,
+    running out of capacity) rewrites the arrays as a new generation, dropping
+    days older than CUBE_WINDOW_DAYS. The metadata is replaced last, so readers
+    switch over atomically.
+    
+    Args:
+        bars: DataFrame with ts_code, trade_date and any of CUBE_FIELDS
+    """
+    frame = _prepare_bars(bars)
+    if frame.empty:
+        return
+    
+    directory = get_cube_dir()
+    with _write_lock:
+        os.makedirs(directory, exist_ok=True)
+        meta = _read_meta(directory) or {'generation': 0, 'dates': [], 'codes': [], 'fields': list(CUBE_FIELDS),
+                                         'day_capacity': 0, 'stock_capacity': 0, 'format': CUBE_FORMAT}
+        if not _has_current_format(meta) and meta['dates']:
+            raise ValueError(f"price cube {directory} has layout {meta.get('format')}, rebuild it first")
+        dates = meta['dates']
+        codes = meta['codes']
+        known_dates = set(dates)
+        known_codes = set(codes)
+        new_dates = sorted(set(frame['trade_date']) - known_dates)
+        new_codes = [code for code in dict.fromkeys(frame['ts_code']) if code not in known_codes]
+        
+        appendable = (meta['generation'] > 0
+                      and (not new_dates or not dates or new_dates[0] > dates[-1])
+                      and len(dates) + len(new_dates) <= meta['day_capacity']
+                      and len(codes) + len(new_codes) <= meta['stock_capacity'])
+        
+        if appendable:
+            arrays = {field: np.load(_array_path(directory, field, meta['generation']), mmap_mode='r+')
+                      for field in CUBE_FIELDS}
+            dates = dates + new_dates
+            codes = codes + new_codes
+            old_generation = None
+        else:
+            window_start = _window_start()
+            kept_rows = [row for row, date in enumerate(dates) if date >= window_start]
+            dates_all = sorted({dates[row] for row in kept_rows} | set(new_dates))
+            codes_all = codes + new_codes
+            old_generation = meta['generation'] or None
+            generation = meta['generation'] + 1
+            day_capacity = _round_up(len(dates_all) + DAY_CAPACITY_STEP // 2, DAY_CAPACITY_STEP)
+            stock_capacity = _round_up(len(codes_all), STOCK_CAPACITY_STEP)
+            arrays = _allocate(directory, generation, day_capacity, stock_capacity)
+            
+            if old_generation and kept_rows and codes:
+                # Existing stocks keep their columns; kept days move to their new rows
+                new_row_of = {date: row for row, date in enumerate(dates_all)}
+                target_rows = np.array([new_row_of[dates[row]] for row in kept_rows])
+                source_rows = np.array(kept_rows)
+                for field in CUBE_FIELDS:
+                    old = np.load(_array_path(directory, field, old_generation), mmap_mode='r')
+                    arrays[field][target_rows, :len(codes)] = old[source_rows, :len(codes)]
+            dates, codes = dates_all, codes_all
+            meta.update(generation=generation, day_capacity=day_capacity, stock_capacity=stock_capacity)
+        
+        date_index = {date: row for row, date in enumerate(dates)}
+        code_index = {code: column for column, code in enumerate(codes)}
+        rows = frame['trade_date'].map(date_index).to_numpy()
+        columns = frame['ts_code'].map(code_index).to_numpy()
+        _write_values(arrays, frame, rows, columns)
+        for array in arrays.values():
+            array.flush()
+        
+        meta.update(dates=dates, codes=codes, fields=list(CUBE_FIELDS), format=CUBE_FORMAT)
+        _write_meta(directory, meta)
+        
+        if old_generation:
+            for path in glob.glob(os.path.join(directory, f'*-{old_generation}.npy')):
+                # Readers that still map the old files keep them until they unmap (POSIX)
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.debug("删除旧的价格立方体文件 %s 失败: %s", path, e)
+
+def rebuild():
+    """Build the cube again from the bars of the last CUBE_WINDOW_DAYS in daily_prices
+    
+    A dirty cube is clean again once the rebuild succeeds without another
+    write failing meanwhile.
+    """
+    directory = get_cube_dir()
+    failures = _write_failures
+    try:
+        with _write_lock:
+            # Empty the cube but keep counting generations, so cached readers notice
+            meta = _read_meta(directory)
+            if meta is not None:
+                meta.update(dates=[], codes=[], day_capacity=0, stock_capacity=0, format=CUBE_FORMAT)
+                _write_meta(directory, meta)
+        bars = db.get_daily_prices_window(None, _window_start())
+        if not bars.empty:
+            append_prices(bars)
+    except Exception:
+        _mark_dirty()
+        raise
+    if _write_failures == failures:
+        _clear_dirty()
+    return not bars.empty
+
+def get_cube(build=True):
+    """Get the current cube, reloading it after writes (also by other processes)
+    
+    Args:
+        build: Build the cube from daily_prices if none has been written yet
+    
+    Returns:
+        PriceCube, or None if there are no bars or the cube is dirty
+    """
+    global _cube
+    
+    if is_dirty():
+        return None
+    directory = get_cube_dir()
+    meta = _read_meta(directory)
+    if (meta is None or not _has_current_format(meta)) and build and rebuild():
+        meta = _read_meta(directory)
+    if meta is None or not _has_current_format(meta):
+        return None
+    
+    with _cube_lock:
+        cube = _cube
+        if (cube is None or cube.directory != directory or cube.generation != meta['generation']
+                or len(cube.dates) != len(meta['dates']) or len(cube.codes) != len(meta['codes'])):
+            cube = _cube = PriceCube(directory, meta)
+        return cube
+
+def on_prices_written(bars):
+    """daily_prices write listener keeping the cube in step
+    
+    When an append fails the cube is marked dirty, so covers() is False and
+    reads use daily_prices, and the next write rebuilds it instead of appending.
+    A cube written in an older layout is rebuilt the same way.
+    """
+    if is_dirty() or not _has_current_format(_read_meta(get_cube_dir())):
+        rebuild()
+        return
+    try:
+        append_prices(bars)
+    except Exception:
+        _mark_dirty()
+        raise
+
+db.add_price_write_listener(on_prices_written)
@@ -0,0 +1,226 @@
+"""
+Market-session-aware background refresh scheduler
+"""
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+import trade_calendar
+from hk_stock_utils import get_hk_market_status, is_hk_stock_code
+
+# A-share continuous trading sessions (morning, afternoon), Asia/Shanghai time
+A_SHARE_SESSIONS = (((9, 30), (11, 30)), ((13, 0), (15, 0)))
+
+# Minutes between refreshes of a market's stocks while it is trading
+REFRESH_INTERVAL_MINUTES = {'A': 15, 'HK': 15}
+
+# Minutes after the close before the final pass of the day (daily bars are
+# published by Tushare some time after the close)
+POST_CLOSE_DELAY_MINUTES = {'A': 60, 'HK': 60}
+
+# Seconds between two checks of the market sessions
+SCHEDULER_TICK_SECONDS = 30
+
+# Display names of the markets in log messages
+MARKET_LABELS = {'A': 'A股', 'HK': '港股'}
+
+def get_a_share_market_status(now=None):
+    """Get A-share (SSE/SZSE) trading status
+    
+    Args:
+        now: Optional aware datetime to evaluate instead of the current time
+    
+    Returns:
+        dict: Same fields as hk_stock_utils.get_hk_market_status; is_open is
+        only True inside a session (the 11:30-13:00 lunch break is closed)
+    """
+    cn_tz = pytz.timezone('Asia/Shanghai')
+    now_cn = now.astimezone(cn_tz) if now is not None else datetime.now(cn_tz)
+    
+    sessions = [(now_cn.replace(hour=start[0], minute=start[1], second=0, microsecond=0),
+                 now_cn.replace(hour=end[0], minute=end[1], second=0, microsecond=0))
+                for start, end in A_SHARE_SESSIONS]
+    market_open = sessions[0][0]
+    market_close = sessions[-1][1]
+    
+    is_trading_day = now_cn.weekday() < 5  # Monday = 0, Friday = 4
+    is_trading_hours = any(start <= now_cn <= end for start, end in sessions)
+    is_lunch_break = sessions[0][1] < now_cn < sessions[1][0]
+    
+    return {
+        'is_open': is_trading_day and is_trading_hours,
+        'local_time': now_cn.strftime('%Y-%m-%d %H:%M:%S %Z'),
+        'is_trading_day': is_trading_day,
+        'is_trading_hours': is_trading_hours,
+        'is_lunch_break': is_trading_day and is_lunch_break,
+        'is_after_close': is_trading_day and now_cn > market_close,
+        'trade_date': now_cn.strftime('%Y%m%d'),
+        'open_time': market_open,
+        'close_time': market_close
+    }
+
+# Session model of every market
+MARKET_STATUS_FUNCTIONS = {
+    'A': get_a_share_market_status,
+    'HK': get_hk_market_status
+}
+
+def get_market(stock_code):
+    """Get the market key ('A' or 'HK') of a ts_code"""
+    return 'HK' if is_hk_stock_code(stock_code) else 'A'
+
+class MarketRefreshScheduler:
+    """Submit per-market refreshes while the market can produce new bars
+    
+    While a market is in a trading session, its stocks are refreshed every
+    REFRESH_INTERVAL_MINUTES. After the close of a trading day, one final pass
+    runs POST_CLOSE_DELAY_MINUTES later. Nothing is submitted on weekends,
+    exchange holidays (see trade_calendar), overnight or during the lunch breaks.
+    """
+    
+    def __init__(self, submit, code_provider, last_refresh_provider=None):
+        """
+        Args:
+            submit: Callable(codes) starting a refresh of those ts_codes
+                (e.g. JobManager.submit)
+            code_provider: Callable returning the ts_codes to keep fresh
+            last_refresh_provider: Optional callable returning the datetime of
+                the last completed refresh, used to skip a post-close pass that
+                already ran before a restart
+        """
+        self.submit = submit
+        self.code_provider = code_provider
+        self.last_refresh_provider = last_refresh_provider
+        self.last_refresh = {}         # Market -> aware datetime of the last in-session refresh
+        self.post_close_done = {}      # Market -> trade date of the last post-close pass
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Start checking the sessions on a daemon thread"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='refresh-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+        print("后台定时刷新已启动")
+        return True
+    
+    def stop(self):
+        """Stop the scheduler thread"""
+        self._stop.set()
+    
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+    
+    def _loop(self):
+        self._seed_post_close()
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"定时刷新检查时发生错误: {e}")
+            self._stop.wait(SCHEDULER_TICK_SECONDS)
+    
+    def _seed_post_close(self, now=None):
+        """Mark today's post-close passes as done if a refresh already ran after them
+        
+        Args:
+            now: Optional aware datetime to evaluate instead of the current time
+        """
+        if self.last_refresh_provider is None:
+            return
+        try:
+            last_refresh = self.last_refresh_provider()
+        except Exception as e:
+            print(f"读取上次刷新时间时发生错误: {e}")
+            return
+        if last_refresh is None:
+            return
+        
+        for market, status_function in MARKET_STATUS_FUNCTIONS.items():
+            status = status_function(now)
+            post_close_time = status.get('close_time')
+            if not status.get('is_after_close') or post_close_time is None:
+                continue
+            post_close_time += timedelta(minutes=POST_CLOSE_DELAY_MINUTES[market])
+            # Stored refresh times are naive local times
+            if last_refresh >= post_close_time.astimezone().replace(tzinfo=None):
+                self.post_close_done[market] = status['trade_date']
+    
+    def get_due_markets(self, now=None):
+        """Decide which markets need a refresh now
+        
+        Returns:
+            dict: market -> reason ('session' or 'post_close')
+        """
+        due = {}
+        for market, status_function in MARKET_STATUS_FUNCTIONS.items():
+            status = status_function(now)
+            if 'error' in status:
+                continue
+            # Holidays produce no bars, neither in session hours nor after the close
+            if not trade_calendar.is_trade_day(trade_calendar.MARKET_EXCHANGES[market], status['trade_date']):
+                continue
+            current = now or datetime.now(status['close_time'].tzinfo)
+            
+            if status['is_open']:
+                last = self.last_refresh.get(market)
+                interval = timedelta(minutes=REFRESH_INTERVAL_MINUTES[market])
+                if last is None or current - last >= interval:
+                    due[market] = 'session'
+            elif status['is_after_close'] and self.post_close_done.get(market) != status['trade_date']:
+                post_close_time = status['close_time'] + timedelta(minutes=POST_CLOSE_DELAY_MINUTES[market])
+                if current >= post_close_time:
+                    due[market] = 'post_close'
+        return due
+    
+    def tick(self, now=None):
+        """Submit the refreshes that are due
+        
+        Returns:
+            dict: market -> submitted job (or the submit return value)
+        """
+        due = self.get_due_markets(now)
+        if not due:
+            return {}
+        
+        codes_by_market = {}
+        for code in self.code_provider():
+            codes_by_market.setdefault(get_market(code), []).append(code)
+        
+        submitted = {}
+        for market, reason in due.items():
+            status = MARKET_STATUS_FUNCTIONS[market](now)
+            if reason == 'session':
+                self.last_refresh[market] = now or datetime.now(status['close_time'].tzinfo)
+            else:
+                self.post_close_done[market] = status['trade_date']
+            
+            codes = codes_by_market.get(market)
+            if not codes:
+                continue
+            reason_label = '盘中' if reason == 'session' else '收盘后'
+            print(f"定时刷新: {MARKET_LABELS[market]}{reason_label}刷新 {len(codes)} 只股票")
+            submitted[market] = self.submit(codes)
+        return submitted
+    
+    def get_status(self):
+        """JSON friendly description of the scheduler state"""
+        markets = {}
+        for market, status_function in MARKET_STATUS_FUNCTIONS.items():
+            status = status_function()
+            last = self.last_refresh.get(market)
+            markets[market] = {
+                'is_open': status.get('is_open', False),
+                'is_lunch_break': status.get('is_lunch_break', False),
+                'local_time': status.get('local_time'),
+                'interval_minutes': REFRESH_INTERVAL_MINUTES[market],
+                'last_refresh': last.strftime('%Y-%m-%d %H:%M:%S') if last else None,
+                'post_close_done': self.post_close_done.get(market)
+            }
+        return {'running': self.is_running(), 'markets': markets}
@@ -1,39 +1,83 @@
+import logging
+
 import pandas as pd
 import tushare as ts
 from datetime import datetime, timedelta
 from sector import SECTORS
 import db
+import fetcher
+import pipeline
+import name_resolver
+import metrics
+import events
+import trade_calendar
+import instrumentation
+import price_cube
+
+logger = logging.getLogger(__name__)
+
+# Tushare pro API client, created on first use (see get_pro)
+pro = None
+
+# Weight of one cross-sectional (whole market, one trade_date) daily call relative
+# to one per-stock call when choosing between date-major and stock-major fetching
+DATE_MAJOR_CALL_WEIGHT = 2
+
+# Minimum minutes between two stock_basic downloads triggered by unresolved names
+STOCK_BASIC_REFRESH_TTL_MINUTES = 12 * 60
+
+# Minutes an unresolvable stock name stays in the negative cache
+NEGATIVE_CACHE_TTL_MINUTES = 24 * 60
+
+# Minimum hours between two compactions of old bars into the cold tier
+COLD_COMPACTION_INTERVAL_HOURS = 24
+
+# Fetch/write pipeline counters of the most recent update_daily_data_batch run
+_last_update_stats = {}
 
-# Initialize with your Tushare token
-ts.set_token('')
-pro = ts.pro_api()
+# Time of the last cold tier compaction in this process
+_last_cold_compaction = None
+
+def get_pro():
+    """Get the Tushare pro API client, creating it on first use"""
+    global pro
+    if pro is None:
+        # Initialize with your Tushare token
+        ts.set_token('')
+        pro = ts.pro_api()
+    return pro
+
+def set_pro(client):
+    """Replace the Tushare client, e.g. with an offline stand-in (see benchmarks/)"""
+    global pro
+    pro = client
 
 def update_stock_basic_data():
     """Update the stock basic info database including Hong Kong stocks"""
     try:
-        print("从Tushare获取股票基本信息...")
+        logger.info("从Tushare获取股票基本信息...")
         
         # Get A-share basic info
-        print("获取A股基本信息...")
-        a_stock_info = pro.stock_basic(exchange='', list_status='L', 
-                                      fields='ts_code,symbol,name,area,industry,market')
+        logger.debug("获取A股基本信息...")
+        a_stock_info = fetcher.call_api(get_pro(), 'stock_basic', exchange='', list_status='L', 
+                                        fields='ts_code,symbol,name,area,industry,market')
         
         # Get Hong Kong stock basic info
-        print("获取港股基本信息...")
+        logger.debug("获取港股基本信息...")
         try:
-            hk_stock_info = pro.hk_basic(fields='ts_code,name,fullname,enname,market')
+            hk_stock_info = fetcher.call_api(get_pro(), 'hk_basic', fields='ts_code,name,fullname,enname,market')
             # Add market column for consistency
             if hk_stock_info is not None and not hk_stock_info.empty:
                 hk_stock_info['symbol'] = hk_stock_info['ts_code'].str.replace('.HK', '')
                 hk_stock_info['area'] = '香港'
                 hk_stock_info['industry'] = '港股'
                 hk_stock_info['market'] = 'HK'
-                print(f"成功获取 {len(hk_stock_info)} 条港股基本信息")
+                logger.debug("成功获取 %d 条港股基本信息", len(hk_stock_info))
             else:
-                print("港股基本信息获取失败或为空")
+                logger.warning("港股基本信息获取失败或为空")
                 hk_stock_info = pd.DataFrame()
         except Exception as e:
-            print(f"获取港股基本信息时发生错误: {e}")
+            logger.warning("获取港股基本信息时发生错误: %s", e)
             hk_stock_info = pd.DataFrame()
         
         # Combine A-share and HK stock info
@@ -45,74 +89,134 @@ def update_stock_basic_data():
                 hk_stock_info = hk_stock_info[common_columns]
                 
                 stock_info = pd.concat([a_stock_info, hk_stock_info], ignore_index=True)
-                print(f"合并后总计 {len(stock_info)} 条股票基本信息")
+                logger.info("合并后总计 %d 条股票基本信息", len(stock_info))
             else:
                 stock_info = a_stock_info
-                print(f"仅A股数据，总计 {len(stock_info)} 条股票基本信息")
+                logger.info("仅A股数据，总计 %d 条股票基本信息", len(stock_info))
         else:
-            print("A股基本信息获取失败")
+            logger.error("A股基本信息获取失败")
             return False
         
         # Save to database
-        print("正在保存股票基本信息到数据库...")
+        logger.debug("正在保存股票基本信息到数据库...")
         save_success = db.save_stock_basic(stock_info)
         
         if save_success:
-            print("股票基本信息保存到数据库成功")
+            logger.debug("股票基本信息保存到数据库成功")
         else:
-            print("股票基本信息保存到数据库失败")
+            logger.error("股票基本信息保存到数据库失败")
             
         return save_success
-    except Exception as e:
-        print(f"更新股票基本信息发生错误: {e}")
+    except Exception:
+        logger.exception("更新股票基本信息发生错误")
         return False
 
-def get_stock_code(stock_name):
-    """Get stock code by name, with support for both A-shares and HK stocks"""
+def refresh_stock_basic_if_stale(ttl_minutes=None):
+    """Download stock_basic again unless it was refreshed within ttl_minutes
+    
+    Returns:
+        bool: True if a download was performed
+    """
+    ttl_minutes = STOCK_BASIC_REFRESH_TTL_MINUTES if ttl_minutes is None else ttl_minutes
+    last_updated = db.get_stock_basic_last_updated()
+    if last_updated and datetime.now() - last_updated < timedelta(minutes=ttl_minutes):
+        logger.info("股票基本信息于 %s 更新，未超过 %d 分钟，跳过下载", last_updated, ttl_minutes)
+        return False
+    
+    update_stock_basic_data()
+    return True
+
+def compact_cold_history_if_due(interval_hours=None):
+    """Move bars older than db.COLD_HORIZON_DAYS into the cold tier, at most once per interval
+    
+    Returns:
+        dict: Compaction stats (see db.compact_cold_history), or None if skipped or failed
+    """
+    global _last_cold_compaction
+    
+    interval_hours = COLD_COMPACTION_INTERVAL_HOURS if interval_hours is None else interval_hours
+    now = datetime.now()
+    if _last_cold_compaction and now - _last_cold_compaction < timedelta(hours=interval_hours):
+        return None
+    
     try:
-        # Try to get from database first
-        code = db.get_stock_code_from_db(stock_name)
-        if code:
-            return code
-            
-        # Try variations of the stock name for better matching
-        stock_name_variations = [
-            stock_name,
-            stock_name.replace('集团', ''),
-            stock_name.replace('股份', ''),
-            stock_name.replace('有限公司', ''),
-            stock_name.replace('公司', ''),
-            stock_name + '集团',
-            stock_name + '股份'
-        ]
-        
-        for variation in stock_name_variations:
-            code = db.get_stock_code_from_db(variation)
-            if code:
-                print(f"通过名称变体 '{variation}' 找到股票 '{stock_name}' 的代码: {code}")
-                return code
-            
-        print(f"数据库中未找到股票 '{stock_name}' 的代码，尝试更新股票基本数据...")
+        stats = db.compact_cold_history()
+    except Exception as e:
+        logger.warning("压缩历史日线数据时发生错误: %s", e)
+        return None
+    _last_cold_compaction = now
+    return stats
+
+def resolve_stock_codes(stock_names):
+    """Resolve many stock names to codes in one pass
+    
+    Saved aliases are used first, then the in-memory resolver. stock_basic is
+    downloaded again at most once per call, and only if names are still
+    unresolved and the last download is older than STOCK_BASIC_REFRESH_TTL_MINUTES.
+    Successful mappings are saved as aliases; names that still cannot be
+    resolved go into a negative cache for NEGATIVE_CACHE_TTL_MINUTES and are
+    not looked up again until it expires.
+    
+    Returns:
+        dict: stock name -> ts_code, or None if the name could not be resolved
+    """
+    names = list(dict.fromkeys(stock_names))
+    result = {name: None for name in names}
+    if not names:
+        return result
+    
+    try:
+        aliases = db.get_stock_aliases(names)
+        result.update(aliases)
+        instrumentation.CACHE_REQUESTS.inc(len(aliases), cache='stock_aliases', result='hit')
+        instrumentation.CACHE_REQUESTS.inc(len(names) - len(aliases), cache='stock_aliases', result='miss')
         
-        # If not in database, update stock basic data then try again
-        if callable(update_stock_basic_data):
-            update_stock_basic_data()
-        else:
-            print("警告: update_stock_basic_data 不可调用")
+        pending = [name for name in names if name not in aliases]
+        cached_misses = db.get_stock_name_misses(pending)
+        instrumentation.CACHE_REQUESTS.inc(len(cached_misses), cache='stock_name_misses', result='hit')
+        instrumentation.CACHE_REQUESTS.inc(len(pending) - len(cached_misses), cache='stock_name_misses',
+                                           result='miss')
+        if cached_misses:
+            logger.info("跳过 %d 个近期无法识别的股票名称", len(cached_misses))
+        pending = [name for name in pending if name not in cached_misses]
+        
+        resolved = {}
+        if pending:
+            resolver = name_resolver.get_resolver()
+            for name in pending:
+                code = resolver.resolve(name)
+                if code:
+                    resolved[name] = code
             
-        # Try again with variations after update
-        for variation in stock_name_variations:
-            code = db.get_stock_code_from_db(variation)
-            if code:
-                print(f"更新后通过名称变体 '{variation}' 找到股票 '{stock_name}' 的代码: {code}")
-                return code
+            unresolved = [name for name in pending if name not in resolved]
+            if unresolved or len(resolver) == 0:
+                logger.info("%d 个股票名称未找到代码，检查是否需要更新股票基本数据...", len(unresolved))
+                if refresh_stock_basic_if_stale():
+                    resolver = name_resolver.get_resolver()
+                    for name in unresolved:
+                        code = resolver.resolve(name)
+                        if code:
+                            resolved[name] = code
             
-        # If still not found, return None
-        print(f"无法找到股票 '{stock_name}' 的代码")
-        return None
-    except Exception as e:
-        print(f"获取股票 '{stock_name}' 代码时发生错误: {e}")
-        return None
+            unresolved = [name for name in pending if name not in resolved]
+            for name in unresolved:
+                logger.warning("无法找到股票 '%s' 的代码", name)
+            
+            db.save_stock_aliases(resolved)
+            db.save_stock_name_misses(unresolved, NEGATIVE_CACHE_TTL_MINUTES)
+        
+        result.update(resolved)
+        return result
+    except Exception:
+        logger.exception("批量解析股票代码时发生错误")
+        return result
+
+def get_stock_code(stock_name):
+    """Get stock code by name, with support for both A-shares and HK stocks
+    
+    This is a wrapper around resolve_stock_codes for a single name.
+    """
+    return resolve_stock_codes([stock_name]).get(stock_name)
 
 def update_daily_data(stock_code, days=120):
     """Update daily price data for a single stock
@@ -126,7 +230,7 @@ def update_daily_data(stock_code, days=120):
     Returns:
         bool: Success or failure
     """
-    print(f"更新单只股票 {stock_code} 的历史数据...")
+    logger.debug("更新单只股票 %s 的历史数据...", stock_code)
     
     # Call the batch function with a single stock
     results = update_daily_data_batch([stock_code], days=days)
@@ -134,132 +238,429 @@ def update_daily_data(stock_code, days=120):
     # Return the result for this stock
     return results.get(stock_code, False)
 
-def update_daily_data_batch(stock_codes, days=120):
-    """Update daily price data for multiple stocks at once, supporting both A-shares and HK stocks"""
+def _plan_daily_fetch(watermark, start_date_str, end_date_str, calendar=None):
+    """Work out which date range still has to be downloaded for one stock
+    
+    Args:
+        watermark: Watermark dict from db.get_price_watermarks, or None
+        start_date_str: First date of the requested window (YYYYMMDD)
+        end_date_str: Latest trade date whose bar is expected (YYYYMMDD)
+        calendar: Optional trade_calendar.TradeCalendar of the stock's market;
+            without it every day counts as a possible trading day
+        
+    Returns:
+        tuple: (fetch_start_date, is_full_fetch), or None if the stock is already up to date
+    """
+    if not watermark or not watermark.get('last_trade_date'):
+        # New code: download the full window
+        return start_date_str, True
+    
+    last_trade_date = str(watermark['last_trade_date'])
+    covered_from = watermark.get('covered_from')
+    
+    # Gap detection: the stored range has to start at or before the first
+    # trading day of the window and the watermark has to fall inside the
+    # window, otherwise refetch everything
+    window_start = calendar.first_trade_date_on_or_after(start_date_str) if calendar else start_date_str
+    if not covered_from or covered_from > window_start or last_trade_date < start_date_str:
+        return start_date_str, True
+    
+    # Incremental fetch: only the bars after the watermark, nothing if no
+    # trading day has passed since then
+    if calendar:
+        next_date_str = calendar.next_trade_date(last_trade_date)
+    else:
+        next_date_str = (datetime.strptime(last_trade_date, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+    if next_date_str > end_date_str:
+        return None
+    return next_date_str, False
+
+def _plan_daily_updates(stock_codes, days=120):
+    """Plan the fetches of many stocks from their watermarks and the trading calendars
+    
+    Returns:
+        tuple: (plans, start_date_str, end_dates, calendars) where plans maps
+        every stock that is behind to its (fetch_start_date, is_full_fetch),
+        and end_dates/calendars hold the expected latest trade date and the
+        calendar of each market ('A', 'HK')
+    """
+    start_date_str = (datetime.now() - timedelta(days=days)).strftime('%Y%m%d')
+    trade_calendar.ensure_trade_calendar(get_pro(), start_date_str)
+    
+    calendars = {}
+    end_dates = {}
+    for market, exchange in trade_calendar.MARKET_EXCHANGES.items():
+        calendars[market] = trade_calendar.get_calendar(exchange)
+        end_dates[market] = trade_calendar.get_expected_latest_trade_date(exchange)
+    
+    watermarks = db.get_price_watermarks(stock_codes)
+    plans = {}
+    for stock_code in stock_codes:
+        market = 'HK' if stock_code.endswith('.HK') else 'A'
+        plan = _plan_daily_fetch(watermarks.get(stock_code), start_date_str, end_dates[market],
+                                 calendars[market])
+        if plan is not None:
+            plans[stock_code] = plan
+    return plans, start_date_str, end_dates, calendars
+
+def has_pending_updates(stock_codes, days=120):
+    """Check whether any of the stocks can have bars that are not stored yet"""
+    plans, _, _, _ = _plan_daily_updates(stock_codes, days)
+    return bool(plans)
+
+def _update_single_stock(stock_code, endpoint, market_label, plan, end_date_str, writer):
+    """Fetch the planned date range of one stock and queue it on the writer, returning success"""
+    fetch_start_str, is_full_fetch = plan
+    try:
+        logger.debug("获取%s %s 的历史数据 (%s - %s)...", market_label, stock_code, fetch_start_str, end_date_str)
+        hist_data = fetcher.call_api(get_pro(), endpoint,
+                                     ts_code=stock_code,
+                                     start_date=fetch_start_str,
+                                     end_date=end_date_str)
+        
+        if hist_data is None or hist_data.empty:
+            if is_full_fetch:
+                logger.warning("%s %s 在指定日期范围内没有数据", market_label, stock_code)
+                return False
+            # Nothing new since the watermark (e.g. market still open or a holiday)
+            logger.debug("%s %s 没有新的数据", market_label, stock_code)
+            return True
+            
+        logger.debug("成功获取%s %s 的 %d 条历史数据记录", market_label, stock_code, len(hist_data))
+        
+        # Hand the bars to the writer thread and move on to the next request
+        coverage = {stock_code: fetch_start_str} if is_full_fetch else None
+        writer.put(hist_data, codes=[stock_code], coverage=coverage)
+        return True
+        
+    except Exception as e:
+        logger.warning("获取%s %s 的数据时发生错误: %s", market_label, stock_code, e)
+        return False
+
+def _candidate_trade_dates(start_date_str, end_date_str, calendar=None):
+    """List the possible trading days between two dates (YYYYMMDD), oldest first
+    
+    These are the calendar's trading days, or every weekday without a calendar.
+    """
+    if calendar:
+        return calendar.trade_dates(start_date_str, end_date_str)
+    dates = []
+    current = datetime.strptime(start_date_str, '%Y%m%d')
+    end = datetime.strptime(end_date_str, '%Y%m%d')
+    while current <= end:
+        if current.weekday() < 5:
+            dates.append(current.strftime('%Y%m%d'))
+        current += timedelta(days=1)
+    return dates
+
+def _choose_fetch_modes(plans, end_date_str, calendar=None):
+    """Split the planned stocks between stock-major and date-major fetching
+    
+    A date-major call returns every stock of the market for one trade_date, so
+    the stocks whose fetch range starts on or after a cutoff date are fetched as
+    one call per trading day since the cutoff, and the rest one call per stock.
+    The cutoff is chosen to minimise the weighted number of API calls, which
+    switches to date-major when many stocks miss only a few days.
+    
+    Returns:
+        tuple: (stock_major_codes, date_major_codes, trade_dates)
+    """
+    codes = sorted(plans, key=lambda code: plans[code][0])
+    best_cost = len(codes)  # Everything stock-major
+    best_index = len(codes)
+    best_dates = []
+    
+    for index, code in enumerate(codes):
+        if index > 0 and plans[codes[index - 1]][0] == plans[code][0]:
+            continue
+        trade_dates = _candidate_trade_dates(plans[code][0], end_date_str, calendar)
+        cost = index + len(trade_dates) * DATE_MAJOR_CALL_WEIGHT
+        if cost < best_cost:
+            best_cost, best_index, best_dates = cost, index, trade_dates
+    
+    return codes[:best_index], codes[best_index:], best_dates
+
+def _update_stocks_date_major(plans, endpoint, market_label, trade_dates, writer, max_workers=None,
+                              progress=None):
+    """Fetch the planned stocks with one cross-sectional call per trade date
+    
+    The market-wide result of every call is filtered down to the tracked stocks
+    and queued on the writer as soon as it arrives. Bars of the dates after a
+    failed one are still written, so the watermarks of the affected stocks are
+    rewound to before the earliest failed date for the next refresh to fetch it.
+    """
+    progress = progress or events.ProgressReporter(enabled=False)
+    codes = set(plans)
+    
+    def fetch_trade_date(trade_date):
+        if progress.is_cancelled():
+            return None
+        try:
+            day_data = fetcher.call_api(get_pro(), endpoint, trade_date=trade_date)
+        except Exception as e:
+            logger.warning("获取%s %s 的全市场数据时发生错误: %s", market_label, trade_date, e)
+            return None
+        finally:
+            progress.advance('calls')
+        
+        if day_data is None or day_data.empty:
+            # Non-trading day or data not published yet
+            return day_data
+        day_data = day_data[day_data['ts_code'].isin(codes)]
+        if not day_data.empty:
+            writer.put(day_data)
+        return day_data
+    
+    logger.debug("按日期批量获取%s %d 只股票 %d 个交易日的数据...", market_label, len(codes), len(trade_dates))
+    day_results = fetcher.fetch_many(fetch_trade_date, trade_dates, max_workers=max_workers)
+    
+    failed_dates = [trade_date for trade_date, day_data in day_results.items()
+                    if day_data is None or day_data is False]
+    frames = [day_data for day_data in day_results.values()
+              if day_data is not None and day_data is not False and not day_data.empty]
+    
+    fetched_codes = set()
+    for frame in frames:
+        fetched_codes.update(frame['ts_code'].unique())
+    
+    results = {}
+    coverage = {}
+    rewind = {}
+    for stock_code, (fetch_start_str, is_full_fetch) in plans.items():
+        missed_dates = [trade_date for trade_date in failed_dates if trade_date >= fetch_start_str]
+        if missed_dates:
+            results[stock_code] = False
+            # A full fetch is retried as a whole; an incremental one from the first missing date
+            rewind[stock_code] = fetch_start_str if is_full_fetch else min(missed_dates)
+        elif is_full_fetch and stock_code not in fetched_codes:
+            logger.warning("%s %s 在指定日期范围内没有数据", market_label, stock_code)
+            results[stock_code] = False
+        else:
+            results[stock_code] = True
+            if is_full_fetch:
+                coverage[stock_code] = fetch_start_str
+    
+    if frames:
+        total_rows = sum(len(frame) for frame in frames)
+        logger.debug("成功获取%s %d 只股票的 %d 条历史数据记录", market_label, len(fetched_codes), total_rows)
+    
+    # Coverage and rewinds are applied only once every trade date of the range has been queued
+    writer.put(codes=list(results), coverage=coverage, rewind=rewind)
+    progress.advance('fetched', len(results))
+    return results
+
+def _update_market(stock_codes, plans, endpoint, market_label, end_date_str, writer, max_workers=None,
+                   progress=None, calendar=None):
+    """Update one market's stocks, choosing stock-major or date-major fetching"""
+    progress = progress or events.ProgressReporter(enabled=False)
+    results = {}
+    market_plans = {code: plans[code] for code in stock_codes if code in plans}
+    if not market_plans:
+        return results
+    
+    logger.debug("处理%s数据...", market_label)
+    stock_major_codes, date_major_codes, trade_dates = _choose_fetch_modes(market_plans, end_date_str, calendar)
+    logger.info("%s: 按股票获取 %d 只，按日期获取 %d 只", market_label, len(stock_major_codes), len(date_major_codes))
+    progress.add_total('calls', len(stock_major_codes) + (len(trade_dates) if date_major_codes else 0))
+    
+    if date_major_codes:
+        date_major_plans = {code: market_plans[code] for code in date_major_codes}
+        results.update(_update_stocks_date_major(
+            date_major_plans, endpoint, market_label, trade_dates, writer, max_workers=max_workers,
+            progress=progress))
+    
+    def update_stock(stock_code):
+        if progress.is_cancelled():
+            return False
+        try:
+            return _update_single_stock(stock_code, endpoint, market_label, market_plans[stock_code],
+                                        end_date_str, writer)
+        finally:
+            progress.advance('calls')
+            progress.advance('fetched')
+    
+    if stock_major_codes:
+        # Fetch the remaining stocks concurrently, sharing the endpoint's rate limit
+        results.update(fetcher.fetch_many(update_stock, stock_major_codes, max_workers=max_workers))
+    
+    return results
+
+def update_daily_data_batch(stock_codes, days=120, max_workers=None, progress=None):
+    """Update daily price data for multiple stocks at once, supporting both A-shares and HK stocks
+    
+    Each stock keeps a watermark (its last stored trade_date), so a refresh only
+    asks Tushare for the bars after the watermark, up to the latest trading day
+    of its market (see trade_calendar); stocks that already have that day's bar
+    cost no API call. The full window is fetched for
+    new codes or when a gap between the stored data and the window is detected.
+    Depending on the number of stocks and missing days, bars are fetched per
+    stock or per trade date (whole market in one call), on a pool of
+    max_workers threads (default fetcher.DEFAULT_WORKERS) that share each
+    endpoint's rate limit. Fetchers stream their DataFrames to a single writer
+    thread (see pipeline.PriceWritePipeline), so downloads and database writes
+    overlap; the counters of the last run are available from
+    get_last_update_stats(). Fetched stocks, API calls and written rows are
+    reported to the optional events.ProgressReporter.
+    """
+    global _last_update_stats
+    
     if not stock_codes:
         return {}
+    
+    progress = progress or events.ProgressReporter(enabled=False)
         
-    print(f"批量获取 {len(stock_codes)} 只股票的历史数据...")
+    logger.info("批量获取 %d 只股票的历史数据...", len(stock_codes))
     
     # Separate A-shares and HK stocks
     a_stock_codes = [code for code in stock_codes if not code.endswith('.HK')]
     hk_stock_codes = [code for code in stock_codes if code.endswith('.HK')]
     
-    print(f"其中A股 {len(a_stock_codes)} 只，港股 {len(hk_stock_codes)} 只")
-    
-    # Calculate date range
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days)
-    
-    # Format dates for Tushare
-    start_date_str = start_date.strftime('%Y%m%d')
-    end_date_str = end_date.strftime('%Y%m%d')
+    logger.info("其中A股 %d 只，港股 %d 只", len(a_stock_codes), len(hk_stock_codes))
     
     results = {}
     
     try:
-        # Process A-shares
-        if a_stock_codes:
-            print("处理A股数据...")
-            chunk_size = 50
-            
-            for i in range(0, len(a_stock_codes), chunk_size):
-                chunk = a_stock_codes[i:i+chunk_size]
-                print(f"正在处理第 {i//chunk_size + 1} 批A股数据 ({len(chunk)} 只)...")
-                
-                for stock_code in chunk:
-                    try:
-                        print(f"  获取A股 {stock_code} 的历史数据...")
-                        hist_data = pro.daily(ts_code=stock_code, 
-                                          start_date=start_date_str, 
-                                          end_date=end_date_str)
-                        
-                        if hist_data.empty:
-                            print(f"  A股 {stock_code} 在指定日期范围内没有数据")
-                            results[stock_code] = False
-                            continue
-                            
-                        print(f"  成功获取A股 {stock_code} 的 {len(hist_data)} 条历史数据记录")
-                        
-                        # Save to database
-                        success = db.save_daily_price(hist_data)
-                        results[stock_code] = success
-                        
-                    except Exception as e:
-                        print(f"  获取或保存A股 {stock_code} 的数据时发生错误: {e}")
-                        results[stock_code] = False
-        
-        # Process Hong Kong stocks
-        if hk_stock_codes:
-            print("处理港股数据...")
-            chunk_size = 30  # Smaller chunks for HK stocks as they might have different limits
+        # Plan the fetch range of every stock from its watermark, up to the
+        # latest trade date of its market whose bar can exist by now
+        plans, _, end_dates, calendars = _plan_daily_updates(stock_codes, days)
+        for stock_code in stock_codes:
+            if stock_code not in plans:
+                # Already up to date, nothing to download
+                results[stock_code] = True
+        
+        full_count = sum(1 for _, is_full_fetch in plans.values() if is_full_fetch)
+        logger.info("全量获取 %d 只，增量获取 %d 只，已是最新 %d 只",
+                    full_count, len(plans) - full_count, len(stock_codes) - len(plans))
+        progress.advance('fetched', len(stock_codes) - len(plans))
+        
+        fetch_results = {}
+        on_flush = lambda written_rows, codes: progress.advance('written_rows', written_rows)
+        with pipeline.PriceWritePipeline(on_flush=on_flush) as writer:
+            # Process A-shares
+            fetch_results.update(_update_market(a_stock_codes, plans, 'daily', 'A股', end_dates['A'],
+                                                writer, max_workers=max_workers, progress=progress,
+                                                calendar=calendars['A']))
             
-            for i in range(0, len(hk_stock_codes), chunk_size):
-                chunk = hk_stock_codes[i:i+chunk_size]
-                print(f"正在处理第 {i//chunk_size + 1} 批港股数据 ({len(chunk)} 只)...")
-                
-                for stock_code in chunk:
-                    try:
-                        print(f"  获取港股 {stock_code} 的历史数据...")
-                        # Use hk_daily for Hong Kong stocks
-                        hist_data = pro.hk_daily(ts_code=stock_code,
-                                               start_date=start_date_str,
-                                               end_date=end_date_str)
-                        
-                        if hist_data.empty:
-                            print(f"  港股 {stock_code} 在指定日期范围内没有数据")
-                            results[stock_code] = False
-                            continue
-                            
-                        print(f"  成功获取港股 {stock_code} 的 {len(hist_data)} 条历史数据记录")
-                        
-                        # Save to database
-                        success = db.save_daily_price(hist_data)
-                        results[stock_code] = success
-                        
-                    except Exception as e:
-                        print(f"  获取或保存港股 {stock_code} 的数据时发生错误: {e}")
-                        results[stock_code] = False
+            # Process Hong Kong stocks with hk_daily (its own rate limit applies)
+            fetch_results.update(_update_market(hk_stock_codes, plans, 'hk_daily', '港股', end_dates['HK'],
+                                                writer, max_workers=max_workers, progress=progress,
+                                                calendar=calendars['HK']))
+        
+        # A stock succeeded if it was fetched and every batch holding its bars committed
+        for stock_code, fetched in fetch_results.items():
+            results[stock_code] = bool(fetched) and writer.is_written(stock_code)
+        
+        _last_update_stats = writer.get_stats()
+        logger.info("写入完成: %d 条记录，%d 个批次，获取 %.0f 条/秒，写入 %.0f 条/秒，队列阻塞 %.2f 秒",
+                    _last_update_stats['written_rows'], _last_update_stats['batches'],
+                    _last_update_stats['fetch_rows_per_second'], _last_update_stats['write_rows_per_second'],
+                    _last_update_stats['put_wait_seconds'])
         
         return results
         
-    except Exception as e:
-        print(f"批量获取股票数据过程中发生错误: {e}")
+    except Exception:
+        logger.exception("批量获取股票数据过程中发生错误")
         return {code: False for code in stock_codes}
 
-def get_all_sector_stocks_data(days=120):
-    """Get all sector stocks data in a single operation"""
-    print("\n======== 开始一次性获取所有行业股票数据 ========")
+def get_last_update_stats():
+    """Get the fetch/write pipeline counters of the most recent batch update"""
+    return dict(_last_update_stats)
+
+def save_sector_snapshot(sector_data, sectors=None):
+    """Save the sector data as a new snapshot and announce its version
+    
+    Args:
+        sector_data: Dict sector -> list of stock dicts (every sector)
+        sectors: Optional list of the sectors that changed, announced with the
+            version when only part of the snapshot was recomputed
+    
+    Returns:
+        int: Version of the new snapshot
+    """
+    version = db.save_sector_snapshot(sector_data)
+    event = {
+        'version': version,
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    if sectors is not None:
+        event['sectors'] = sorted(sectors)
+    events.publish('data_version', event)
+    return version
+
+def get_sector_stock_codes(sectors=None):
+    """Resolve the codes of every stock listed in SECTORS
+    
+    Args:
+        sectors: Optional sector names to limit the stocks to
+    
+    Returns:
+        list: Unique ts_codes of the resolved sector stocks
+    """
+    all_stocks = set()
+    for sector, stocks in SECTORS.items():
+        if sectors is None or sector in sectors:
+            all_stocks.update(stocks)
+    resolved_codes = resolve_stock_codes(all_stocks)
+    return sorted({code for code in resolved_codes.values() if code})
+
+def get_current_sector_snapshot():
+    """Get the latest snapshot if nothing it was built from has changed since
+    
+    That is, it covers every sector, was built today (so its price window is
+    today's) and no bars have been written after it.
+    
+    Returns:
+        tuple: (version, sector data), or None
+    """
+    snapshot, created_at, version = db.get_latest_sector_snapshot()
+    if snapshot is None or not all(sector in snapshot for sector in SECTORS):
+        return None
+    
+    created_at = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+    last_write = db.get_last_price_write_time()
+    if created_at.date() != datetime.now().date() or (last_write and last_write > created_at):
+        return None
+    return version, {sector: snapshot[sector] for sector in SECTORS}
+
+def get_all_sector_stocks_data(days=120, progress=None, codes=None):
+    """Get all sector stocks data in a single operation
+    
+    Progress (stocks resolved, fetched, rows written, sectors computed and the
+    ETA) is published as 'progress' events, see events.ProgressReporter.
+    A refresh that cannot produce new data (no trading day since the stored
+    bars, see trade_calendar) returns the current snapshot without fetching.
+    
+    Args:
+        days: Length of the price window
+        progress: Optional events.ProgressReporter
+        codes: Optional ts_codes to fetch (e.g. one market); the other stocks
+            are assembled from their stored bars. None fetches every stock.
+    """
+    logger.info("======== 开始一次性获取所有行业股票数据 ========")
+    progress = progress or events.ProgressReporter()
     try:
-        # First update stock basic data
-        print("更新股票基本信息...")
-        update_stock_basic_data()
-        
         # Get all unique stocks from all sectors
         all_stocks = set()
         for sector, stocks in SECTORS.items():
             all_stocks.update(stocks)
         
-        print(f"总共需要获取 {len(all_stocks)} 只股票数据")
+        logger.info("总共需要获取 %d 只股票数据", len(all_stocks))
+        progress.stage('resolving', stocks=len(all_stocks))
         
-        # Get all stock codes first
-        print("获取所有股票代码...")
-        stock_codes = {}  # Dictionary mapping stock name to stock code
-        stock_names = {}  # Reverse mapping from code to name
-        missing_stocks = []
-        
-        for stock_name in all_stocks:
-            code = get_stock_code(stock_name)
-            if code:
-                stock_codes[stock_name] = code
-                stock_names[code] = stock_name
-            else:
-                missing_stocks.append(stock_name)
+        # Resolve all stock codes in one batch (stock basic data is only
+        # downloaded again if names are missing and the TTL has passed)
+        logger.debug("获取所有股票代码...")
+        resolved_codes = resolve_stock_codes(all_stocks)
+        stock_codes = {name: code for name, code in resolved_codes.items() if code}  # Stock name -> code
+        stock_names = {code: name for name, code in stock_codes.items()}  # Reverse mapping from code to name
+        missing_stocks = [name for name, code in resolved_codes.items() if not code]
                 
         if missing_stocks:
-            print(f"警告: 未找到 {len(missing_stocks)} 只股票的代码")
+            logger.warning("未找到 %d 只股票的代码", len(missing_stocks))
             
-        print(f"成功获取 {len(stock_codes)} 只股票代码")
+        logger.info("成功获取 %d 只股票代码", len(stock_codes))
+        progress.advance('resolved', len(stock_codes))
+        progress.raise_if_cancelled()
         
         # Calculate date range for all stocks
         end_date = datetime.now()
@@ -268,127 +669,259 @@ def get_all_sector_stocks_data(days=120):
         end_date_str = end_date.strftime('%Y%m%d')
         
         # Batch update all stock data at once
-        print(f"批量更新所有股票从 {start_date_str} 到 {end_date_str} 的历史数据...")
+        logger.info("批量更新所有股票从 %s 到 %s 的历史数据...", start_date_str, end_date_str)
         code_list = list(stock_codes.values())
-        update_results = update_daily_data_batch(code_list, days=days)
+        if codes is None:
+            fetch_codes = code_list
+        else:
+            requested = set(codes)
+            fetch_codes = [code for code in code_list if code in requested]
+        
+        # Skip the refresh entirely when no trading day has passed since the
+        # stored bars and the latest snapshot already reflects them
+        current = get_current_sector_snapshot()
+        if current is not None and not has_pending_updates(fetch_codes, days):
+            version, result = current
+            logger.info("所有股票已有最新交易日的数据，快照 (版本 %s) 无需更新，跳过本次刷新", version)
+            progress.finish('skipped', version=version)
+            return result
+        
+        progress.stage('fetching', fetched=len(fetch_codes))
+        update_results = update_daily_data_batch(fetch_codes, days=days, progress=progress)
         
         # Check update statistics
         update_success_count = sum(1 for success in update_results.values() if success)
         update_fail_count = len(update_results) - update_success_count
-        print(f"数据更新结果: {update_success_count} 成功, {update_fail_count} 失败")
+        logger.info("数据更新结果: %d 成功, %d 失败", update_success_count, update_fail_count)
+        progress.raise_if_cancelled()
         
-        # Create the result data structure
-        result = {}
-        for sector, stock_names_list in SECTORS.items():
-            print(f"处理 {sector} 行业的 {len(stock_names_list)} 只股票数据...")
-            sector_data = []
-            
-            for stock_name in stock_names_list:
-                stock_code = stock_codes.get(stock_name)
-                if not stock_code:
-                    print(f"  - 跳过 {stock_name}: 未找到股票代码")
-                    continue
-                
-                # Check if this stock was successfully updated
-                if stock_code in update_results and not update_results[stock_code]:
-                    print(f"  - 跳过 {stock_name}: 数据更新失败")
-                    continue
-                
-                # Retrieve data from database (should be already updated)
-                try:
-                    # Get latest price from database
-                    latest_price_df = db.get_daily_prices(stock_code, limit=1)
-                    if latest_price_df.empty:
-                        print(f"  - 跳过 {stock_name}: 无法获取最新价格")
-                        continue
-                    
-                    latest_price = latest_price_df['close'].values[0]
-                    latest_volume = latest_price_df['vol'].values[0]  # Get latest volume
-                    
-                    # Get all data for the period to find highest price and max volume
-                    hist_data = db.get_daily_prices(stock_code, start_date_str, end_date_str)
-                    if hist_data.empty:
-                        print(f"  - 跳过 {stock_name}: 无法获取历史数据")
-                        continue
-                        
-                    # Find highest price
-                    hist_data = hist_data.sort_values('trade_date')
-                    highest_price_row = hist_data.loc[hist_data['high'].idxmax()]
-                    highest_price = highest_price_row['high']
-                    highest_date = highest_price_row['trade_date']
-                    
-                    # Find maximum volume over 4 months
-                    max_volume = hist_data['vol'].max()
-                    
-                    # Calculate volume ratio
-                    volume_ratio = (latest_volume / max_volume * 100) if max_volume > 0 else 0
-                    
-                    # Convert date format for display, fixing future dates
-                    try:
-                        formatted_date = datetime.strptime(str(highest_date), '%Y%m%d')
-                        # Check if date is in the future
-                        if formatted_date > datetime.now():
-                            print(f"  注意: 检测到未来日期 {highest_date}，使用当前日期代替")
-                            formatted_date = datetime.now()
-                        formatted_date = formatted_date.strftime('%Y-%m-%d')
-                    except Exception as e:
-                        print(f"  日期格式化错误: {e}")
-                        formatted_date = datetime.now().strftime('%Y-%m-%d')
-                    
-                    # Get maximum increase
-                    hist_data['pct_chg'] = hist_data['pct_chg'].astype(float)
-                    max_increase = hist_data['pct_chg'].max()
-                    
-                    # Calculate drop percentage
-                    drop_percentage = calculate_drop_percentage(latest_price, highest_price)
-                    
-                    # Add stock data to sector (including new volume metrics)
-                    sector_data.append({
-                        'name': stock_name,
-                        'code': stock_code,
-                        'latest_price': latest_price,
-                        'highest_price': highest_price,
-                        'highest_date': formatted_date,
-                        'max_4m_increase': max_increase,  # Changed from max_3m_increase
-                        'drop_percentage': drop_percentage,
-                        'latest_volume': latest_volume,
-                        'max_volume': max_volume,
-                        'volume_ratio': volume_ratio
-                    })
-                    print(f"  + 成功处理 {stock_name} 数据")
-                    
-                except Exception as e:
-                    print(f"  - 处理 {stock_name} 数据时出错: {e}")
-            
-            # Add sector results
-            print(f"成功处理 {sector} 行业 {len(sector_data)} 只股票数据 (共 {len(stock_names_list)} 只)")
-            
-            # Calculate sector score
-            sector_score = calculate_sector_score(sector_data)
-            
-            # Add score to each stock
-            for stock in sector_data:
-                stock['sector_score'] = sector_score
-                
-            result[sector] = sector_data
-            
-            # Save sector data to database
-            db.save_sector_data(sector, sector_data)
+        # The per-stock aggregates are maintained in stock_metrics as bars are
+        # written; other window lengths are computed from the raw bars
+        progress.stage('computing', sectors=len(SECTORS))
+        usable_codes = [code for code in code_list if update_results.get(code, True)]
+        metrics_frame = get_window_metrics(usable_codes, days, start_date_str, end_date_str)
+        stock_records = metrics.build_stock_records(metrics_frame)
+        logger.info("计算完成 %d 只股票的指标", len(stock_records))
+        
+        # Assemble sectors by lookup
+        result = build_sector_data(SECTORS, stock_codes, stock_records, update_results)
+        progress.advance('sectors', len(result))
+        
+        # Save all sectors as one snapshot
+        progress.raise_if_cancelled()
+        progress.stage('saving')
+        version = save_sector_snapshot(result)
+        logger.info("已保存行业数据快照 (版本 %s)", version)
         
         # Final report
         total_stocks_processed = sum(len(stocks) for stocks in result.values())
-        print(f"======== 所有行业股票数据获取完成 ========")
-        print(f"总计: {len(all_stocks)} 只股票")
-        print(f"处理成功: {total_stocks_processed} 只")
-        print(f"未找到代码: {len(missing_stocks)} 只")
-        print(f"更新失败: {update_fail_count} 只")
+        logger.info("======== 所有行业股票数据获取完成 ======== 总计: %d 只股票，处理成功: %d 只，"
+                    "未找到代码: %d 只，更新失败: %d 只", len(all_stocks), total_stocks_processed,
+                    len(missing_stocks), update_fail_count)
+        progress.finish('done', version=version, missing=len(missing_stocks), failed=update_fail_count)
         
         return result
         
+    except events.Cancelled:
+        logger.info("获取所有行业股票数据已取消，保留上一次的数据快照")
+        progress.finish('cancelled')
+        return {}
     except Exception as e:
-        print(f"获取所有行业股票数据时发生错误: {e}")
+        logger.exception("获取所有行业股票数据时发生错误")
+        progress.finish('failed', error=str(e))
         return {}
 
+def refresh_sector_stocks(codes, days=120, progress=None):
+    """Refresh only some stocks and recompute only the sectors that contain them
+    
+    The bars of the given codes are fetched, the affected sectors are rebuilt
+    from the stored metrics of their stocks, and the result is saved as a new
+    snapshot that keeps every other sector of the latest one. Without a
+    complete snapshot to start from, all sectors are assembled (still fetching
+    only the given codes).
+    
+    Args:
+        codes: ts_codes to refresh
+        days: Length of the price window
+        progress: Optional events.ProgressReporter
+    
+    Returns:
+        dict: The recomputed sectors -> list of stock dicts ({} on failure)
+    """
+    snapshot, _, _ = db.get_latest_sector_snapshot()
+    if snapshot is None or not all(sector in snapshot for sector in SECTORS):
+        logger.info("没有完整的行业数据快照，改为组装所有行业")
+        return get_all_sector_stocks_data(days=days, progress=progress, codes=codes)
+    
+    progress = progress or events.ProgressReporter()
+    requested = set(codes)
+    try:
+        progress.stage('resolving', stocks=len(requested))
+        all_stocks = set()
+        for stocks in SECTORS.values():
+            all_stocks.update(stocks)
+        resolved_codes = resolve_stock_codes(all_stocks)
+        stock_codes = {name: code for name, code in resolved_codes.items() if code}
+        
+        # Only sectors holding one of the requested stocks are recomputed
+        sectors = {sector: stocks for sector, stocks in SECTORS.items()
+                   if any(stock_codes.get(name) in requested for name in stocks)}
+        fetch_codes = sorted(requested & set(stock_codes.values()))
+        progress.advance('resolved', len(fetch_codes))
+        if not sectors:
+            logger.info("要刷新的 %d 只股票不属于任何行业", len(requested))
+            progress.finish('done', sectors=[])
+            return {}
+        logger.info("======== 刷新 %d 只股票，涉及 %d 个行业 ========", len(fetch_codes), len(sectors))
+        progress.raise_if_cancelled()
+        
+        current = get_current_sector_snapshot()
+        if current is not None and not has_pending_updates(fetch_codes, days):
+            version, result = current
+            logger.info("这些股票已有最新交易日的数据，快照 (版本 %s) 无需更新，跳过本次刷新", version)
+            progress.finish('skipped', version=version)
+            return {sector: result[sector] for sector in sectors}
+        
+        progress.stage('fetching', fetched=len(fetch_codes))
+        update_results = update_daily_data_batch(fetch_codes, days=days, progress=progress)
+        progress.raise_if_cancelled()
+        
+        # Every stock of an affected sector is needed for its sector score
+        progress.stage('computing', sectors=len(sectors))
+        sector_codes = {stock_codes[name] for stocks in sectors.values() for name in stocks
+                        if name in stock_codes}
+        usable_codes = [code for code in sector_codes if update_results.get(code, True)]
+        start_date_str = (datetime.now() - timedelta(days=days)).strftime('%Y%m%d')
+        metrics_frame = get_window_metrics(usable_codes, days, start_date_str, datetime.now().strftime('%Y%m%d'))
+        result = build_sector_data(sectors, stock_codes, metrics.build_stock_records(metrics_frame),
+                                   update_results)
+        progress.advance('sectors', len(result))
+        
+        # Keep the other sectors of the latest snapshot as they are
+        progress.raise_if_cancelled()
+        progress.stage('saving')
+        merged = dict(db.get_latest_sector_snapshot()[0])
+        merged.update(result)
+        version = save_sector_snapshot(merged, sectors=list(result))
+        logger.info("已保存行业数据快照 (版本 %s)，更新了 %d 个行业", version, len(result))
+        
+        failed = sum(1 for success in update_results.values() if not success)
+        progress.finish('done', version=version, failed=failed, sectors=sorted(result))
+        return result
+    
+    except events.Cancelled:
+        logger.info("定向刷新已取消，保留上一次的数据快照")
+        progress.finish('cancelled')
+        return {}
+    except Exception as e:
+        logger.exception("定向刷新股票数据时发生错误")
+        progress.finish('failed', error=str(e))
+        return {}
+
+def refresh_sector(sector, days=120, progress=None):
+    """Refresh the stocks of one sector, see refresh_sector_stocks
+    
+    Returns:
+        dict: The recomputed sectors (other sectors sharing a stock are included),
+        or None if the sector does not exist
+    """
+    if sector not in SECTORS:
+        return None
+    return refresh_sector_stocks(get_sector_stock_codes([sector]), days=days, progress=progress)
+
+def refresh_stock(stock_code, days=120, progress=None):
+    """Refresh one stock and the sectors that contain it, see refresh_sector_stocks"""
+    return refresh_sector_stocks([stock_code], days=days, progress=progress)
+
+def get_window_metrics(stock_codes, days, start_date_str, end_date_str):
+    """Get the window aggregates (metrics.METRIC_COLUMNS) of some stocks
+    
+    The default window (METRICS_WINDOW_DAYS, the one the sector views use) is
+    maintained in stock_metrics as bars are written. The price cube is a side
+    path for other window lengths only: they are reduced from the cube when it
+    holds them, and from the raw bars in daily_prices otherwise.
+    """
+    if days == db.METRICS_WINDOW_DAYS:
+        return db.get_stock_metrics(stock_codes, start_date_str)
+    if price_cube.covers(start_date_str):
+        cube = price_cube.get_cube()
+        if cube is not None:
+            return metrics.compute_cube_metrics(cube, stock_codes, start_date_str, end_date_str)
+    prices = db.get_daily_prices_window(stock_codes, start_date_str, end_date_str)
+    return metrics.compute_stock_metrics(prices)
+
+def build_sector_data_from_metrics():
+    """Assemble all sectors from the materialized stock_metrics table without fetching
+    
+    Returns:
+        dict: sector -> list of stock dicts, or None if some resolved stock has
+        no stored metrics yet (a full refresh is needed then)
+    """
+    all_stocks = set()
+    for stocks in SECTORS.values():
+        all_stocks.update(stocks)
+    
+    resolved_codes = resolve_stock_codes(all_stocks)
+    stock_codes = {name: code for name, code in resolved_codes.items() if code}
+    if not stock_codes:
+        return None
+    
+    metrics_frame = db.get_stock_metrics(list(set(stock_codes.values())))
+    if len(metrics_frame) < len(set(stock_codes.values())):
+        return None
+    
+    result = build_sector_data(SECTORS, stock_codes, metrics.build_stock_records(metrics_frame))
+    save_sector_snapshot(result)
+    return result
+
+@instrumentation.METRICS_COMPUTE_SECONDS.timed(step='build_sector_data')
+def build_sector_data(sectors, stock_codes, stock_records, update_results=None):
+    """Assemble the per-sector stock lists from precomputed per-stock records
+    
+    Args:
+        sectors: Dict sector -> list of stock names
+        stock_codes: Dict stock name -> ts_code
+        stock_records: Dict ts_code -> record from metrics.build_stock_records
+        update_results: Optional dict ts_code -> bool of the last data update
+        
+    Returns:
+        dict: sector -> list of stock dicts including the sector score
+    """
+    update_results = update_results or {}
+    result = {}
+    
+    for sector, stock_names_list in sectors.items():
+        sector_data = []
+        
+        for stock_name in stock_names_list:
+            stock_code = stock_codes.get(stock_name)
+            if not stock_code:
+                logger.info("跳过 %s/%s: 未找到股票代码", sector, stock_name)
+                continue
+            
+            # Check if this stock was successfully updated
+            if stock_code in update_results and not update_results[stock_code]:
+                logger.info("跳过 %s/%s: 数据更新失败", sector, stock_name)
+                continue
+            
+            record = stock_records.get(stock_code)
+            if record is None:
+                logger.info("跳过 %s/%s: 无法获取历史数据", sector, stock_name)
+                continue
+            
+            stock = dict(record)
+            stock['name'] = stock_name
+            sector_data.append(stock)
+        
+        # Calculate sector score and add it to each stock
+        sector_score = calculate_sector_score(sector_data)
+        for stock in sector_data:
+            stock['sector_score'] = sector_score
+        
+        result[sector] = sector_data
+    
+    return result
+
 def calculate_drop_percentage(current_price, highest_price):
     """Calculate the drop percentage from highest price to current price"""
     if current_price is None or highest_price is None or highest_price == 0:
@@ -420,54 +953,64 @@ def get_sector_comparison(force_refresh=False):
     # First check if we have fresh data for all sectors
     all_sectors_fresh = True
     if not force_refresh:
-        for sector in SECTORS.keys():
-            data, fetch_time = db.get_latest_sector_data(sector)
-            if data is None:  # No fresh data
-                all_sectors_fresh = False
-                print(f"找不到 {sector} 行业的缓存数据")
-                break
-            result[sector] = data
-            
-            # Log when we're using cached data
-            if fetch_time:
-                print(f"使用缓存的 {sector} 行业数据 (获取时间: {fetch_time})")
+        snapshot, created_at, version = db.get_latest_sector_snapshot()
+        if snapshot is not None and all(sector in snapshot for sector in SECTORS):
+            logger.info("使用缓存的行业数据快照 (版本 %s, 获取时间: %s)", version, created_at)
+            result = {sector: snapshot[sector] for sector in SECTORS}
+        else:
+            for sector in SECTORS.keys():
+                data, fetch_time = db.get_latest_sector_data(sector)
+                if data is None:  # No fresh data
+                    all_sectors_fresh = False
+                    logger.info("找不到 %s 行业的缓存数据", sector)
+                    break
+                result[sector] = data
+                
+                # Log when we're using cached data
+                if fetch_time:
+                    logger.debug("使用缓存的 %s 行业数据 (获取时间: %s)", sector, fetch_time)
     else:
         all_sectors_fresh = False
-        print("强制刷新模式，跳过缓存检查")
+        logger.info("强制刷新模式，跳过缓存检查")
     
     # If all sectors have fresh data, calculate scores and return
     if all_sectors_fresh:
-        print("所有行业数据均从缓存获取，无需重新获取")
+        logger.info("所有行业数据均从缓存获取，无需重新获取")
         
-        # Calculate scores for cached data
-        sector_scores = {}
+        # Add scores to cached data saved without them (the snapshot itself is
+        # shared, so scored copies of the stocks are returned)
         for sector, stocks in result.items():
-            sector_scores[sector] = calculate_sector_score(stocks)
-        
-        # Add scores to result
-        for sector in result:
-            for stock in result[sector]:
-                if isinstance(stock, dict):  # Ensure it's a dict before adding a key
-                    stock['sector_score'] = sector_scores[sector]
+            if all(isinstance(stock, dict) and 'sector_score' in stock for stock in stocks):
+                continue
+            sector_score = calculate_sector_score(stocks)
+            result[sector] = [dict(stock, sector_score=sector_score) if isinstance(stock, dict) else stock
+                              for stock in stocks]
         
         return result
     
     try:
+        # Rebuild missing sectors from the stored per-stock metrics before fetching anything
+        if not force_refresh:
+            metrics_result = build_sector_data_from_metrics()
+            if metrics_result:
+                logger.info("已从股票指标表重建所有行业数据")
+                return metrics_result
+        
         # Otherwise, get fresh data for all sectors
-        print("缓存数据不完整或已过期，重新获取所有行业数据")
+        logger.info("缓存数据不完整或已过期，重新获取所有行业数据")
         result = get_all_sector_stocks_data()
         return result
-    except Exception as e:
-        print(f"获取行业数据时发生错误: {e}")
+    except Exception:
+        logger.exception("获取行业数据时发生错误")
         # Return any partial results we may have
         if result:
-            print(f"返回部分缓存数据 ({len(result)} 个行业)")
+            logger.warning("返回部分缓存数据 (%d 个行业)", len(result))
             return result
         # If no results, create an empty result structure
         empty_result = {}
         for sector in SECTORS.keys():
             empty_result[sector] = []
-        print("没有可用数据，返回空结构")
+        logger.warning("没有可用数据，返回空结构")
         return empty_result
 
 # Ensure stock basic data is up to date when the module is loaded
@@ -0,0 +1,36 @@
+"""
+Shared fixtures of the test suite
+"""
+import os
+import sys
+import tempfile
+
+# Importing db initializes its database, so point it at a scratch file first
+os.environ.setdefault('STOCK_DATA_DB', os.path.join(tempfile.mkdtemp(prefix='stock-tests-'), 'import.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import db
+import fetcher
+import stock_data
+from benchmarks.fake_tushare import FakeTushare, SyntheticUniverse
+
+@pytest.fixture
+def database(tmp_path):
+    """Point db at an empty database of its own"""
+    db.use_database(str(tmp_path / 'stock_data.db'))
+    return db.DB_PATH
+
+@pytest.fixture
+def universe():
+    return SyntheticUniverse(100)
+
+@pytest.fixture
+def fake_pro(universe, database, monkeypatch):
+    """Serve stock_data from a FakeTushare without rate limits"""
+    fake = FakeTushare(universe)
+    monkeypatch.setattr(stock_data, 'pro', fake)
+    monkeypatch.setattr(fetcher, 'ENDPOINT_QUOTAS', {})
+    monkeypatch.setattr(fetcher, 'DEFAULT_QUOTA_PER_MINUTE', 10 ** 9)
+    return fake
@@ -0,0 +1,72 @@
+"""
+Lossless cold tier: the bar codec and the compaction of old daily_prices rows
+"""
+import numpy as np
+import pandas as pd
+
+import db
+import price_codec
+from benchmarks.fake_tushare import SyntheticUniverse
+
+# Calendar days of synthetic history, reaching well past the compaction horizon
+HISTORY_DAYS = 800
+
+# Horizon of the compaction under test
+HORIZON_DAYS = 365
+
+def test_encode_decode_round_trip_is_exact():
+    bars = pd.DataFrame({
+        'trade_date': ['20240104', '20240102', '20240103', '20240108'],
+        'open': [10.01, 9.87, None, 10.5],
+        'high': [10.2, 10.0, np.nan, 10.75],
+        'low': [9.9, 9.8, np.nan, 10.1],
+        'close': [10.05, 9.95, np.nan, 10.66],
+        'pre_close': [9.95, 10.1, 10.05, 10.05],
+        'change': [0.1, -0.15, None, 0.61],
+        'pct_chg': [1.005, -1.4851, np.nan, 6.0697],
+        'vol': [123456789.0, 98765432.12, 0.0, 2 ** 40 + 0.5],
+        # A value no decimal scaling keeps exact is stored as raw float64
+        'amount': [1 / 3, 1.5e11, np.nan, -2.25],
+    })
+    
+    decoded = price_codec.decode_bars(price_codec.encode_bars(bars))
+    
+    expected = bars.sort_values('trade_date', ignore_index=True).astype({'trade_date': str})
+    expected[price_codec.BAR_FIELDS] = expected[price_codec.BAR_FIELDS].astype(np.float64)
+    pd.testing.assert_frame_equal(decoded, expected, check_exact=True)
+
+def test_compaction_keeps_every_bar(database):
+    universe = SyntheticUniverse(6, history_days=HISTORY_DAYS)
+    codes = list(universe.codes)
+    assert db.upsert_daily_prices(universe.bars(codes)) is not None
+    # Holes and a negative change inside the compacted years
+    with db.transaction() as conn:
+        conn.execute('UPDATE daily_prices SET vol = NULL, amount = NULL WHERE trade_date = ?',
+                     (universe.trade_dates[3],))
+        conn.execute('UPDATE daily_prices SET change = -1.23 WHERE trade_date = ?', (universe.trade_dates[4],))
+    
+    cutoff = db.get_cold_horizon_start(HORIZON_DAYS)
+    middle = universe.trade_dates[len(universe.trade_dates) // 2]
+    reads = [
+        lambda: [db.get_daily_prices(code) for code in codes],
+        lambda: [db.get_daily_prices(code, start_date=universe.trade_dates[10], end_date=middle) for code in codes],
+        lambda: [db.get_daily_prices(codes[0], end_date=cutoff, limit=30)],
+        lambda: [db.get_daily_prices_window(codes, universe.trade_dates[0], middle)],
+    ]
+    before = [read() for read in reads]
+    
+    result = db.compact_cold_history(HORIZON_DAYS)
+    assert result['rows'] > 0 and result['blobs'] > 0
+    with db.get_connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM daily_prices WHERE trade_date < ?', (cutoff,)).fetchone()[0] == 0
+    
+    for read, expected in zip(reads, before):
+        for frame, expected_frame in zip(read(), expected):
+            pd.testing.assert_frame_equal(
+                frame.sort_values(['ts_code', 'trade_date'], ignore_index=True),
+                expected_frame.sort_values(['ts_code', 'trade_date'], ignore_index=True),
+                check_dtype=False, check_exact=True
+            )
+    
+    # Nothing is left to move
+    assert db.compact_cold_history(HORIZON_DAYS)['rows'] == 0
@@ -0,0 +1,97 @@
+"""
+Failed downloads and writes of daily bars are fetched again by the next refresh
+"""
+import functools
+
+import pandas as pd
+import pytest
+
+import db
+import fetcher
+import pipeline
+import stock_data
+import trade_calendar
+from benchmarks.fake_tushare import FakeTushare
+
+# Trading days the watermarks are moved back before the refresh under test
+REWOUND_DAYS = 5
+
+class FailingTushare(FakeTushare):
+    """FakeTushare whose market-wide daily call fails for one trade date"""
+    
+    def __init__(self, universe):
+        super().__init__(universe)
+        self.failing_date = None
+    
+    def daily(self, trade_date=None, **kwargs):
+        if trade_date is not None and trade_date == self.failing_date:
+            raise RuntimeError(f'simulated failure of {trade_date}')
+        return super().daily(trade_date=trade_date, **kwargs)
+
+@pytest.fixture
+def market(universe, fake_pro, monkeypatch):
+    fake = FailingTushare(universe)
+    monkeypatch.setattr(stock_data, 'pro', fake)
+    
+    codes = universe.market_codes(False)
+    assert all(stock_data.update_daily_data_batch(codes).values())
+    
+    # Forget the last few trading days, so the next refresh fetches them per trade date
+    end_date = trade_calendar.get_expected_latest_trade_date('SSE')
+    trade_dates = [date for date in universe.trade_dates if date <= end_date]
+    rewound = trade_dates[-REWOUND_DAYS - 1]
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM daily_prices WHERE trade_date > ?', (rewound,))
+        conn.execute('UPDATE price_watermarks SET last_trade_date = ?', (rewound,))
+    return fake, codes, trade_dates[-REWOUND_DAYS:]
+
+def _bar_count(trade_date):
+    with db.get_connection() as conn:
+        return conn.execute('SELECT COUNT(*) FROM daily_prices WHERE trade_date = ?', (trade_date,)).fetchone()[0]
+
+def test_failed_trade_date_is_fetched_by_the_next_refresh(market):
+    fake, codes, missing_dates = market
+    failing_date = fake.failing_date = missing_dates[1]
+    
+    results = stock_data.update_daily_data_batch(codes)
+    assert not any(results.values())
+    assert _bar_count(failing_date) == 0
+    # The later dates were written, but the watermarks stay before the failed one
+    assert _bar_count(missing_dates[-1]) == len(codes)
+    watermarks = db.get_price_watermarks(codes)
+    assert all(watermark['last_trade_date'] < failing_date for watermark in watermarks.values())
+    
+    fake.failing_date = None
+    results = stock_data.update_daily_data_batch(codes)
+    assert all(results.values())
+    for trade_date in missing_dates:
+        assert _bar_count(trade_date) == len(codes)
+
+def test_failed_write_batch_is_fetched_by_the_next_refresh(market, monkeypatch):
+    fake, codes, missing_dates = market
+    failing_date = missing_dates[1]
+    upsert_daily_prices = db.upsert_daily_prices
+    
+    def failing_upsert(data, coverage=None, rewind=None):
+        frames = [data] if isinstance(data, pd.DataFrame) else list(data)
+        if any((frame['trade_date'].astype(str) == failing_date).any() for frame in frames):
+            return None
+        return upsert_daily_prices(data, coverage=coverage, rewind=rewind)
+    
+    # One batch per frame, so the batches of the later dates commit after the failed one
+    monkeypatch.setattr(db, 'upsert_daily_prices', failing_upsert)
+    monkeypatch.setattr(pipeline, 'PriceWritePipeline', functools.partial(pipeline.PriceWritePipeline, batch_rows=1))
+    monkeypatch.setattr(fetcher, 'DEFAULT_WORKERS', 1)
+    
+    results = stock_data.update_daily_data_batch(codes)
+    assert not any(results.values())
+    assert _bar_count(failing_date) == 0
+    assert _bar_count(missing_dates[-1]) == len(codes)
+    watermarks = db.get_price_watermarks(codes)
+    assert all(watermark['last_trade_date'] < failing_date for watermark in watermarks.values())
+    
+    monkeypatch.setattr(db, 'upsert_daily_prices', upsert_daily_prices)
+    results = stock_data.update_daily_data_batch(codes)
+    assert all(results.values())
+    for trade_date in missing_dates:
+        assert _bar_count(trade_date) == len(codes)
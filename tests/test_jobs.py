@@ -0,0 +1,65 @@
+"""
+Single-flight refresh jobs: overlapping submissions share a job
+"""
+import threading
+
+import jobs
+
+# Seconds a test waits for a job before failing
+TIMEOUT = 5
+
+class BlockingRunner:
+    """Job runner that holds every run until released, recording the targets of each"""
+    
+    def __init__(self):
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.runs = []
+    
+    def __call__(self, job):
+        self.runs.append(None if job.targets is None else set(job.targets))
+        self.started.release()
+        assert self.release.wait(TIMEOUT)
+        return True
+
+def test_overlapping_submissions_share_one_job():
+    runner = BlockingRunner()
+    manager = jobs.JobManager(runner)
+    
+    running, created = manager.submit()
+    assert created
+    assert runner.started.acquire(timeout=TIMEOUT)
+    
+    # The running refresh of everything already covers a second request
+    joined, created = manager.submit(['000001.SZ'])
+    assert joined is running and not created
+    assert running.requests == 2
+    
+    runner.release.set()
+    assert running.wait(TIMEOUT)
+    assert running.status == jobs.SUCCEEDED
+    assert runner.runs == [None]
+    assert not manager.is_busy()
+
+def test_follow_up_submissions_coalesce_into_one_pending_job():
+    runner = BlockingRunner()
+    manager = jobs.JobManager(runner)
+    
+    running, _ = manager.submit(['000001.SZ'])
+    assert runner.started.acquire(timeout=TIMEOUT)
+    
+    # Requests the running job does not cover queue up as a single follow-up
+    pending, created = manager.submit(['600000.SH'])
+    assert created and pending is not running
+    merged, created = manager.submit(['00700.HK'])
+    assert merged is pending and not created
+    covered, created = manager.submit(['000001.SZ'])
+    assert covered is running and not created
+    assert pending.status == jobs.PENDING
+    assert pending.targets == {'600000.SH', '00700.HK'} and pending.requests == 2
+    
+    runner.release.set()
+    assert pending.wait(TIMEOUT)
+    assert running.status == pending.status == jobs.SUCCEEDED
+    assert runner.runs == [{'000001.SZ'}, {'600000.SH', '00700.HK'}]
+    assert not manager.is_busy()
@@ -0,0 +1,58 @@
+"""
+Fetch planning from the price watermarks and the trading calendars
+"""
+import db
+import stock_data
+import trade_calendar
+
+# January 2024 on a calendar closed on New Year's Day and the weekends
+JANUARY_OPEN_DATES = [f'202401{day:02d}' for day in range(2, 32)
+                      if trade_calendar._parse_date(f'202401{day:02d}').weekday() < 5]
+
+def _calendar():
+    return trade_calendar.TradeCalendar('SSE', JANUARY_OPEN_DATES, '20240101', '20240131')
+
+def test_stock_without_watermark_is_fetched_in_full():
+    calendar = _calendar()
+    assert stock_data._plan_daily_fetch(None, '20240101', '20240112', calendar) == ('20240101', True)
+    watermark = {'last_trade_date': None, 'covered_from': None}
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', calendar) == ('20240101', True)
+
+def test_current_stock_is_not_fetched():
+    calendar = _calendar()
+    watermark = {'last_trade_date': '20240112', 'covered_from': '20240102'}
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', calendar) is None
+    # No trading day has passed over the weekend either
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240114', calendar) is None
+
+def test_stock_behind_fetches_from_the_next_trade_date():
+    watermark = {'last_trade_date': '20240105', 'covered_from': '20240102'}
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', _calendar()) == ('20240108', False)
+
+def test_covered_from_after_the_window_start_is_fetched_in_full():
+    calendar = _calendar()
+    watermark = {'last_trade_date': '20240112', 'covered_from': '20240103'}
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', calendar) == ('20240101', True)
+    # The window starts on a holiday, so the first trading day after it is enough
+    watermark['covered_from'] = '20240102'
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', calendar) is None
+
+def test_watermark_before_the_window_is_fetched_in_full():
+    watermark = {'last_trade_date': '20231229', 'covered_from': '20231101'}
+    assert stock_data._plan_daily_fetch(watermark, '20240101', '20240112', _calendar()) == ('20240101', True)
+
+def test_plan_daily_updates_follows_the_stored_watermarks(universe, fake_pro):
+    codes = universe.market_codes(False)
+    assert all(stock_data.update_daily_data_batch(codes).values())
+    plans, start_date_str, _, _ = stock_data._plan_daily_updates(codes)
+    assert plans == {}
+    
+    missing, narrowed = codes[:2]
+    calendar = trade_calendar.get_calendar('SSE')
+    with db.transaction() as conn:
+        conn.execute('DELETE FROM price_watermarks WHERE ts_code = ?', (missing,))
+        conn.execute('UPDATE price_watermarks SET covered_from = ? WHERE ts_code = ?',
+                     (calendar.next_trade_date(calendar.first_trade_date_on_or_after(start_date_str)), narrowed))
+    
+    plans, start_date_str, _, _ = stock_data._plan_daily_updates(codes)
+    assert plans == {missing: (start_date_str, True), narrowed: (start_date_str, True)}
@@ -0,0 +1,66 @@
+"""
+Window metrics reduced from the price cube match those of the raw bars
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import db
+import metrics
+import price_cube
+
+CODES = ['000001.SZ', '600519.SH', '00700.HK', '09988.HK']
+
+# Business days of bars written before each test
+HISTORY_DAYS = 150
+
+def _bars(seed=0):
+    """Bars with exchange-like magnitudes: volumes and amounts far above 2**24"""
+    rng = np.random.default_rng(seed)
+    end = datetime.now() - timedelta(days=1)
+    dates = [date.strftime('%Y%m%d') for date in pd.bdate_range(end=end, periods=HISTORY_DAYS)]
+    rows = []
+    for ts_code in CODES:
+        for trade_date in dates:
+            close = round(float(rng.uniform(5, 2000)), 2)
+            rows.append({'ts_code': ts_code, 'trade_date': trade_date, 'open': close, 'high': round(close * 1.01, 2),
+                         'low': round(close * 0.99, 2), 'close': close, 'pre_close': close, 'change': -0.01,
+                         'pct_chg': round(float(rng.uniform(-10, 10)), 4),
+                         'vol': round(float(rng.uniform(1e7, 5e9)), 2),
+                         'amount': round(float(rng.uniform(1e9, 9e11)), 3)})
+    return pd.DataFrame(rows)
+
+def test_cube_metrics_match_the_raw_bars_on_realistic_volumes(database):
+    bars = _bars()
+    assert db.upsert_daily_prices(bars) is not None
+    cube = price_cube.get_cube()
+    assert cube.field('vol').dtype == np.float64 and cube.field('amount').dtype == np.float64
+    
+    start_date = sorted(bars['trade_date'].unique())[-60]
+    expected = metrics.compute_stock_metrics(bars[bars['trade_date'] >= start_date]).sort_index()
+    reduced = metrics.compute_cube_metrics(cube, CODES, start_date).sort_index()
+    pd.testing.assert_frame_equal(reduced, expected, check_dtype=False)
+    # Volumes are exact, not just close
+    assert (reduced['max_volume'] == expected['max_volume']).all()
+
+def test_cube_of_an_older_layout_is_rebuilt(database):
+    bars = _bars()
+    assert db.upsert_daily_prices(bars) is not None
+    directory = price_cube.get_cube_dir()
+    meta_path = os.path.join(directory, price_cube.META_FILE)
+    with open(meta_path, encoding='utf-8') as f:
+        meta = json.load(f)
+    del meta['format']
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    
+    # The next write rebuilds the cube from daily_prices instead of appending to it
+    newer = bars[bars['trade_date'] == bars['trade_date'].max()].copy()
+    newer['trade_date'] = datetime.now().strftime('%Y%m%d')
+    assert db.upsert_daily_prices(newer) is not None
+    cube = price_cube.get_cube(build=False)
+    assert cube is not None and cube.field('vol').dtype == np.float64
+    assert len(cube) == HISTORY_DAYS + 1 and sorted(cube.codes) == sorted(CODES)
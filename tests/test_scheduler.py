@@ -0,0 +1,88 @@
+"""
+Market-session-aware refresh scheduling at fixed times
+"""
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import db
+import scheduler
+import trade_calendar
+
+CODES = ['000001.SZ', '600000.SH', '00700.HK']
+
+# A Wednesday and the Saturday after it
+TRADING_DAY = (2025, 3, 12)
+SATURDAY = (2025, 3, 15)
+
+def _at(day, hour, minute):
+    """Aware datetime in Shanghai time (Hong Kong shares the UTC+8 offset)"""
+    return pytz.timezone('Asia/Shanghai').localize(datetime(*day, hour, minute))
+
+@pytest.fixture
+def refresh(database):
+    submitted = []
+    refresh_scheduler = scheduler.MarketRefreshScheduler(lambda codes: submitted.append(codes) or codes,
+                                                         lambda: CODES)
+    return refresh_scheduler, submitted
+
+@pytest.mark.parametrize('hour, minute, due', [
+    (9, 15, {}),
+    # A-share lunch break, Hong Kong still in its morning session
+    (11, 45, {'HK': 'session'}),
+    (13, 5, {'A': 'session', 'HK': 'session'}),
+    # A-shares closed, their post-close pass not due yet
+    (15, 10, {'HK': 'session'}),
+    (16, 5, {'A': 'post_close'}),
+    (17, 5, {'A': 'post_close', 'HK': 'post_close'}),
+    (23, 0, {'A': 'post_close', 'HK': 'post_close'}),
+])
+def test_due_markets_follow_the_sessions(refresh, hour, minute, due):
+    refresh_scheduler, _ = refresh
+    assert refresh_scheduler.get_due_markets(_at(TRADING_DAY, hour, minute)) == due
+
+@pytest.mark.parametrize('hour, minute', [(11, 45), (13, 5), (15, 10), (17, 5)])
+def test_nothing_is_due_on_a_weekend(refresh, hour, minute):
+    refresh_scheduler, _ = refresh
+    assert refresh_scheduler.get_due_markets(_at(SATURDAY, hour, minute)) == {}
+
+def test_nothing_is_due_on_a_holiday(refresh, monkeypatch):
+    refresh_scheduler, _ = refresh
+    holiday = '%04d%02d%02d' % TRADING_DAY
+    calendar = trade_calendar.TradeCalendar('SSE', [], holiday, holiday)
+    monkeypatch.setitem(trade_calendar._calendars, (db.DB_PATH, 'SSE'), calendar)
+    assert refresh_scheduler.get_due_markets(_at(TRADING_DAY, 13, 5)) == {'HK': 'session'}
+
+def test_session_refreshes_wait_for_the_interval(refresh):
+    refresh_scheduler, submitted = refresh
+    assert refresh_scheduler.tick(_at(TRADING_DAY, 13, 5)) == {'A': CODES[:2], 'HK': CODES[2:]}
+    assert refresh_scheduler.tick(_at(TRADING_DAY, 13, 15)) == {}
+    assert set(refresh_scheduler.tick(_at(TRADING_DAY, 13, 20))) == {'A', 'HK'}
+    assert len(submitted) == 4
+
+def test_post_close_pass_runs_once(refresh):
+    refresh_scheduler, submitted = refresh
+    assert refresh_scheduler.tick(_at(TRADING_DAY, 16, 5)) == {'A': CODES[:2]}
+    assert refresh_scheduler.get_due_markets(_at(TRADING_DAY, 16, 30)) == {}
+    assert refresh_scheduler.tick(_at(TRADING_DAY, 17, 5)) == {'HK': CODES[2:]}
+    assert refresh_scheduler.get_due_markets(_at(TRADING_DAY, 23, 0)) == {}
+    assert len(submitted) == 2
+    
+    # The next trading day has a pass of its own
+    next_day = (datetime(*TRADING_DAY) + timedelta(days=1)).timetuple()[:3]
+    assert refresh_scheduler.get_due_markets(_at(next_day, 17, 5)) == {'A': 'post_close', 'HK': 'post_close'}
+
+def test_refresh_after_the_close_skips_the_pass_after_a_restart(database):
+    post_close = _at(TRADING_DAY, 15, 0) + timedelta(minutes=scheduler.POST_CLOSE_DELAY_MINUTES['A'])
+    # Stored refresh times are naive local times
+    last_refresh = (post_close + timedelta(minutes=10)).astimezone().replace(tzinfo=None)
+    refresh_scheduler = scheduler.MarketRefreshScheduler(lambda codes: codes, lambda: CODES,
+                                                         last_refresh_provider=lambda: last_refresh)
+    
+    now = _at(TRADING_DAY, 16, 20)
+    refresh_scheduler._seed_post_close(now)
+    assert refresh_scheduler.post_close_done == {'A': '%04d%02d%02d' % TRADING_DAY}
+    assert refresh_scheduler.get_due_markets(now) == {}
+    # Hong Kong closed after that refresh, so its pass still runs
+    assert refresh_scheduler.get_due_markets(_at(TRADING_DAY, 17, 5)) == {'HK': 'post_close'}
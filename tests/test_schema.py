@@ -0,0 +1,70 @@
+"""
+Schema migrations of an existing database
+"""
+import sqlite3
+
+import db
+
+# daily_prices as created by the version 1 schema
+V1_DAILY_PRICES_SQL = '''
+CREATE TABLE daily_prices (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts_code TEXT,
+    trade_date TEXT,
+    open REAL,
+    high REAL,
+    low REAL,
+    close REAL,
+    pre_close REAL,
+    change REAL,
+    pct_chg REAL,
+    vol REAL,
+    amount REAL,
+    UNIQUE(ts_code, trade_date)
+)
+'''
+
+V1_BARS = [
+    ('000001.SZ', '20240102', 9.8, 10.2, 9.7, 10.0, 9.9, 0.1, 1.0101, 123456.0, 1234560.0),
+    ('000001.SZ', '20240103', 10.0, 10.1, 9.5, 9.6, 10.0, -0.4, -4.0, 234567.0, None),
+    ('600000.SH', '20240102', 7.0, 7.1, 6.9, 7.05, 7.0, 0.05, 0.7143, 99.0, 700.0),
+]
+
+def _schema_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return {
+            'versions': conn.execute('SELECT version FROM schema_version ORDER BY version').fetchall(),
+            'objects': conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall(),
+            'bars': conn.execute(f"SELECT {', '.join(db.DAILY_PRICE_COLUMNS)} FROM daily_prices "
+                                 "ORDER BY ts_code, trade_date").fetchall(),
+        }
+    finally:
+        conn.close()
+
+def test_version_1_database_is_migrated_once(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(V1_DAILY_PRICES_SQL)
+        conn.executemany(f"INSERT INTO daily_prices ({', '.join(db.DAILY_PRICE_COLUMNS)}) "
+                         f"VALUES ({', '.join(['?'] * len(db.DAILY_PRICE_COLUMNS))})", V1_BARS)
+    conn.close()
+    
+    db.use_database(path)
+    
+    assert db.get_schema_version() == 2
+    migrated = _schema_rows(path)
+    assert migrated['versions'] == [(2,)]
+    table_sql = next(sql for kind, name, sql in migrated['objects'] if name == 'daily_prices')
+    assert 'WITHOUT ROWID' in table_sql and ' id ' not in table_sql
+    # Reads of daily_prices go through its primary key; no secondary index to maintain on writes
+    assert not [name for kind, name, sql in migrated['objects'] if kind == 'index' and sql and 'ON daily_prices' in sql]
+    assert migrated['bars'] == [(ts_code, int(trade_date), *values) for ts_code, trade_date, *values in V1_BARS]
+    stored = db.get_daily_prices('000001.SZ')
+    assert list(stored['trade_date']) == ['20240103', '20240102']
+    assert stored['change'].iloc[0] == -0.4
+    
+    # A second initialization finds nothing to migrate
+    db.init_db()
+    assert _schema_rows(path) == migrated
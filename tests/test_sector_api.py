@@ -0,0 +1,75 @@
+"""
+/api/sector-data deltas between snapshot versions and conditional requests
+"""
+import pytest
+
+import app
+import db
+
+SECTORS = {'银行': ['平安银行', '浦发银行'], '互联网': ['腾讯控股']}
+
+def _stock(name, code, latest_price, sector_score):
+    return {'name': name, 'code': code, 'latest_price': latest_price, 'highest_price': 12.0,
+            'highest_date': '20240102', 'max_4m_increase': 5.0, 'drop_percentage': 10.0,
+            'sector_score': sector_score, 'latest_volume': 1000.0, 'max_volume': 2000.0, 'volume_ratio': 0.5}
+
+def _snapshot(bank_price=10.8):
+    return {
+        '银行': [_stock('平安银行', '000001.SZ', bank_price, 60.0), _stock('浦发银行', '600000.SH', 7.2, 60.0)],
+        '互联网': [_stock('腾讯控股', '00700.HK', 380.0, 40.0)],
+    }
+
+@pytest.fixture
+def client(database, monkeypatch):
+    monkeypatch.setattr(app, 'SECTORS', SECTORS)
+    app._sector_response_cache.clear()
+    return app.app.test_client()
+
+def test_unchanged_since_returns_an_empty_delta(client):
+    since = db.save_sector_snapshot(_snapshot())
+    version = db.save_sector_snapshot(_snapshot())
+    
+    for held in (since, version):
+        response = client.get(f'/api/sector-data?since={held}')
+        assert response.status_code == 200
+        delta = response.get_json()
+        assert delta['delta'] is True
+        assert (delta['since'], delta['version']) == (held, version)
+        assert delta['changed'] == {} and delta['removed'] == {} and delta['sector_scores'] == {}
+
+def test_delta_lists_only_the_changed_stocks(client):
+    since = db.save_sector_snapshot(_snapshot())
+    db.save_sector_snapshot(_snapshot(bank_price=11.5))
+    
+    delta = client.get(f'/api/sector-data?since={since}').get_json()
+    assert [stock['code'] for stock in delta['changed']['银行']] == ['000001.SZ']
+    assert set(delta['changed']) == {'银行'}
+
+def test_since_older_than_retention_returns_the_full_payload(client):
+    pruned = db.save_sector_snapshot(_snapshot())
+    db.save_sector_snapshot(_snapshot(bank_price=11.5))
+    version = db.save_sector_snapshot(_snapshot(bank_price=12.5))
+    db.prune_sector_snapshots(keep_last=1)
+    assert db.get_sector_snapshot(pruned) is None
+    
+    response = client.get(f'/api/sector-data?since={pruned}')
+    payload = response.get_json()
+    assert 'delta' not in payload
+    assert payload['version'] == version
+    assert payload['data']['银行'][0]['latest_price'] == 12.5
+    assert response.headers['ETag'] == f'W/"sector-data-{version}"'
+
+def test_matching_if_none_match_returns_not_modified(client):
+    since = db.save_sector_snapshot(_snapshot())
+    db.save_sector_snapshot(_snapshot(bank_price=11.5))
+    
+    for url in ('/api/sector-data', f'/api/sector-data?since={since}'):
+        etag = client.get(url).headers['ETag']
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+    
+    # A client holding an older version gets the new one
+    response = client.get('/api/sector-data', headers={'If-None-Match': f'W/"sector-data-{since}"'})
+    assert response.status_code == 200
@@ -0,0 +1,73 @@
+"""
+The incrementally maintained stock_metrics rows match a rescan of the raw bars
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db
+import metrics
+
+CODES = ['000001.SZ', '600000.SH', '00700.HK']
+
+# Business days of bars, reaching back past the start of the metrics window
+HISTORY_DAYS = 110
+
+def _bars(dates, seed):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for ts_code in CODES:
+        for trade_date in dates:
+            close = float(rng.uniform(5, 50))
+            rows.append({'ts_code': ts_code, 'trade_date': trade_date, 'open': close, 'high': close * 1.02,
+                         'low': close * 0.98, 'close': close, 'pre_close': close, 'change': 0.0,
+                         'pct_chg': float(rng.uniform(-10, 10)), 'vol': float(rng.integers(1000, 10 ** 7)),
+                         'amount': close * 1000})
+    return pd.DataFrame(rows)
+
+@pytest.fixture
+def dates(database):
+    end = datetime.now() - timedelta(days=1)
+    return [date.strftime('%Y%m%d') for date in pd.bdate_range(end=end, periods=HISTORY_DAYS)]
+
+def _assert_matches_rescan(written, window_start=None):
+    window_start = window_start or db.get_metrics_window_start()
+    stored = db.get_stock_metrics(CODES, window_start).sort_index()
+    expected = metrics.compute_stock_metrics(written[written['trade_date'] >= window_start]).sort_index()
+    pd.testing.assert_frame_equal(stored, expected, check_dtype=False, check_index_type=False)
+
+def _write(written, bars):
+    assert db.upsert_daily_prices(bars) is not None
+    written = pd.concat([written, bars]).drop_duplicates(['ts_code', 'trade_date'], keep='last')
+    _assert_matches_rescan(written)
+    return written
+
+def test_metrics_follow_appends_back_fills_and_window_moves(dates):
+    gap = dates[-40:-35]
+    seeded = [date for date in dates[:-5] if date not in gap]
+    written = _write(pd.DataFrame(), _bars(seeded, seed=1))
+    
+    # Daily append after the stored latest bar
+    written = _write(written, _bars(dates[-5:], seed=2))
+    
+    # Back-fill of older bars, newest first like out of order date batches.
+    # Every back-filled bar of one stock ties on a new window high, so the
+    # earliest of them has to win.
+    back_fill = _bars(gap, seed=3)
+    back_fill.loc[back_fill['ts_code'] == CODES[0], 'high'] = written['high'].max() + 1
+    for trade_date in reversed(gap):
+        written = _write(written, back_fill[back_fill['trade_date'] == trade_date])
+    
+    # Revision of the bar holding the high: only a rescan can find the new one
+    high_date = db.get_stock_metrics(CODES).loc[CODES[0], 'highest_date']
+    revised = written[(written['ts_code'] == CODES[0]) & (written['trade_date'] == high_date)].copy()
+    revised['high'] = 1.0
+    written = _write(written, revised)
+    
+    # Move the window past the dates of the back-filled extremes
+    new_high_date = db.get_stock_metrics(CODES).loc[CODES[0], 'highest_date']
+    later_start = dates[dates.index(max(gap[-1], new_high_date)) + 1]
+    assert db.refresh_stock_metrics(CODES, later_start) > 0
+    _assert_matches_rescan(written, later_start)
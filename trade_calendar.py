@@ -0,0 +1,230 @@
+"""
+Trading calendars of SSE, SZSE and HKEX cached in the trade_cal table
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+import db
+import fetcher
+
+logger = logging.getLogger(__name__)
+
+# Exchanges whose calendars are downloaded
+EXCHANGES = ('SSE', 'SZSE', 'HKEX')
+
+# Calendar used for each market's date-major fetches and freshness checks
+MARKET_EXCHANGES = {'A': 'SSE', 'HK': 'HKEX'}
+
+# Local timezone of every exchange
+EXCHANGE_TIMEZONES = {'SSE': 'Asia/Shanghai', 'SZSE': 'Asia/Shanghai', 'HKEX': 'Asia/Hong_Kong'}
+
+# Local opening time of every exchange; from then on the bar of a trading day is expected
+EXCHANGE_OPEN_TIMES = {'SSE': (9, 30), 'SZSE': (9, 30), 'HKEX': (9, 30)}
+
+# Days of history loaded before today (covers the longest price window)
+CALENDAR_LOOKBACK_DAYS = 400
+
+# Days after which a stored calendar is downloaded again (holidays get announced late)
+CALENDAR_REFRESH_DAYS = 30
+
+# Minutes to wait before retrying a failed or incomplete calendar download
+CALENDAR_RETRY_MINUTES = 60
+
+# Longest run of closed days searched for the previous/next trading day
+MAX_CLOSED_DAYS = 60
+
+def _format_date(date):
+    return date.strftime('%Y%m%d')
+
+def _parse_date(date_str):
+    return datetime.strptime(date_str, '%Y%m%d')
+
+class TradeCalendar:
+    """Trading days of one exchange
+    
+    Dates outside the stored range fall back to treating every weekday as a
+    trading day, which is also what an exchange without a stored calendar uses.
+    """
+    
+    def __init__(self, exchange, open_dates=(), first_date=None, last_date=None, last_updated=None):
+        self.exchange = exchange
+        self.open_dates = set(open_dates)
+        self.first_date = first_date
+        self.last_date = last_date
+        self.last_updated = last_updated
+    
+    def covers(self, start_date, end_date):
+        """Check whether the stored calendar covers start_date to end_date (YYYYMMDD)"""
+        return (self.first_date is not None and self.first_date <= start_date
+                and end_date <= self.last_date)
+    
+    def is_trade_day(self, date_str):
+        if self.first_date is not None and self.first_date <= date_str <= self.last_date:
+            return date_str in self.open_dates
+        return _parse_date(date_str).weekday() < 5
+    
+    def trade_dates(self, start_date, end_date):
+        """List the trading days between two dates (YYYYMMDD), oldest first"""
+        dates = []
+        current = _parse_date(start_date)
+        end = _parse_date(end_date)
+        while current <= end:
+            date_str = _format_date(current)
+            if self.is_trade_day(date_str):
+                dates.append(date_str)
+            current += timedelta(days=1)
+        return dates
+    
+    def _step(self, date_str, step):
+        current = _parse_date(date_str)
+        for _ in range(MAX_CLOSED_DAYS):
+            current += timedelta(days=step)
+            candidate = _format_date(current)
+            if self.is_trade_day(candidate):
+                return candidate
+        return _format_date(current)
+    
+    def previous_trade_date(self, date_str):
+        """Get the last trading day before date_str"""
+        return self._step(date_str, -1)
+    
+    def next_trade_date(self, date_str):
+        """Get the first trading day after date_str"""
+        return self._step(date_str, 1)
+    
+    def first_trade_date_on_or_after(self, date_str):
+        return date_str if self.is_trade_day(date_str) else self.next_trade_date(date_str)
+
+# Loaded calendars and the last download attempt, keyed by database file
+# (db.use_database may switch to another one)
+_calendars = {}
+_calendars_lock = threading.Lock()
+_last_download_attempts = {}
+
+def get_exchange(ts_code):
+    """Get the exchange whose calendar applies to a ts_code"""
+    if ts_code.endswith('.HK'):
+        return 'HKEX'
+    if ts_code.endswith('.SZ'):
+        return 'SZSE'
+    return 'SSE'
+
+def get_calendar(exchange):
+    """Get the in-memory calendar of an exchange, loading it from the database once"""
+    with _calendars_lock:
+        key = (db.DB_PATH, exchange)
+        calendar = _calendars.get(key)
+        if calendar is None:
+            stored = None
+            try:
+                stored = db.get_trade_calendar(exchange)
+            except Exception:
+                logger.exception("读取 %s 交易日历时发生错误", exchange)
+            calendar = TradeCalendar(exchange, *stored) if stored else TradeCalendar(exchange)
+            _calendars[key] = calendar
+        return calendar
+
+def _fetch_calendar(pro, exchange, start_date, end_date):
+    if exchange == 'HKEX':
+        return fetcher.call_api(pro, 'hk_tradecal', start_date=start_date, end_date=end_date,
+                                fields='cal_date,is_open,pretrade_date')
+    return fetcher.call_api(pro, 'trade_cal', exchange=exchange, start_date=start_date, end_date=end_date,
+                            fields='exchange,cal_date,is_open,pretrade_date')
+
+def load_trade_calendar(pro, start_date=None, exchanges=EXCHANGES):
+    """Download the calendars from Tushare and store them
+    
+    The range runs from start_date (or CALENDAR_LOOKBACK_DAYS ago, whichever
+    is earlier) to the end of the current year.
+    
+    Returns:
+        bool: True if every calendar was downloaded
+    """
+    today = datetime.now()
+    earliest = _format_date(today - timedelta(days=CALENDAR_LOOKBACK_DAYS))
+    start_date = min(start_date or earliest, earliest)
+    end_date = f'{today.year}1231'
+    
+    success = True
+    for exchange in exchanges:
+        try:
+            logger.info("获取 %s 交易日历 (%s - %s)...", exchange, start_date, end_date)
+            calendar = _fetch_calendar(pro, exchange, start_date, end_date)
+            if calendar is None or calendar.empty:
+                logger.warning("%s 交易日历为空", exchange)
+                success = False
+                continue
+            db.save_trade_calendar(exchange, calendar)
+            logger.info("成功保存 %s 交易日历 %d 天", exchange, len(calendar))
+        except Exception:
+            logger.exception("获取 %s 交易日历时发生错误", exchange)
+            success = False
+    
+    # Reload from the database on next use
+    with _calendars_lock:
+        _calendars.clear()
+    return success
+
+def ensure_trade_calendar(pro, start_date=None):
+    """Download the calendars if they are missing, too old or do not cover start_date to today
+    
+    Failed downloads are retried at most every CALENDAR_RETRY_MINUTES; until
+    then the weekday fallback of TradeCalendar applies.
+    
+    Returns:
+        bool: True if usable calendars are stored
+    """
+    now = datetime.now()
+    today = _format_date(now)
+    stale = []
+    for exchange in EXCHANGES:
+        calendar = get_calendar(exchange)
+        if (calendar.last_updated is None
+                or now - calendar.last_updated > timedelta(days=CALENDAR_REFRESH_DAYS)
+                or not calendar.covers(start_date or today, today)):
+            stale.append(exchange)
+    if not stale:
+        return True
+    
+    with _calendars_lock:
+        last_attempt = _last_download_attempts.get(db.DB_PATH)
+        if last_attempt is not None and now - last_attempt < timedelta(minutes=CALENDAR_RETRY_MINUTES):
+            return False
+        _last_download_attempts[db.DB_PATH] = now
+    return load_trade_calendar(pro, start_date, stale)
+
+def is_trade_day(exchange, date_str=None):
+    """Check whether a date (default: today in the exchange's timezone) is a trading day"""
+    if date_str is None:
+        date_str = _format_date(datetime.now(pytz.timezone(EXCHANGE_TIMEZONES[exchange])))
+    return get_calendar(exchange).is_trade_day(date_str)
+
+def get_expected_latest_trade_date(exchange, now=None):
+    """Get the latest trading day whose bar can exist at `now`
+    
+    That is today once the exchange has opened on a trading day, and the
+    previous trading day otherwise (before the open, weekends and holidays).
+    """
+    local_now = (now or datetime.now(pytz.utc)).astimezone(pytz.timezone(EXCHANGE_TIMEZONES[exchange]))
+    today = _format_date(local_now)
+    calendar = get_calendar(exchange)
+    if calendar.is_trade_day(today) and (local_now.hour, local_now.minute) >= EXCHANGE_OPEN_TIMES[exchange]:
+        return today
+    return calendar.previous_trade_date(today)
+
+def get_oldest_fresh_trade_date(ts_code, days=1):
+    """Get the oldest trade_date a stock's latest bar may have and still count as fresh
+    
+    Args:
+        ts_code: Stock code (selects the exchange calendar)
+        days: Number of trading days, counting the expected latest one, that are fresh
+    """
+    exchange = get_exchange(ts_code)
+    calendar = get_calendar(exchange)
+    oldest = get_expected_latest_trade_date(exchange)
+    for _ in range(max(days, 1) - 1):
+        oldest = calendar.previous_trade_date(oldest)
+    return oldest
@@ -0,0 +1,129 @@
+"""
+Compact wire formats and field projection for the /api/sector-data payload
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional: several times faster than the json module
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # Optional: only needed for encoding=msgpack
+    msgpack = None
+
+# Per-stock fields of a sector row, in column order
+STOCK_FIELDS = ['code', 'name', 'latest_price', 'highest_price', 'highest_date', 'max_4m_increase',
+                'drop_percentage', 'latest_volume', 'max_volume', 'volume_ratio']
+
+# Fields a row can hold; sector_score is the same for every stock of a sector
+# and is sent once per sector in sector_scores
+ROW_FIELDS = STOCK_FIELDS + ['sector_score']
+
+# Supported payload layouts and encodings
+FORMATS = ('rows', 'columnar')
+ENCODINGS = ('json', 'msgpack')
+
+MIMETYPES = {'json': 'application/json', 'msgpack': 'application/x-msgpack'}
+
+def is_encoding_available(encoding):
+    """Check whether the library behind an encoding is installed"""
+    return encoding == 'json' or (encoding == 'msgpack' and msgpack is not None)
+
+def parse_fields(value):
+    """Parse a comma separated fields= parameter
+    
+    Returns:
+        tuple: The requested fields in ROW_FIELDS order (code is always
+        included), or None for all fields
+    
+    Raises:
+        ValueError: If a field is unknown
+    """
+    if not value:
+        return None
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested - set(ROW_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    requested.add('code')
+    return tuple(field for field in ROW_FIELDS if field in requested)
+
+def _project(stock, fields):
+    return {field: stock.get(field) for field in fields}
+
+def project_rows(payload, fields=None):
+    """Keep only the requested fields of every stock of a row payload (full or delta)"""
+    if fields is None:
+        return payload
+    projected = dict(payload)
+    key = 'changed' if payload.get('delta') else 'data'
+    projected[key] = {sector: [_project(stock, fields) for stock in stocks]
+                      for sector, stocks in payload[key].items()}
+    return projected
+
+def to_columnar(payload, fields=None):
+    """Convert a full row payload to the columnar layout
+    
+    Every distinct stock row is stored once in `columns` (one list per field)
+    and each sector lists the indexes of its stocks, so a stock shared by
+    several sectors and the repeated sector_score are sent only once.
+    
+    Returns:
+        dict: {'format': 'columnar', 'fields': [...], 'columns': {field: [...]},
+        'sectors': {sector: [index, ...]}, 'sector_scores', 'sorted_sectors', ...}
+    """
+    fields = [field for field in (fields or STOCK_FIELDS) if field != 'sector_score']
+    columns = {field: [] for field in fields}
+    row_indexes = {}
+    sectors = {}
+    
+    for sector, stocks in payload['data'].items():
+        indexes = []
+        for stock in stocks:
+            row = tuple(stock.get(field) for field in fields)
+            index = row_indexes.get(row)
+            if index is None:
+                index = row_indexes[row] = len(row_indexes)
+                for field, value in zip(fields, row):
+                    columns[field].append(value)
+            indexes.append(index)
+        sectors[sector] = indexes
+    
+    columnar = {key: value for key, value in payload.items() if key != 'data'}
+    columnar.update({
+        'format': 'columnar',
+        'fields': fields,
+        'columns': columns,
+        'sectors': sectors
+    })
+    return columnar
+
+def dumps_json(payload):
+    """Encode a payload as compact UTF-8 JSON (NaN becomes null)"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(_replace_nan(payload), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _replace_nan(value):
+    """Replace float NaN values (invalid JSON) with None, recursively"""
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, dict):
+        return {key: _replace_nan(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_replace_nan(item) for item in value]
+    return value
+
+def encode(payload, encoding='json'):
+    """Encode a payload
+    
+    Returns:
+        tuple: (body bytes, mimetype)
+    """
+    if encoding == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        return msgpack.packb(payload, use_bin_type=True), MIMETYPES['msgpack']
+    return dumps_json(payload), MIMETYPES['json']